@@ -0,0 +1,310 @@
+###################################################################################################
+#
+# This file is part of the HPC allocator code for the UMD astronomy department
+#
+# (c) Benedikt Diemer
+#
+###################################################################################################
+
+import copy
+import heapq
+import datetime
+import threading
+
+import config
+import utils
+import context
+import cluster
+import pools
+
+###################################################################################################
+
+# Job-level SU accounting. Instead of the totals reported by sbalance, the usage of each group is
+# computed from the job records of its Slurm account, which are read from sacct in chunks of a few
+# days each. The cost of each job is computed from its allocated TRES (CPUs, memory, GPUs and so
+# on), its run time, and a factor for its partition. The usage is aggregated per user, so that the
+# memory needed does not depend on the number of jobs.
+#
+# For each account, the end time of the last processed job is kept as a checkpoint, so that each
+# run only reads the jobs that ended since the last run. Jobs are counted when they end. Slurm can
+# write job records late (e.g., when slurmdbd is behind), so each run reads again a lookback window
+# before the checkpoint. The IDs of the jobs that ended within this window are kept so that they 
+# are not counted twice. The state is reset at the beginning of each quarter, when the Slurm usage
+# counters are reset as well.
+#
+# For each account, the most expensive jobs that ended since the start of the current period are 
+# kept in a min-heap of fixed size. Each new job is compared only to the cheapest job on the heap,
+# so the cost of this drilldown does not depend on the number of jobs either.
+
+# Job states that mean a job has ended
+end_states = 'CD,F,TO,CA,NF,OOM,PR,DL,BF'
+sacct_format = 'JobIDRaw,User,Partition,ElapsedRaw,AllocTRES,End,Account'
+time_format = '%Y-%m-%dT%H:%M:%S'
+
+# The accounting states are kept in the active context (see context.py) by file name, so that 
+# departments with separate files do not mix. Groups can be processed in parallel threads, which
+# share the state.
+states_lock = threading.Lock()
+
+###################################################################################################
+
+def loadState():
+
+    cfg = config.getConfig()
+
+    fname = cfg['accounting']['yaml_file']
+    states = context.get().accounting_states
+    with states_lock:
+        if not fname in states:
+            st = utils.readYaml(fname)
+            if st is None:
+                st = {}
+            states[fname] = st
+
+    return states[fname]
+
+###################################################################################################
+
+def saveState():
+
+    cfg = config.getConfig()
+
+    utils.writeYaml(cfg['accounting']['yaml_file'], loadState())
+
+    return
+
+###################################################################################################
+
+# Convert a TRES amount to a number. Memory is converted to GB; other TRES have no units.
+
+def getTresAmount(tres, value):
+
+    if tres == 'mem':
+        unit = value[-1].upper()
+        if unit in ['K', 'M', 'G', 'T']:
+            return utils.getSizeFromString(value[:-1], unit + 'B')
+        return utils.getSizeFromString(value, 'MB')
+
+    return float(value)
+
+###################################################################################################
+
+# Compute the cost of a job in SU. The TRES weights are given in SU per unit and hour; TRES without
+# a weight are not charged. The same computation gives the usage of other resource pools if their
+# config is passed, in which case the partition factors are optional.
+
+def getJobCost(partition, elapsed_sec, alloc_tres, cfg_cost = None):
+
+    cfg = config.getConfig()
+    if cfg_cost is None:
+        cfg_cost = cfg['accounting']
+
+    su_per_hour = 0.0
+    for item in alloc_tres.split(','):
+        if not '=' in item:
+            continue
+        tres, value = item.split('=', 1)
+        if tres in cfg_cost['tres_weights']:
+            su_per_hour += cfg_cost['tres_weights'][tres] * getTresAmount(tres, value)
+    factors = cfg_cost.get('partition_factors', None)
+    if factors is None:
+        fac = 1.0
+    else:
+        fac = factors.get(partition, factors['default'])
+    su = su_per_hour * fac * elapsed_sec / 3600.0
+
+    return su
+
+###################################################################################################
+
+# Parse one line of sacct output into a job dictionary; returns None for jobs without end time.
+
+def parseJobLine(line):
+
+    cfg = config.getConfig()
+
+    w = line.strip().split('|')
+    if len(w) < 7:
+        return None
+    if w[5] in ['', 'Unknown', 'None']:
+        return None
+
+    job = {}
+    job['id'] = w[0]
+    job['user'] = w[1]
+    job['partition'] = w[2]
+    job['elapsed'] = int(w[3])
+    job['tres'] = w[4]
+    job['end'] = datetime.datetime.strptime(w[5], time_format)
+    job['account'] = w[6]
+    job['su'] = getJobCost(job['partition'], job['elapsed'], job['tres'])
+    job['pools'] = {}
+    for r in pools.getPools():
+        job['pools'][r] = getJobCost(job['partition'], job['elapsed'], job['tres'], cfg_cost = cfg['pools'][r])
+
+    return job
+
+###################################################################################################
+
+# Update the usage of the given groups with all jobs that ended since their last checkpoints, and 
+# return a dictionary with the usage of each group in the same format as collectGroupSU() in 
+# run.py. The SU quota is not known from job records and is returned as None. The jobs of all 
+# groups are read with one sacct query per chunk, which covers the accounts whose checkpoints are
+# before the end of the chunk.
+
+def collectSU(grps, q_all, q_start, p_start, t_now = None):
+
+    cfg = config.getConfig()
+    st = loadState()
+
+    n_top = cfg['accounting']['top_jobs']
+    p_start_str = datetime.datetime.combine(p_start, datetime.time()).strftime(time_format)
+    accts = {}
+    for grp in grps:
+        acct = '%s-%s' % (grp, cfg['slurm_account'])
+        accts[acct] = grp
+        if (not acct in st) or (st[acct]['quarter'] != q_all):
+            st[acct] = {}
+            st[acct]['quarter'] = q_all
+            st[acct]['checkpoint'] = datetime.datetime.combine(q_start, datetime.time()).strftime(time_format)
+            st[acct]['ids_recent'] = {}
+            st[acct]['users'] = {}
+            st[acct]['n_jobs'] = 0
+    
+        # Reset the list of top jobs if a new period has started
+        if st[acct].get('top_start', None) != p_start_str:
+            st[acct]['top_start'] = p_start_str
+            st[acct]['top_jobs'] = []
+
+    if t_now is None:
+        t_now = utils.getNow().replace(microsecond = 0)
+    chunk = datetime.timedelta(days = cfg['accounting']['chunk_days'])
+    lookback = datetime.timedelta(minutes = cfg['accounting']['lookback'])
+    q_start_dt = datetime.datetime.combine(q_start, datetime.time())
+    ckpts = {}
+    n_new = {}
+    for acct in accts:
+        ckpts[acct] = datetime.datetime.strptime(st[acct]['checkpoint'], time_format)
+        n_new[acct] = 0
+
+    # The jobs of an account are read from the start of its lookback window, but not from before
+    # the start of the quarter
+    def getWindowStart(acct):
+        return max(ckpts[acct] - lookback, q_start_dt)
+
+    t_start = min([getWindowStart(acct) for acct in accts], default = t_now)
+    while t_start < t_now:
+        t_end = min(t_start + chunk, t_now)
+        accts_chunk = [acct for acct in accts if getWindowStart(acct) < t_end]
+        if len(accts_chunk) == 0:
+            t_start = t_end
+            continue
+        rettxt = cluster.runCommand(['sacct', '-a', '-X', '-n', '-P', '-A', ','.join(accts_chunk),
+                                     '-s', end_states, '--format=%s' % (sacct_format),
+                                     '-S', t_start.strftime(time_format), '-E', t_end.strftime(time_format)])
+
+        # All lines of the chunk are parsed before any job is counted, so that an error cannot 
+        # leave the state with part of a chunk whose jobs would be counted again in the next run. 
+        # Lines that cannot be parsed are skipped.
+        jobs = []
+        for line in rettxt.splitlines():
+            try:
+                job = parseJobLine(line)
+            except Exception as e:
+                print('    WARNING: could not parse sacct line "%s", skipping job (%s).' % (line.strip(), str(e)))
+                continue
+            if job is not None:
+                jobs.append(job)
+
+        # Process jobs that ended within the lookback window of their account or later, before 
+        # the end of this chunk, and that were not counted yet. The checkpoints are advanced only
+        # after the chunk.
+        ckpts_new = {}
+        for acct in accts_chunk:
+            ckpts_new[acct] = ckpts[acct]
+        for job in jobs:
+            if not job['account'] in ckpts_new:
+                continue
+            acct = job['account']
+            acc = st[acct]
+            if (job['end'] < getWindowStart(acct)) or (job['end'] > t_end):
+                continue
+            if job['id'] in acc['ids_recent']:
+                continue
+            acc['ids_recent'][job['id']] = job['end'].strftime(time_format)
+            acc['users'][job['user']] = acc['users'].get(job['user'], 0.0) + job['su']
+            if len(job['pools']) > 0:
+                if not 'pool_users' in acc:
+                    acc['pool_users'] = {}
+                if not job['user'] in acc['pool_users']:
+                    acc['pool_users'][job['user']] = {}
+                for r in job['pools']:
+                    acc['pool_users'][job['user']][r] = acc['pool_users'][job['user']].get(r, 0.0) + job['pools'][r]
+            acc['n_jobs'] += 1
+            n_new[acct] += 1
+            if (n_top > 0) and (job['end'].strftime(time_format) >= p_start_str):
+                item = [job['su'], job['id'], job['user'], job['partition'], job['end'].strftime(time_format)]
+                if len(acc['top_jobs']) < n_top:
+                    heapq.heappush(acc['top_jobs'], item)
+                elif item[0] > acc['top_jobs'][0][0]:
+                    heapq.heapreplace(acc['top_jobs'], item)
+            if job['end'] > ckpts_new[acct]:
+                ckpts_new[acct] = job['end']
+
+        # Forget the jobs that have left the lookback window
+        for acct in accts_chunk:
+            acc = st[acct]
+            ckpts[acct] = ckpts_new[acct]
+            acc['checkpoint'] = ckpts[acct].strftime(time_format)
+            t_window = getWindowStart(acct).strftime(time_format)
+            acc['ids_recent'] = {k: v for k, v in acc['ids_recent'].items() if v >= t_window}
+        t_start = t_end
+
+    ret = {}
+    for acct in accts:
+        acc = st[acct]
+        su_usage = 0.0
+        for usr in acc['users']:
+            su_usage += acc['users'][usr]
+        print('    Group %-15s processed %d new jobs, %d total this quarter.' % (accts[acct], n_new[acct], acc['n_jobs']))
+        ret[accts[acct]] = [None, su_usage, dict(acc['users'])]
+
+    return ret
+
+###################################################################################################
+
+# Return the most expensive jobs of a group in the current period, sorted by decreasing cost. Each
+# job is a dictionary with id, user, partition, su, and end time.
+
+def getTopJobs(grp):
+
+    cfg = config.getConfig()
+    st = loadState()
+
+    acct = '%s-%s' % (grp, cfg['slurm_account'])
+    if (not acct in st) or (not 'top_jobs' in st[acct]):
+        return []
+    
+    jobs = []
+    for item in sorted(st[acct]['top_jobs'], reverse = True):
+        jobs.append({'su': item[0], 'id': item[1], 'user': item[2], 'partition': item[3], 'end': item[4]})
+
+    return jobs
+
+###################################################################################################
+
+# Return the cumulative usage of the resource pools this quarter for each user of a group, as a
+# dictionary of users with a dictionary of pools.
+
+def getPoolUsage(grp):
+
+    cfg = config.getConfig()
+    st = loadState()
+
+    acct = '%s-%s' % (grp, cfg['slurm_account'])
+    if (not acct in st) or (not 'pool_users' in st[acct]):
+        return {}
+
+    return copy.deepcopy(st[acct]['pool_users'])
+
+###################################################################################################
@@ -0,0 +1,93 @@
+###################################################################################################
+#
+# This file is part of the HPC allocator code for the UMD astronomy department
+#
+# (c) Benedikt Diemer
+#
+###################################################################################################
+
+import context
+import cluster
+import lock
+import server
+import run
+
+###################################################################################################
+
+# An allocator that owns its config, clock, data source, state store, and mailer (see context.py
+# for the options). Each instance runs in its own context, so that many instances can be used
+# concurrently in one process, e.g., one per thread:
+#
+#     alloc = allocator.Allocator(cfg = cfg, store = {}, outbox = [], runner = runner)
+#     alloc.check()
+#
+# The command-line interface in run.py is a thin wrapper around this class. Any function of the
+# other modules can be run in the instance's context with run().
+
+class Allocator():
+
+    def __init__(self, config_path = context.config_path, config_path_email = context.config_path_email,
+                 cfg = None, test_mode = False, dry_run = True, clock = None, store = None, runner = None,
+                 mailer = None, outbox = None):
+
+        self.context = context.Context(config_path = config_path, config_path_email = config_path_email,
+                                       cfg = cfg, test_mode = test_mode, dry_run = dry_run, clock = clock,
+                                       store = store, runner = runner, mailer = mailer, outbox = outbox)
+
+        return
+
+    ###############################################################################################
+
+    # Run a function in the context of this allocator and return its result.
+
+    def run(self, func, *args, **kwargs):
+
+        with context.activate(self.context):
+            ret = func(*args, **kwargs)
+
+        return ret
+
+    ###############################################################################################
+
+    # Run the check for all departments, holding the lock. If a recording file is given, all
+    # cluster commands and their output are appended to it. If a replay file is given, the runs in
+    # it are checked instead of querying the cluster.
+
+    def check(self, days_future = 0, record_file = None, replay_file = None):
+
+        with context.activate(self.context):
+            if replay_file is not None:
+                run.replayRecording(replay_file)
+            elif record_file is not None:
+                cluster.startRecording(record_file, days_future = days_future)
+                try:
+                    lock.runExclusive(run.checkDepartments, days_future = days_future)
+                finally:
+                    cluster.stopRecording()
+            else:
+                lock.runExclusive(run.checkDepartments, days_future = days_future)
+
+        return
+
+    ###############################################################################################
+
+    # Simulate the check for each day from date_start to date_end (given as YYYY-MM-DD).
+
+    def simulate(self, date_start, date_end, replay_file = None, report_file = None):
+
+        self.run(run.simulateRange, date_start, date_end, replay_file = replay_file,
+                 report_file = report_file)
+
+        return
+
+    ###############################################################################################
+
+    # Serve the status pages until interrupted.
+
+    def serve(self):
+
+        self.run(server.serve)
+
+        return
+
+###################################################################################################
@@ -0,0 +1,238 @@
+###################################################################################################
+#
+# This file is part of the HPC allocator code for the UMD astronomy department
+#
+# (c) Benedikt Diemer
+#
+###################################################################################################
+
+import os
+import gzip
+import json
+import fcntl
+import datetime
+
+import config
+import utils
+import context
+
+###################################################################################################
+
+# Archive of all emails, both drafts (from dry runs) and sent messages. The messages are stored in
+# mbox format in monthly segments, one per kind. Each message is compressed as a separate gzip
+# member, so that a segment is a valid gzipped mbox file but each message can be read without
+# decompressing the rest of the segment. For each segment, an index file contains one JSON line per
+# message with its time, type, groups, recipients, subject, and position in the segment. Segments
+# older than the retention time of their kind are deleted together with their index.
+
+kinds = ['draft', 'sent']
+time_format = '%Y-%m-%dT%H:%M:%S'
+
+# Old segments are pruned once per context (see context.py), when the first message is stored
+
+###################################################################################################
+
+def getSegmentBase(kind, t):
+
+    cfg = config.getConfig()
+
+    return os.path.join(cfg['email_archive']['dir'], '%s_%s' % (kind, t.strftime('%Y_%m')))
+
+###################################################################################################
+
+# Find all segments of the given kinds, as a list of [kind, first day of month, base file name].
+
+def getSegments(kinds_use = None):
+
+    cfg = config.getConfig()
+
+    if kinds_use is None:
+        kinds_use = kinds
+    archive_dir = cfg['email_archive']['dir']
+    if not os.path.exists(archive_dir):
+        return []
+
+    segments = []
+    for fn in sorted(os.listdir(archive_dir)):
+        if not fn.endswith('.idx'):
+            continue
+        w = fn[:-4].split('_')
+        if (len(w) != 3) or (not w[0] in kinds_use):
+            continue
+        month = datetime.date(int(w[1]), int(w[2]), 1)
+        segments.append([w[0], month, os.path.join(archive_dir, fn[:-4])])
+
+    return segments
+
+###################################################################################################
+
+# Delete the segments that ended more than the retention time ago. A retention time of None means
+# that messages of this kind are kept forever.
+
+def pruneArchive():
+
+    cfg = config.getConfig()
+
+    context.get().archive_pruned = True
+    date_today = utils.getToday()
+    for kind, month, base in getSegments():
+        days = cfg['email_archive']['retention_days'][kind]
+        if days is None:
+            continue
+        if month.month == 12:
+            month_next = datetime.date(month.year + 1, 1, 1)
+        else:
+            month_next = datetime.date(month.year, month.month + 1, 1)
+        if month_next > date_today - datetime.timedelta(days = days):
+            continue
+        print('    Deleting email archive segment %s (older than %d days).' % (base, days))
+        for ext in ['.idx', '.mbox.gz']:
+            if os.path.exists(base + ext):
+                os.remove(base + ext)
+
+    return
+
+###################################################################################################
+
+def formatMessage(recipients, subject, content, t):
+
+    cfg = config.getConfig()
+
+    txt = 'From %s %s\n' % (cfg['email']['sender_email'], t.strftime('%a %b %d %H:%M:%S %Y'))
+    txt += 'From: %s\n' % (cfg['email']['sender_email'])
+    txt += 'To: %s\n' % (recipients)
+    txt += 'Subject: %s\n' % (subject)
+    txt += 'Date: %s\n' % (t.strftime('%a, %d %b %Y %H:%M:%S'))
+    txt += '\n'
+    for l in content.splitlines():
+        if l.startswith('From '):
+            l = '>' + l
+        txt += l + '\n'
+    txt += '\n'
+
+    return txt
+
+###################################################################################################
+
+# Add a message to the current segment of its kind (draft or sent). The groups are the groups the
+# message refers to.
+
+def storeMessage(kind, recipients, subject, content, msg_type = 'other', groups = None):
+
+    cfg = config.getConfig()
+
+    if not kind in kinds:
+        raise Exception('Unknown email kind, "%s". Allowed are %s.' % (kind, str(kinds)))
+    if not os.path.exists(cfg['email_archive']['dir']):
+        os.makedirs(cfg['email_archive']['dir'])
+    if not context.get().archive_pruned:
+        pruneArchive()
+    if groups is None:
+        groups = []
+
+    t = utils.getNow().replace(microsecond = 0)
+    base = getSegmentBase(kind, t)
+    data = gzip.compress(formatMessage(recipients, subject, content, t).encode())
+
+    # The lock on the segment keeps the offsets in the index consistent if several processes write
+    f = open(base + '.mbox.gz', 'ab')
+    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+    try:
+        f.seek(0, 2)
+        offset = f.tell()
+        f.write(data)
+        f.flush()
+        entry = {'time': t.strftime(time_format), 'type': msg_type, 'groups': groups,
+                 'to': [r.strip() for r in recipients.split(',')], 'subject': subject,
+                 'offset': offset, 'length': len(data)}
+        f_idx = open(base + '.idx', 'a')
+        f_idx.write(json.dumps(entry) + '\n')
+        f_idx.close()
+    finally:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        f.close()
+
+    return
+
+###################################################################################################
+
+# Find the index entries that match all given criteria. Dates are inclusive; the user is matched
+# against the user names of the recipients.
+
+def findMessages(grp = None, usr = None, msg_type = None, date_start = None, date_end = None,
+                 kinds_use = None):
+
+    found = []
+    for kind, month, base in getSegments(kinds_use):
+        if (date_end is not None) and (month > date_end):
+            continue
+        if (date_start is not None) and (month < date_start.replace(day = 1)):
+            continue
+        f = open(base + '.idx', 'r')
+        ll = f.readlines()
+        f.close()
+        for l in ll:
+            entry = json.loads(l)
+            t = datetime.datetime.strptime(entry['time'], time_format)
+            if (date_start is not None) and (t.date() < date_start):
+                continue
+            if (date_end is not None) and (t.date() > date_end):
+                continue
+            if (grp is not None) and (not grp in entry['groups']):
+                continue
+            if (msg_type is not None) and (entry['type'] != msg_type):
+                continue
+            if usr is not None:
+                usrs = [r.split('@')[0] for r in entry['to']]
+                if not usr in usrs:
+                    continue
+            entry['kind'] = kind
+            entry['segment'] = base + '.mbox.gz'
+            found.append(entry)
+
+    found.sort(key = lambda e: e['time'])
+
+    return found
+
+###################################################################################################
+
+# Read one message from its segment. Returns the message in mbox format, without the separator.
+
+def readMessage(entry):
+
+    f = open(entry['segment'], 'rb')
+    f.seek(entry['offset'])
+    data = f.read(entry['length'])
+    f.close()
+    txt = gzip.decompress(data).decode()
+    ll = txt.splitlines()[1:]
+    for i in range(len(ll)):
+        if ll[i].startswith('>From '):
+            ll[i] = ll[i][1:]
+
+    return '\n'.join(ll)
+
+###################################################################################################
+
+def printMessages(grp = None, usr = None, msg_type = None, date_start = None, date_end = None,
+                  show_content = False):
+
+    found = findMessages(grp = grp, usr = usr, msg_type = msg_type, date_start = date_start,
+                         date_end = date_end)
+
+    print('Found %d messages.' % (len(found)))
+    print('    | Time                | Kind  | Type       | Groups               | Subject')
+    print('    ----------------------------------------------------------------------------------------------------')
+    for entry in found:
+        print('    | %-19s | %-5s | %-10s | %-20s | %s' \
+              % (entry['time'].replace('T', ' '), entry['kind'], entry['type'],
+                 ', '.join(entry['groups'])[:20], entry['subject']))
+        if show_content:
+            print('')
+            for l in readMessage(entry).splitlines():
+                print('        %s' % (l))
+            print('')
+
+    return
+
+###################################################################################################
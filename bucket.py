@@ -0,0 +1,176 @@
+###################################################################################################
+#
+# This file is part of the HPC allocator code for the UMD astronomy department
+#
+# (c) Benedikt Diemer
+#
+###################################################################################################
+
+import datetime
+
+import config
+import utils
+
+###################################################################################################
+
+# Continuous allocation with token buckets. Instead of receiving a fixed allocation at the start of
+# each period, each group has a bucket of SUs that is refilled continuously at its weight fraction
+# of the remaining quarterly SUs per remaining day of the quarter. The bucket holds at most
+# capacity_days days of refill, so that idle groups cannot hoard allocation, and it starts full at
+# the beginning of each quarter. At each check, the bucket is refilled for the time since the last
+# check and the usage since then is taken out.
+#
+# The periods remain the units of reporting, and the bucket is carried from one period to the next.
+# The allocation of a group in a period is its usage in the period plus the tokens in its bucket, so
+# that the usual warning levels apply to the fraction of the available SUs that has been used. A
+# group whose bucket is empty has exceeded its allocation. When a new period starts, a negative
+# balance is multiplied by the penalty factor; unused tokens expire at the end of a quarter but the
+# penalty does not.
+#
+# The refill rates are updated after each check from the remaining SUs of the department, that is,
+# the SUs available at the start of the period minus the usage of all groups since then.
+
+###################################################################################################
+
+def isEnabled():
+
+    cfg = config.getConfig()
+
+    return cfg['bucket']['enabled']
+
+###################################################################################################
+
+# The first day of the next quarter, i.e., the time when the current quarter's SUs run out.
+
+def getQuarterEnd(p_start, p):
+
+    cfg = config.getConfig()
+
+    q_start = p_start - datetime.timedelta(days = cfg['periods'][p]['start_day'])
+    if q_start.month >= 10:
+        q_end = datetime.date(q_start.year + 1, 1, 1)
+    else:
+        q_end = datetime.date(q_start.year, q_start.month + 3, 1)
+
+    return datetime.datetime.combine(q_end, datetime.time())
+
+###################################################################################################
+
+# Set the refill rates (in SU per day) and capacities of all groups in a period, given the SUs that
+# remain to be distributed until the end of the quarter.
+
+def setRates(prd_data, su_remaining, t_now, q_end):
+
+    cfg = config.getConfig()
+
+    days_left = max((q_end - t_now).total_seconds() / 86400.0, 1.0)
+    su_remaining = max(su_remaining, 0.0)
+    prd_data['bucket']['su_remaining'] = su_remaining
+    prd_data['bucket']['days_left'] = days_left
+    for grp in prd_data['groups']:
+        b = prd_data['groups'][grp]['bucket']
+        b['rate'] = prd_data['groups'][grp]['weight_frac'] * su_remaining / days_left
+        b['capacity'] = b['rate'] * cfg['bucket']['capacity_days']
+
+    return
+
+###################################################################################################
+
+# Refill a bucket up to time t and take out the SU usage since the last update. The usage is taken
+# out before the capacity is applied, since the group consumed SUs while the bucket was filling.
+
+def updateTokens(b, su_usage, t):
+
+    dt = max((t - b['time']) / 86400.0, 0.0)
+    b['tokens'] = min(b['tokens'] - (su_usage - b['su_usage']) + b['rate'] * dt, b['capacity'])
+    b['su_usage'] = su_usage
+    b['time'] = t
+
+    return
+
+###################################################################################################
+
+# Start the buckets in a new period. The groups must have their weight fractions and penalties in
+# the period data; the penalty is replaced by the negative balance of the group's bucket if the
+# group had a bucket in the previous period. The buckets of the previous period are updated to its
+# final usage first. The period's su_alloc is the total refill expected over the period.
+
+def startPeriod(prd_new, prd_old, p, new_quarter):
+
+    cfg = config.getConfig()
+
+    now = utils.getNow()
+    t_now = now.timestamp()
+    q_end = getQuarterEnd(prd_new['start_date'], p)
+    p_end = datetime.datetime.combine(prd_new['end_date'], datetime.time()) + datetime.timedelta(days = 1)
+
+    prd_new['bucket'] = {'capacity_days': cfg['bucket']['capacity_days']}
+    for grp in prd_new['groups']:
+        prd_new['groups'][grp]['bucket'] = {}
+    setRates(prd_new, prd_new['su_avail'], now, q_end)
+    prd_new['su_alloc'] = prd_new['bucket']['su_remaining'] \
+        * min((p_end - now).total_seconds() / 86400.0 / prd_new['bucket']['days_left'], 1.0)
+
+    for grp in prd_new['groups']:
+        grp_new = prd_new['groups'][grp]
+        b = grp_new['bucket']
+        carried = (grp in prd_old['groups']) and ('bucket' in prd_old['groups'][grp])
+        if carried:
+            b_old = prd_old['groups'][grp]['bucket']
+            updateTokens(b_old, prd_old['groups'][grp]['su_usage'], t_now)
+            grp_new['penalty_old'] = max(-b_old['tokens'], 0.0) * cfg['penalty_factor']
+        if carried and (not new_quarter):
+            b['tokens'] = max(b_old['tokens'], 0.0) - grp_new['penalty_old']
+        else:
+            b['tokens'] = b['capacity'] - grp_new['penalty_old']
+        b['su_usage'] = 0.0
+        b['time'] = t_now
+        grp_new['alloc'] = max(b['tokens'], 0.0)
+        grp_new['penalty_new'] = 0.0
+
+    return
+
+###################################################################################################
+
+# Update the bucket of a group from its usage in the current period and set its allocation.
+
+def updateGroup(prd_cur, grp):
+
+    grp_data = prd_cur['groups'][grp]
+    b = grp_data['bucket']
+    updateTokens(b, grp_data['su_usage'], utils.getNow().timestamp())
+    grp_data['alloc'] = max(grp_data['su_usage'] + b['tokens'], 0.0)
+
+    return
+
+###################################################################################################
+
+# Add a bucket for a group that joined during a period (see reallocate.py). The group must have its
+# weight fraction in the period data. As at the beginning of a quarter, the bucket starts full.
+
+def addGroup(prd_cur, grp, p):
+
+    grp_data = prd_cur['groups'][grp]
+    b = {'tokens': 0.0, 'su_usage': grp_data['su_usage'], 'time': utils.getNow().timestamp()}
+    grp_data['bucket'] = b
+    updateRates(prd_cur, p)
+    b['tokens'] = b['capacity']
+    grp_data['alloc'] = max(grp_data['su_usage'] + b['tokens'], 0.0)
+
+    return
+
+###################################################################################################
+
+# Update the refill rates once all groups have been checked, from the SUs that remain of what was
+# available at the start of the period. The new rates apply until the next check.
+
+def updateRates(prd_cur, p):
+
+    su_used = 0.0
+    for grp in prd_cur['groups']:
+        su_used += prd_cur['groups'][grp]['su_usage']
+    setRates(prd_cur, prd_cur['su_avail'] - su_used, utils.getNow(), getQuarterEnd(prd_cur['start_date'], p))
+
+    return
+
+###################################################################################################
@@ -0,0 +1,304 @@
+###################################################################################################
+#
+# This file is part of the HPC allocator code for the UMD astronomy department
+#
+# (c) Benedikt Diemer
+#
+###################################################################################################
+
+import os
+import time
+import json
+import datetime
+import gzip
+import subprocess
+import threading
+import collections
+
+import config
+import utils
+import context
+
+###################################################################################################
+
+# All command-line queries of the cluster go through this module. Each command belongs to a
+# backend (the name of the executable), which has its own timeout. Failed calls are retried with
+# exponential backoff. If a backend fails repeatedly, its circuit breaker opens and further calls
+# fail immediately until a cooldown time has passed, so that a hung filesystem or database does
+# not stall the entire run. The breaker state is kept in a yaml file so that it persists between
+# runs.
+#
+# Commands and their outputs can be recorded to a gzipped file with one JSON record per line. Each
+# run starts with a 'run' record that contains the date of the run, followed by one 'cmd' record 
+# per command. In replay mode, the recorded outputs are returned instead of running the commands;
+# the outputs for each command line are returned in the order in which they were recorded.
+#
+# During a shared pass (e.g., when several departments are processed in one run), the output of
+# each successful command is cached, so that identical queries are run only once.
+#
+# The breaker state, recording, replay queues, and cache belong to the active context (see 
+# context.py). If the context has a runner, it is called instead of running the commands.
+
+# Commands may be run from several threads at once (see streamGroupData() in run.py), so changes to
+# the circuit breaker state and the recording are serialized.
+state_lock = threading.RLock()
+
+###################################################################################################
+
+class CommandError(Exception):
+
+    pass
+
+###################################################################################################
+
+def loadCircuitState():
+
+    cfg = config.getConfig()
+    ctx = context.get()
+
+    with state_lock:
+        if ctx.circuit_state is None:
+            ctx.circuit_state = utils.readYaml(cfg['yaml_file_circuit'])
+            if ctx.circuit_state is None:
+                ctx.circuit_state = {}
+
+    return ctx.circuit_state
+
+###################################################################################################
+
+def saveCircuitState():
+
+    cfg = config.getConfig()
+
+    state = loadCircuitState()
+    utils.writeYaml(cfg['yaml_file_circuit'], state)
+
+    return
+
+###################################################################################################
+
+def recordResult(backend, success):
+
+    cfg = config.getConfig()
+    state = loadCircuitState()
+
+    with state_lock:
+        if not backend in state:
+            state[backend] = {'n_fail': 0, 'open_until': 0.0}
+        if success:
+            state[backend]['n_fail'] = 0
+            state[backend]['open_until'] = 0.0
+        else:
+            state[backend]['n_fail'] += 1
+            if state[backend]['n_fail'] >= cfg['cluster']['breaker_threshold']:
+                state[backend]['open_until'] = time.time() + cfg['cluster']['breaker_cooldown']
+                print('    WARNING: %d consecutive failures of %s, pausing calls for %.0f seconds.' \
+                      % (state[backend]['n_fail'], backend, cfg['cluster']['breaker_cooldown']))
+
+    return
+
+###################################################################################################
+
+def isCircuitOpen(backend):
+
+    state = loadCircuitState()
+
+    return (backend in state) and (state[backend]['open_until'] > time.time())
+
+###################################################################################################
+
+def startSharedPass():
+
+    context.get().shared_cache = {}
+
+    return
+
+###################################################################################################
+
+def endSharedPass():
+
+    ctx = context.get()
+    n_cached = len(ctx.shared_cache)
+    ctx.shared_cache = None
+
+    return n_cached
+
+###################################################################################################
+
+# Start recording to a file. The run record contains the date and time of the run according to the
+# clock of the active context, shifted by days_future.
+
+def startRecording(fname, days_future = 0):
+
+    time_run = utils.getNow() + datetime.timedelta(days = days_future)
+    context.get().recording_file = gzip.open(fname, 'at')
+    writeRecord({'type': 'run', 'date': time_run.date().isoformat(), 'time': time_run.timestamp()})
+
+    return
+
+###################################################################################################
+
+def stopRecording():
+
+    ctx = context.get()
+    if ctx.recording_file is not None:
+        ctx.recording_file.close()
+        ctx.recording_file = None
+
+    return
+
+###################################################################################################
+
+def writeRecord(rec):
+
+    recording_file = context.get().recording_file
+    with state_lock:
+        recording_file.write(json.dumps(rec) + '\n')
+        recording_file.flush()
+
+    return
+
+###################################################################################################
+
+# Load a recording and split it into runs. Returns a list of dictionaries with the date and time 
+# (as a datetime) of each run and the list of its command records. If the recorded time does not
+# fall on the date of the run (because the run was shifted into the future), the time of day is 
+# kept.
+
+def loadRecording(fname):
+
+    if not os.path.exists(fname):
+        raise Exception('Could not find recording %s.' % (fname))
+    
+    runs = []
+    f = gzip.open(fname, 'rt')
+    for l in f:
+        rec = json.loads(l)
+        if rec['type'] == 'run':
+            date_run = datetime.date.fromisoformat(rec['date'])
+            time_run = datetime.datetime.fromtimestamp(rec['time'])
+            if time_run.date() != date_run:
+                time_run = datetime.datetime.combine(date_run, time_run.time())
+            runs.append({'date': rec['date'], 'time': time_run, 'cmds': []})
+        elif rec['type'] == 'cmd':
+            if len(runs) == 0:
+                raise Exception('Found command record before first run record in %s.' % (fname))
+            runs[-1]['cmds'].append(rec)
+        else:
+            raise Exception('Unknown record type, "%s".' % (rec['type']))
+    f.close()
+
+    return runs
+
+###################################################################################################
+
+def startReplay(cmds):
+
+    replay_queues = {}
+    for rec in cmds:
+        key = ' '.join(rec['cmd'])
+        if not key in replay_queues:
+            replay_queues[key] = collections.deque()
+        replay_queues[key].append(rec)
+    context.get().replay_queues = replay_queues
+
+    return
+
+###################################################################################################
+
+# End replay mode and return the number of recorded commands that were not used.
+
+def stopReplay():
+
+    ctx = context.get()
+    n_left = 0
+    for key in ctx.replay_queues:
+        n_left += len(ctx.replay_queues[key])
+    ctx.replay_queues = None
+
+    return n_left
+
+###################################################################################################
+
+def replayCommand(cmd):
+
+    replay_queues = context.get().replay_queues
+    key = ' '.join(cmd)
+    if (not key in replay_queues) or (len(replay_queues[key]) == 0):
+        raise CommandError('No recorded output left for command "%s".' % (key))
+    rec = replay_queues[key].popleft()
+    if not rec['ok']:
+        raise CommandError(rec['error'])
+
+    return rec['stdout']
+
+###################################################################################################
+
+# Run a command and return its standard output. If input_text is given, it is passed to the
+# command's standard input. A CommandError is raised if the command failed after all retries, or if
+# the backend's circuit breaker is open.
+
+def runCommand(cmd, input_text = None):
+
+    cfg = config.getConfig()
+    ctx = context.get()
+    shared_cache = ctx.shared_cache
+    recording_file = ctx.recording_file
+
+    key = ' '.join(cmd)
+    if (shared_cache is not None) and (input_text is None) and (key in shared_cache):
+        return shared_cache[key]
+    
+    if ctx.replay_queues is not None:
+        stdout = replayCommand(cmd)
+        if (shared_cache is not None) and (input_text is None):
+            shared_cache[key] = stdout
+        return stdout
+    
+    backend = cmd[0]
+    timeout = cfg['cluster']['timeout'].get(backend, cfg['cluster']['timeout']['default'])
+    n_tries = cfg['cluster']['retries'] + 1
+    wait = cfg['cluster']['backoff']
+
+    for i in range(n_tries):
+
+        if isCircuitOpen(backend):
+            msg = 'Circuit breaker for %s is open, not running "%s".' % (backend, ' '.join(cmd))
+            if recording_file is not None:
+                writeRecord({'type': 'cmd', 'time': time.time(), 'cmd': cmd, 'ok': False, 'error': msg})
+            raise CommandError(msg)
+
+        try:
+            if ctx.runner is not None:
+                stdout = ctx.runner(cmd, input_text, timeout)
+            else:
+                stdout = subprocess.run(cmd, capture_output = True, text = True, check = True, timeout = timeout,
+                                        input = input_text).stdout
+            recordResult(backend, True)
+            if recording_file is not None:
+                writeRecord({'type': 'cmd', 'time': time.time(), 'cmd': cmd, 'ok': True, 'stdout': stdout})
+            if (shared_cache is not None) and (input_text is None):
+                shared_cache[key] = stdout
+            return stdout
+        except subprocess.TimeoutExpired:
+            msg = 'Command "%s" timed out after %.0f seconds.' % (' '.join(cmd), timeout)
+        except subprocess.CalledProcessError as e:
+            msg = 'Command "%s" failed with code %d.' % (' '.join(cmd), e.returncode)
+        except OSError as e:
+            msg = 'Command "%s" could not be run (%s).' % (' '.join(cmd), str(e))
+        except CommandError as e:
+            msg = 'Command "%s" failed (%s).' % (' '.join(cmd), str(e))
+
+        print('    WARNING: %s' % (msg))
+        if i < n_tries - 1:
+            time.sleep(wait)
+            wait *= 2.0
+
+    # Only calls that failed after all retries count towards opening the circuit breaker
+    recordResult(backend, False)
+    if recording_file is not None:
+        writeRecord({'type': 'cmd', 'time': time.time(), 'cmd': cmd, 'ok': False, 'error': msg})
+    
+    raise CommandError(msg)
+
+###################################################################################################
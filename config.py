@@ -7,40 +7,210 @@
 ###################################################################################################
 
 import os
+import copy
 import yaml
 
+import context
+
+###################################################################################################
+
+# The configs are kept in the active context (see context.py). The active config is the base 
+# config or, if several departments are configured, the config of the department that is currently
+# being processed. The configs of all departments are loaded when they are first needed.
+
 ###################################################################################################
 
-config_path = 'config/config.yaml'
-config_path_email = 'config/config_email.yaml'
+def loadYaml(path):
 
-cfg = None
+    if not os.path.exists(path):
+        raise Exception('Could not find config file %s.' % (path))
+    pFile = open(path, 'r')
+    dic = yaml.safe_load(pFile)
+    pFile.close()
+
+    return dic
 
 ###################################################################################################
 
+def finalizeConfig(dic):
+
+    dic['n_periods'] = len(dic['periods'])
+    dic['admin_user'] = dic['email']['sender_email'].split('@')[0]
+
+    return
+
+###################################################################################################
+
+# Read one top-level setting from a config file without loading the rest of the file. This is meant
+# for short commands that are run very often and need only one value, such as -mode myusage. The
+# setting must fit on one line.
+
+def readSetting(path, key):
+
+    if not os.path.exists(path):
+        raise Exception('Could not find config file %s.' % (path))
+    prefix = key + ':'
+    value = None
+    found = False
+    pFile = open(path, 'r')
+    for l in pFile:
+        if l.startswith(prefix):
+            value = yaml.safe_load(l)[key]
+            found = True
+            break
+    pFile.close()
+    if not found:
+        raise Exception('Could not find setting %s in config file %s.' % (key, path))
+
+    return value
+
+###################################################################################################
+
+# If the context was given a config, it is used instead of the files; it must include the email
+# settings.
+
 def getConfig():
-    
-    global cfg
-    
-    if cfg is None:
-       
-        if not os.path.exists(config_path):
-            raise Exception('Could not find config file %s.' % (config_path))
-        pFile = open(config_path, 'r')
-        cfg = yaml.safe_load(pFile)
-        pFile.close()        
-    
-        if not os.path.exists(config_path_email):
-            raise Exception('Could not find config file %s.' % (config_path_email))
-        pFile = open(config_path_email, 'r')
-        cfg_email = yaml.safe_load(pFile)
-        pFile.close() 
-        
-        cfg.update(cfg_email)
-        
-        cfg['n_periods'] = len(cfg['periods'])
-        cfg['admin_user'] = cfg['email']['sender_email'].split('@')[0]    
-    
-    return cfg
+
+    ctx = context.get()
+
+    if ctx.cfg is None:
+
+        if ctx.cfg_given is not None:
+            cfg_base = copy.deepcopy(ctx.cfg_given)
+        else:
+            cfg_base = loadYaml(ctx.config_path)
+            cfg_email = loadYaml(ctx.config_path_email)
+            cfg_base.update(cfg_email)
+        finalizeConfig(cfg_base)
+        ctx.cfg_base = cfg_base
+        ctx.cfg = cfg_base
+
+    return ctx.cfg
+
+###################################################################################################
+
+# The state and output paths of a department. Those that the department's config file does not set
+# are moved into a directory named after the department, which is placed in the directory of the 
+# base config's path (e.g., yaml/snapshot.json becomes yaml/astro/snapshot.json, and emails/ 
+# becomes emails/astro/). The paths of different departments must not be the same.
+
+department_paths = [['yaml_dir'], ['yaml_file_cfg'], ['yaml_file_grps_cur'], ['yaml_file_circuit'],
+                    ['snapshot_file'], ['snapshot_dir'], ['lock', 'file'], ['email_archive', 'dir'],
+                    ['scratch', 'scan_dir'], ['membership', 'yaml_file'], ['polling', 'yaml_file'],
+                    ['accounting', 'yaml_file'], ['demand', 'yaml_file'], ['enforce', 'dir'],
+                    ['enforce', 'yaml_file']]
+
+###################################################################################################
+
+def getPath(dic, keys):
+
+    for k in keys:
+        if (not isinstance(dic, dict)) or (not k in dic):
+            return None
+        dic = dic[k]
+
+    return dic
+
+###################################################################################################
+
+def setDepartmentPaths(dic, cfg_dept, dept):
+
+    for keys in department_paths:
+        path = getPath(dic, keys)
+        if (path is None) or (getPath(cfg_dept, keys) is not None):
+            continue
+        if path.endswith('/'):
+            path_dept = os.path.join(path, dept) + '/'
+        else:
+            path_dept = os.path.join(os.path.dirname(path), dept, os.path.basename(path))
+        getPath(dic, keys[:-1])[keys[-1]] = path_dept
+
+        # The modules create the directories they write to, but the state files and the files in
+        # yaml_dir are written directly
+        if context.get().store is None:
+            if keys == ['yaml_dir']:
+                os.makedirs(path_dept, exist_ok = True)
+            elif not path.endswith('/'):
+                os.makedirs(os.path.dirname(path_dept), exist_ok = True)
+
+    return
+
+###################################################################################################
+
+# Several departments can be run from one base config. The departments entry maps department names
+# to their config files, which are applied on top of a copy of the base config. Each department
+# thus only needs to set what differs, e.g., its groups, people types, periods, email settings,
+# and Slurm account; its state and output paths are derived from those of the base config (see 
+# above). An email config file can be given in a department's config_email entry. The configs of
+# all departments are loaded together, so that paths shared between departments are found before
+# any of them is run.
+
+def getDepartments():
+
+    getConfig()
+    ctx = context.get()
+    cfg_base = ctx.cfg_base
+    if (not 'departments' in cfg_base) or (cfg_base['departments'] is None):
+        return []
+
+    depts = list(cfg_base['departments'].keys())
+    paths = {}
+    for dept in depts:
+        cfg_dept = loadDepartment(dept)
+        for keys in department_paths:
+            path = getPath(cfg_dept, keys)
+            if path is None:
+                continue
+            path = os.path.normpath(path)
+            if path in paths:
+                raise Exception('Departments %s and %s use the same path %s (%s).' \
+                                % (paths[path][0], dept, path, '/'.join(keys)))
+            paths[path] = [dept, keys]
+
+    return depts
+
+###################################################################################################
+
+# Load the config of a department, which is kept in the context once it has been loaded.
+
+def loadDepartment(dept):
+
+    getConfig()
+    ctx = context.get()
+    cfg_base = ctx.cfg_base
+    cfg_depts = ctx.cfg_depts
+
+    if not dept in cfg_depts:
+        if (not 'departments' in cfg_base) or (cfg_base['departments'] is None) \
+                or (not dept in cfg_base['departments']):
+            raise Exception('Unknown department, "%s".' % (dept))
+        dic = copy.deepcopy(cfg_base)
+        del dic['departments']
+        cfg_dept = loadYaml(cfg_base['departments'][dept])
+        dic.update(cfg_dept)
+        if ('config_email' in dic) and (dic['config_email'] is not None):
+            dic.update(loadYaml(dic['config_email']))
+        dic['department'] = dept
+        setDepartmentPaths(dic, cfg_dept, dept)
+        finalizeConfig(dic)
+        cfg_depts[dept] = dic
+
+    return cfg_depts[dept]
+
+###################################################################################################
+
+# Make a department's config the active config. If dept is None, the base config is restored.
+
+def setDepartment(dept):
+
+    getConfig()
+    ctx = context.get()
+    if dept is None:
+        ctx.cfg = ctx.cfg_base
+        return
+
+    ctx.cfg = loadDepartment(dept)
+
+    return
 
 ###################################################################################################
@@ -0,0 +1,157 @@
+###################################################################################################
+#
+# This file is part of the HPC allocator code for the UMD astronomy department
+#
+# (c) Benedikt Diemer
+#
+###################################################################################################
+
+import threading
+import contextlib
+
+###################################################################################################
+
+# The state of one allocator: its config, settings, clock, state store, mailer, and the state of
+# the cluster queries, messages, and job accounting during a run. The modules look up the context
+# that is active in the current thread, so that several allocators (see allocator.py) can run in
+# one process, each in its own threads. Threads that are started during a run must activate the
+# context of the thread that started them.
+#
+# If no context has been activated, the default context is used, which is created when it is first
+# needed. This is the case when the code is run from the command line.
+
+# Defaults for new contexts. The quarter counter starts in 2025/4; this cannot be changed once
+# quarter files exist, since they are named after the counter.
+config_path = 'config/config.yaml'
+config_path_email = 'config/config_email.yaml'
+first_quarter_year = 2025
+first_quarter_idx = 4
+
+local = threading.local()
+default_context = None
+default_lock = threading.Lock()
+
+###################################################################################################
+
+class Context():
+
+    # The config can be given as a dictionary, which replaces the config files. The clock is either
+    # None (the current time), a datetime, or a function that returns a datetime. If the store is a
+    # dictionary, all state files are written to it instead of the disk (and read from it if they
+    # are found there). If a runner is given, it is called as runner(cmd, input_text, timeout)
+    # instead of running cluster commands, and must return the standard output or raise a
+    # cluster.CommandError. If a mailer is given, it is called with each email message instead of
+    # sending it via SMTP. If the outbox is a list, messages are appended to it instead of being
+    # saved or sent.
+
+    def __init__(self, config_path = config_path, config_path_email = config_path_email, cfg = None,
+                 test_mode = False, dry_run = True, clock = None, store = None, runner = None,
+                 mailer = None, outbox = None, first_quarter_year = first_quarter_year,
+                 first_quarter_idx = first_quarter_idx):
+
+        # Config (see config.py)
+        self.config_path = config_path
+        self.config_path_email = config_path_email
+        self.cfg_given = cfg
+        self.cfg = None
+        self.cfg_base = None
+        self.cfg_depts = {}
+
+        # Run settings
+        self.test_mode = test_mode
+        self.dry_run = dry_run
+        self.simulation = False
+        self.first_quarter_year = first_quarter_year
+        self.first_quarter_idx = first_quarter_idx
+
+        # Clock, state store, data source, and mailer
+        self.clock = clock
+        self.store = store
+        self.runner = runner
+        self.mailer = mailer
+
+        # Messages (see messaging.py and archive.py)
+        self.outbox = outbox
+        self.digest_queue = None
+        self.send_queue = None
+        self.send_thread = None
+        self.send_errors = []
+        self.archive_pruned = False
+
+        # Cluster queries (see cluster.py)
+        self.circuit_state = None
+        self.recording_file = None
+        self.replay_queues = None
+        self.shared_cache = None
+
+        # Job accounting and membership states (see accounting.py and membership.py)
+        self.accounting_states = {}
+        self.membership_state = None
+
+        # Lock of the check if the state is kept in memory (see lock.py)
+        self.check_lock = threading.Lock()
+        self.check_holder = None
+        self.check_pending = False
+
+        # Status server (see server.py)
+        self.server_responses = {}
+        self.server_mtime = None
+        self.server_last_check = 0.0
+        self.server_lock = threading.Lock()
+
+        return
+
+###################################################################################################
+
+# Get the context that is active in the current thread.
+
+def get():
+
+    global default_context
+
+    ctx = getattr(local, 'ctx', None)
+    if ctx is not None:
+        return ctx
+
+    with default_lock:
+        if default_context is None:
+            default_context = Context()
+
+    return default_context
+
+###################################################################################################
+
+# Activate a context in the current thread for the duration of a with block. Activations can be
+# nested; the previous context is restored at the end of the block.
+
+@contextlib.contextmanager
+def activate(ctx):
+
+    ctx_prev = getattr(local, 'ctx', None)
+    local.ctx = ctx
+    try:
+        yield ctx
+    finally:
+        local.ctx = ctx_prev
+
+    return
+
+###################################################################################################
+
+# Start a thread that runs in the context of the current thread.
+
+def startThread(target, args = (), daemon = True):
+
+    ctx = get()
+
+    def runInContext():
+        with activate(ctx):
+            target(*args)
+        return
+
+    t = threading.Thread(target = runInContext, daemon = daemon)
+    t.start()
+
+    return t
+
+###################################################################################################
@@ -0,0 +1,243 @@
+###################################################################################################
+#
+# This file is part of the HPC allocator code for the UMD astronomy department
+#
+# (c) Benedikt Diemer
+#
+###################################################################################################
+
+import datetime
+
+import config
+import utils
+import cluster
+import accounting
+
+###################################################################################################
+
+# Demand signal for the allocations. At each run, a snapshot of all pending and running jobs is
+# taken with one squeue call. The demand of a job is its cost in SU (computed like in accounting.py)
+# over its remaining time: the time limit for pending jobs and the time left for running jobs. The
+# lines are aggregated per group as they are read, and the snapshot is added to a running mean per
+# group over the current period, so that the state does not grow with the number of runs or jobs.
+#
+# At the start of a period, the mean demand of the previous period is blended with the static
+# weights: the weight fraction of a group is (1 - blend) times its static fraction plus blend times
+# its fraction of the total demand, but at most max_factor times its static fraction. What is cut
+# by the cap is given to the other groups in proportion to their blended fractions. The signal can
+# be either the pending work only or pending and running work.
+
+squeue_format = '%a|%T|%P|%C|%b|%l|%L'
+
+###################################################################################################
+
+def loadState():
+
+    cfg = config.getConfig()
+
+    st = utils.readYaml(cfg['demand']['yaml_file'])
+    if st is None:
+        st = {}
+
+    return st
+
+###################################################################################################
+
+# Convert a Slurm time string ([days-]hours:minutes:seconds, or minutes:seconds) to seconds.
+# Returns None for unlimited or invalid times.
+
+def getSeconds(time_str):
+
+    if (time_str is None) or (time_str in ['', 'UNLIMITED', 'INVALID', 'NOT_SET', 'N/A']):
+        return None
+
+    days = 0
+    if '-' in time_str:
+        d, time_str = time_str.split('-', 1)
+        days = int(d)
+    w = [int(x) for x in time_str.split(':')]
+    while len(w) < 3:
+        w.insert(0, 0)
+    sec = days * 86400 + w[0] * 3600 + w[1] * 60 + w[2]
+
+    return sec
+
+###################################################################################################
+
+# Convert the gres string of squeue (e.g., "gres/gpu:2" or "gpu:a100:2") to the TRES format of
+# sacct (e.g., "gres/gpu=2").
+
+def getGresTres(gres_str):
+
+    tres = []
+    for item in gres_str.split(','):
+        w = item.replace('gres/', '').replace('gres:', '').split(':')
+        if (len(w) < 2) or (w[0] != 'gpu'):
+            continue
+        try:
+            tres.append('gres/gpu=%d' % (int(w[-1].split('(')[0])))
+        except ValueError:
+            continue
+
+    return tres
+
+###################################################################################################
+
+# Take one snapshot of the pending and running work of all groups of the current department, in
+# SU. Jobs from other accounts are ignored.
+
+def collectSnapshot():
+
+    cfg = config.getConfig()
+
+    ext = '-%s' % (cfg['slurm_account'])
+    snap = {}
+    for grp in cfg['groups']:
+        snap[grp] = {'pending': 0.0, 'running': 0.0}
+
+    rettxt = cluster.runCommand([cfg['demand']['command'], '-h', '-a', '-t', 'PENDING,RUNNING',
+                                 '-o', squeue_format])
+    for line in rettxt.splitlines():
+        w = line.strip().split('|')
+        if (len(w) < 7) or (not w[0].endswith(ext)):
+            continue
+        grp = w[0][:-len(ext)]
+        if not grp in snap:
+            continue
+        if w[1] == 'PENDING':
+            key = 'pending'
+            sec = getSeconds(w[5])
+        elif w[1] == 'RUNNING':
+            key = 'running'
+            sec = getSeconds(w[6])
+        else:
+            continue
+        if sec is None:
+            sec = cfg['demand']['default_hours'] * 3600.0
+        tres = ['cpu=%s' % (w[3])] + getGresTres(w[4])
+        snap[grp][key] += accounting.getJobCost(w[2], sec, ','.join(tres))
+
+    return snap
+
+###################################################################################################
+
+# Add a snapshot to the running mean of the period that started on p_start. If a new period has
+# started, the state is reset; the mean of the previous period has been used by then.
+
+def pollDemand(p_start, verbose = True):
+
+    cfg = config.getConfig()
+
+    st = loadState()
+    p_start_str = p_start.strftime('%Y-%m-%d')
+    if st.get('period', None) != p_start_str:
+        st = {'period': p_start_str, 'n_samples': 0, 'groups': {}}
+
+    snap = collectSnapshot()
+    n = st['n_samples'] + 1
+    for grp in snap:
+        if not grp in st['groups']:
+            st['groups'][grp] = {'pending': 0.0, 'running': 0.0}
+        for k in ['pending', 'running']:
+            st['groups'][grp][k] += (snap[grp][k] - st['groups'][grp][k]) / n
+    st['n_samples'] = n
+    st['time'] = utils.getNow().strftime('%Y-%m-%dT%H:%M:%S')
+
+    if verbose:
+        pending = sum([snap[grp]['pending'] for grp in snap])
+        running = sum([snap[grp]['running'] for grp in snap])
+        print('    Demand snapshot: %.1f kSU pending, %.1f kSU running (%d samples this period).' \
+              % (pending / 1000.0, running / 1000.0, n))
+
+    return st
+
+###################################################################################################
+
+def saveState(st):
+
+    cfg = config.getConfig()
+
+    utils.writeYaml(cfg['demand']['yaml_file'], st)
+
+    return
+
+###################################################################################################
+
+# Blend the mean demand of the previous period with the static weights of the groups in a new
+# period. The static weight fraction, the demand, and the blended fraction are recorded for each
+# group, and the policy in the period. The blended fractions are set as allocation weights (see
+# hierarchy.py), scaled to the total weight.
+
+def applyDemand(prd_new, p_start):
+
+    cfg = config.getConfig()
+    cfg_d = cfg['demand']
+
+    grps = list(prd_new['groups'].keys())
+    st = loadState()
+    n_samples = st.get('n_samples', 0)
+
+    # The state must be from a previous period
+    if (n_samples > 0) and (datetime.date.fromisoformat(st['period']) >= p_start):
+        n_samples = 0
+
+    dem = {}
+    for grp in grps:
+        d = st.get('groups', {}).get(grp, {'pending': 0.0, 'running': 0.0})
+        if cfg_d['signal'] == 'pending':
+            dem[grp] = d['pending']
+        elif cfg_d['signal'] == 'pending_running':
+            dem[grp] = d['pending'] + d['running']
+        else:
+            raise Exception('Unknown demand signal "%s". Allowed are "pending" and "pending_running".' % (cfg_d['signal']))
+    dem_tot = sum(dem.values())
+
+    w_tot = prd_new['w_tot']
+    f_static = {}
+    for grp in grps:
+        if w_tot > 0.0:
+            f_static[grp] = prd_new['groups'][grp]['weight'] / w_tot
+        else:
+            f_static[grp] = 0.0
+
+    # Without any demand, the static weights are used
+    if (n_samples == 0) or (dem_tot <= 0.0):
+        blend = 0.0
+    else:
+        blend = cfg_d['blend']
+    f_blend = {}
+    for grp in grps:
+        f_blend[grp] = (1.0 - blend) * f_static[grp]
+        if blend > 0.0:
+            f_blend[grp] += blend * dem[grp] / dem_tot
+
+    # Cap the fractions; what is cut is redistributed among the groups below the cap. This is
+    # repeated until no group exceeds its cap.
+    capped = []
+    while True:
+        excess = 0.0
+        for grp in grps:
+            f_max = cfg_d['max_factor'] * f_static[grp]
+            if (not grp in capped) and (f_blend[grp] > f_max):
+                excess += f_blend[grp] - f_max
+                f_blend[grp] = f_max
+                capped.append(grp)
+        if excess <= 0.0:
+            break
+        f_open = sum([f_blend[grp] for grp in grps if not grp in capped])
+        if f_open <= 0.0:
+            break
+        for grp in grps:
+            if not grp in capped:
+                f_blend[grp] += excess * f_blend[grp] / f_open
+
+    prd_new['demand'] = {'signal': cfg_d['signal'], 'blend': blend, 'max_factor': cfg_d['max_factor'],
+                         'n_samples': n_samples, 'total': dem_tot}
+    for grp in grps:
+        prd_new['groups'][grp]['demand'] = dem[grp]
+        prd_new['groups'][grp]['weight_frac_static'] = f_static[grp]
+        prd_new['groups'][grp]['weight_alloc'] = f_blend[grp] * w_tot
+
+    return
+
+###################################################################################################
@@ -0,0 +1,211 @@
+###################################################################################################
+#
+# This file is part of the HPC allocator code for the UMD astronomy department
+#
+# (c) Benedikt Diemer
+#
+###################################################################################################
+
+import os
+
+import config
+import utils
+import context
+import cluster
+
+###################################################################################################
+
+# The enforcement engine turns the allocations of the current period into Slurm association limits.
+# Slurm compares GrpTRESMins to the usage of the account since its last reset, which corresponds to
+# the cumulative usage this quarter. The limit for each group is thus its cumulative usage at the
+# start of the period plus its allocation for the period.
+#
+# All changes are written to one transaction file of sacctmgr commands, which is then fed to
+# sacctmgr in one call. Only limits that changed since the last push are included, and each
+# command sets an absolute value, so that applying a file twice has no further effect. For each
+# transaction, a rollback file with the previous values is written as well.
+
+# Value that removes a limit in sacctmgr
+no_limit = -1
+
+###################################################################################################
+
+def loadState():
+
+    cfg = config.getConfig()
+
+    state = utils.readYaml(cfg['enforce']['yaml_file'])
+    if state is None:
+        state = {'limits': {}, 'history': []}
+
+    return state
+
+###################################################################################################
+
+def saveState(state):
+
+    cfg = config.getConfig()
+
+    utils.writeYaml(cfg['enforce']['yaml_file'], state)
+
+    return
+
+###################################################################################################
+
+def getAccountName(grp):
+
+    cfg = config.getConfig()
+
+    return '%s-%s' % (grp, cfg['slurm_account'])
+
+###################################################################################################
+
+# Compute the limits for all groups in the current period, in units of TRES minutes.
+
+def computeLimits(prd_cur):
+
+    cfg = config.getConfig()
+
+    limits = {}
+    for grp in prd_cur['groups']:
+        grp_data = prd_cur['groups'][grp]
+        su_max = grp_data['su_usage_start'] + max(grp_data['alloc'], 0.0)
+        limits[getAccountName(grp)] = int(su_max * cfg['enforce']['tres_mins_per_su'])
+
+    return limits
+
+###################################################################################################
+
+def makeCommand(account, limit):
+
+    cfg = config.getConfig()
+
+    return 'modify account where name=%s set GrpTRESMins=%s=%d' % (account, cfg['enforce']['tres'], limit)
+
+###################################################################################################
+
+def writeTransaction(fname, commands, comment):
+
+    txt = '# %s\n' % (comment)
+    for c in commands:
+        txt += c + '\n'
+    utils.writeFileAtomic(fname, txt)
+
+    return
+
+###################################################################################################
+
+# Find new file names for a transaction and its rollback. The names contain the time with 
+# microseconds and, if a file of that name exists already, a sequence number.
+
+def getTransactionFiles():
+
+    cfg = config.getConfig()
+
+    if (context.get().store is None) and (not os.path.exists(cfg['enforce']['dir'])):
+        os.makedirs(cfg['enforce']['dir'])
+    base = '%s/limits_%s' % (cfg['enforce']['dir'], utils.getNow().strftime('%Y_%m_%d_%H_%M_%S_%f'))
+    fname = base
+    i = 1
+    while utils.fileExists('%s.txt' % (fname)):
+        fname = '%s_%d' % (base, i)
+        i += 1
+
+    return '%s.txt' % (fname), '%s_rollback.txt' % (fname)
+
+###################################################################################################
+
+def applyTransaction(fname):
+
+    cfg = config.getConfig()
+
+    store = context.get().store
+    if (store is not None) and (fname in store):
+        ll = store[fname].splitlines(keepends = True)
+    else:
+        f = open(fname, 'r')
+        ll = f.readlines()
+        f.close()
+    txt = ''
+    for l in ll:
+        if l.startswith('#'):
+            continue
+        txt += l
+
+    cluster.runCommand(cfg['enforce']['command'], input_text = txt)
+
+    return
+
+###################################################################################################
+
+# Push the limits for the current period. Only limits that differ from the last push are written.
+# If do_push is False, the changes are only printed. If the enforcement is configured as a dry run,
+# the transaction file is written but not applied. In both cases, the state is not changed.
+
+def pushLimits(prd_cur, do_push = False):
+
+    cfg = config.getConfig()
+    state = loadState()
+
+    limits_new = computeLimits(prd_cur)
+    limits_old = state['limits']
+    commands = []
+    commands_rollback = []
+    for acc in sorted(limits_new.keys()):
+        if (acc in limits_old) and (limits_old[acc] == limits_new[acc]):
+            continue
+        commands.append(makeCommand(acc, limits_new[acc]))
+        commands_rollback.append(makeCommand(acc, limits_old.get(acc, no_limit)))
+        print('    Account %-20s limit %12s -> %12d %s' \
+              % (acc, str(limits_old.get(acc, None)), limits_new[acc], cfg['enforce']['tres']))
+
+    if len(commands) == 0:
+        print('    All limits are up to date.')
+        return
+
+    if not do_push:
+        print('    Found %d limit changes (not pushed).' % (len(commands)))
+        return
+
+    fname, fname_rollback = getTransactionFiles()
+    writeTransaction(fname, commands, 'Limit update, %d accounts' % (len(commands)))
+    writeTransaction(fname_rollback, commands_rollback, 'Rollback of %s' % (fname))
+
+    if cfg['enforce']['dry_run']:
+        print('    Wrote %d limit changes to %s (not applied).' % (len(commands), fname))
+        return
+
+    applyTransaction(fname)
+    print('    Applied %d limit changes from %s.' % (len(commands), fname))
+
+    limits = dict(limits_old)
+    limits.update(limits_new)
+    state['history'].append({'file': fname, 'file_rollback': fname_rollback, 'limits_prev': limits_old})
+    state['limits'] = limits
+    saveState(state)
+
+    return
+
+###################################################################################################
+
+# Undo the last applied transaction.
+
+def rollbackLimits():
+
+    state = loadState()
+
+    if len(state['history']) == 0:
+        print('No limit changes to roll back.')
+        return
+
+    trans = state['history'][-1]
+    applyTransaction(trans['file_rollback'])
+    print('Rolled back limit changes from %s.' % (trans['file']))
+
+    state['history'] = state['history'][:-1]
+    state['limits'] = trans['limits_prev']
+    saveState(state)
+
+    return
+
+###################################################################################################
@@ -0,0 +1,336 @@
+###################################################################################################
+#
+# This file is part of the HPC allocator code for the UMD astronomy department
+#
+# (c) Benedikt Diemer
+#
+###################################################################################################
+
+import config
+
+###################################################################################################
+
+# Hierarchical allocations. A group can split its allocation among sub-projects, which can in turn
+# have sub-projects, each with their own members, weight, and warning levels. The department, its
+# groups, and their sub-projects form a tree. The tree is stored as a set of flat lists with one
+# entry per node, where each node comes after its parent. Aggregating the weights and usage from
+# the bottom up is then a single pass over the lists in reverse order, and allocating from the top
+# down is a single pass in forward order, regardless of the size of the tree.
+#
+# Each user belongs to the node that lists them; users that are not listed by any sub-project
+# belong to the group itself. The allocation of a node is split among its children according to
+# their weights, relative to the total weight of the children and the users that belong to the
+# node itself. The share of those users is not allocated to a sub-project, but counts towards the
+# group's allocation as a whole. The penalty of a node is subtracted from its share, so that a
+# sub-project that exceeded its allocation is penalized even if its group as a whole was not.
+#
+# In the period data, the sub-projects of a group are stored by their path (e.g., "sims/gpu").
+# Sorting the paths puts each parent before its children, since the path of a parent is a prefix
+# of the paths of its children.
+
+node_fields = ['grp', 'sub', 'parent', 'users', 'levels', 'w_own', 'weight', 'w_split', 'usage_own',
+               'su_usage', 'penalty_old', 'alloc', 'penalty_new']
+
+###################################################################################################
+
+# Flatten the sub-projects in the config of a group into a dictionary of records by path. The
+# weight is null if it is to be computed from the weights of the users and sub-projects. Warning
+# levels are inherited from the parent if not given.
+
+def makeSubprojects(grp_cfg, levels):
+
+    subs = {}
+    todo = [['', grp_cfg.get('subprojects', None), levels]]
+    while len(todo) > 0:
+        prefix, dic, levels_parent = todo.pop()
+        if dic is None:
+            continue
+        for name in dic:
+            if '/' in name:
+                raise Exception('Sub-project names cannot contain "/" (found "%s").' % (name))
+            path = prefix + name
+            sub_cfg = dic[name]
+            if sub_cfg is None:
+                sub_cfg = {}
+            levels_sub = sub_cfg.get('warning_levels', levels_parent)
+            subs[path] = {}
+            subs[path]['users'] = list(sub_cfg.get('users', []))
+            subs[path]['weight_cfg'] = sub_cfg.get('weight', None)
+            subs[path]['warning_levels'] = list(levels_sub)
+            todo.append([path + '/', sub_cfg.get('subprojects', None), levels_sub])
+
+    return subs
+
+###################################################################################################
+
+def getParentPath(path):
+
+    if '/' in path:
+        return path.rsplit('/', 1)[0]
+
+    return ''
+
+###################################################################################################
+
+def addNode(tr, grp, sub, parent, users, levels, w_own, weight, usage_own):
+
+    tr['grp'].append(grp)
+    tr['sub'].append(sub)
+    tr['parent'].append(parent)
+    tr['users'].append(users)
+    tr['levels'].append(levels)
+    tr['w_own'].append(w_own)
+    tr['weight'].append(weight)
+    tr['w_split'].append(w_own)
+    tr['usage_own'].append(usage_own)
+    tr['su_usage'].append(0.0)
+    tr['penalty_old'].append(0.0)
+    tr['alloc'].append(0.0)
+    tr['penalty_new'].append(0.0)
+
+    return len(tr['grp']) - 1
+
+###################################################################################################
+
+# Build the tree from the period data, for all groups or only the given groups. The root node
+# represents the department; the group nodes have the sub-project path ''. If a group has an 
+# allocation weight (see demand.py), it replaces the group's weight in the split among groups.
+
+def buildTree(prd_data, grps = None):
+
+    cfg = config.getConfig()
+
+    if grps is None:
+        grps = list(prd_data['groups'].keys())
+
+    tr = {}
+    for k in node_fields:
+        tr[k] = []
+    addNode(tr, None, None, -1, [], cfg['warning_levels'], 0.0, 0.0, 0.0)
+
+    for grp in grps:
+        grp_data = prd_data['groups'][grp]
+        grp_users = grp_data['users']
+        subs = grp_data.get('subprojects', {})
+        paths = sorted(subs.keys())
+
+        assigned = {}
+        for path in paths:
+            for usr in subs[path]['users']:
+                if not usr in grp_users:
+                    continue
+                if usr in assigned:
+                    print('    WARNING: User %s is listed in sub-projects %s and %s of group %s, using %s.' \
+                          % (usr, assigned[usr], path, grp, assigned[usr]))
+                    continue
+                assigned[usr] = path
+
+        users = {'': []}
+        for path in paths:
+            users[path] = []
+        for usr in grp_users:
+            users[assigned.get(usr, '')].append(usr)
+
+        idx = {}
+        for path in [''] + paths:
+            w_own = 0.0
+            usage_own = 0.0
+            for usr in users[path]:
+                w_own += grp_users[usr]['weight']
+                usage_own += grp_users[usr].get('su_usage', 0.0)
+            if path == '':
+                idx[path] = addNode(tr, grp, path, 0, users[path], getWarningLevels(grp_data),
+                                    w_own, grp_data.get('weight_alloc', grp_data['weight']), usage_own)
+            else:
+                idx[path] = addNode(tr, grp, path, idx[getParentPath(path)], users[path],
+                                    subs[path]['warning_levels'], w_own, subs[path]['weight_cfg'], usage_own)
+
+    return tr
+
+###################################################################################################
+
+# Bottom-up pass: compute the weights that were not set, the total weight among which each node's
+# allocation is split, and the cumulative usage of each node and its descendants.
+
+def aggregateTree(tr):
+
+    n = len(tr['grp'])
+    for i in range(n):
+        tr['w_split'][i] = tr['w_own'][i]
+        tr['su_usage'][i] = tr['usage_own'][i]
+
+    for i in range(n - 1, 0, -1):
+        if tr['weight'][i] is None:
+            tr['weight'][i] = tr['w_split'][i]
+        j = tr['parent'][i]
+        tr['w_split'][j] += tr['weight'][i]
+        tr['su_usage'][j] += tr['su_usage'][i]
+
+    return
+
+###################################################################################################
+
+# Top-down pass: split the allocation of the root among all nodes. The penalties must have been
+# set. If split is False (in the final period of a quarter), all nodes have access to the full
+# allocation and the penalties are carried over. If the allocations of the groups are given (see
+# bucket.py), only they are split among their sub-projects.
+
+def allocateTree(tr, alloc_root, split = True, alloc_groups = None):
+
+    tr['alloc'][0] = alloc_root
+    for i in range(1, len(tr['grp'])):
+        j = tr['parent'][i]
+        if (j == 0) and (alloc_groups is not None):
+            tr['alloc'][i] = alloc_groups[tr['grp'][i]]
+            tr['penalty_new'][i] = 0.0
+            continue
+        if not split:
+            tr['alloc'][i] = tr['alloc'][j]
+            tr['penalty_new'][i] = tr['penalty_old'][i]
+            continue
+        alloc_share = tr['alloc'][j] * getWeightFraction(tr, i)
+        if tr['penalty_old'][i] <= alloc_share:
+            tr['alloc'][i] = alloc_share - tr['penalty_old'][i]
+            tr['penalty_new'][i] = 0.0
+        else:
+            tr['alloc'][i] = 0.0
+            tr['penalty_new'][i] = tr['penalty_old'][i] - alloc_share
+
+    return
+
+###################################################################################################
+
+def getWeightFraction(tr, i):
+
+    j = tr['parent'][i]
+    if tr['w_split'][j] <= 0.0:
+        return 0.0
+
+    return tr['weight'][i] / tr['w_split'][j]
+
+###################################################################################################
+
+# The penalty carried into a new period by a sub-project, computed from its record in the previous
+# period in the same way as for groups.
+
+def getPenalty(sub_old):
+
+    cfg = config.getConfig()
+
+    penalty = sub_old['penalty_new']
+    if sub_old['su_usage'] > sub_old['alloc']:
+        penalty += sub_old['su_usage'] - sub_old['alloc']
+    penalty *= cfg['penalty_factor']
+
+    return penalty
+
+###################################################################################################
+
+# Set the penalties carried into a new period. The penalties of the groups have already been 
+# computed; those of the sub-projects are computed from their records in the previous period.
+
+def setPenalties(tr, prd_new, prd_old):
+
+    for i in range(1, len(tr['grp'])):
+        grp = tr['grp'][i]
+        sub = tr['sub'][i]
+        if sub == '':
+            tr['penalty_old'][i] = prd_new['groups'][grp]['penalty_old']
+        elif (grp in prd_old['groups']) and (sub in prd_old['groups'][grp].get('subprojects', {})):
+            tr['penalty_old'][i] = getPenalty(prd_old['groups'][grp]['subprojects'][sub])
+        else:
+            tr['penalty_old'][i] = 0.0
+
+    return
+
+###################################################################################################
+
+# Write the results back into the period data. By default, only the sub-projects are changed.
+
+def storeTree(tr, prd_data, keys, include_groups = False):
+
+    for i in range(1, len(tr['grp'])):
+        if tr['sub'][i] == '':
+            if not include_groups:
+                continue
+            rec = prd_data['groups'][tr['grp'][i]]
+        else:
+            rec = prd_data['groups'][tr['grp'][i]]['subprojects'][tr['sub'][i]]
+        for k in keys:
+            if k == 'weight_frac':
+                rec[k] = getWeightFraction(tr, i)
+            else:
+                rec[k] = tr[k][i]
+
+    return
+
+###################################################################################################
+
+# Split the current allocations of the groups among their sub-projects, with the penalties that 
+# the sub-projects carried into the period. This is needed whenever the allocations of the groups
+# change during a period (see bucket.py, rebalance.py, and reallocate.py).
+
+def splitTree(tr, prd_data):
+
+    alloc_groups = {}
+    for i in range(1, len(tr['grp'])):
+        grp_data = prd_data['groups'][tr['grp'][i]]
+        if tr['sub'][i] == '':
+            alloc_groups[tr['grp'][i]] = grp_data['alloc']
+        else:
+            tr['penalty_old'][i] = grp_data['subprojects'][tr['sub'][i]]['penalty_old']
+    allocateTree(tr, 0.0, alloc_groups = alloc_groups)
+    storeTree(tr, prd_data, ['alloc', 'penalty_new'])
+
+    return
+
+###################################################################################################
+
+# The warning levels of a group, which can be set in its config. Otherwise, the department-wide
+# levels are used.
+
+def getWarningLevels(grp_data):
+
+    cfg = config.getConfig()
+
+    return grp_data.get('warning_levels', cfg['warning_levels'])
+
+###################################################################################################
+
+# Find the highest warning level that the usage has crossed since the last check, or -1 if it has 
+# not crossed any level. The levels are given in percent of the allocation. If the allocation has
+# changed since the last check, the old fraction is computed with the old allocation.
+
+def getCrossedLevel(su_usage_old, su_usage_new, su_alloc, levels, su_alloc_old = None):
+
+    if (su_usage_new <= 0.0) or (su_alloc <= 0.0):
+        return -1
+    if su_alloc_old is None:
+        su_alloc_old = su_alloc
+    if su_alloc_old <= 0.0:
+        return -1
+    prct_old = su_usage_old / su_alloc_old * 100.0
+    prct_new = su_usage_new / su_alloc * 100.0
+    for ii in range(len(levels)):
+        i = len(levels) - ii - 1
+        if (prct_new > levels[i]) and (prct_old <= levels[i]):
+            return i
+
+    return -1
+
+###################################################################################################
+
+# The users of a sub-project, including the users of its own sub-projects.
+
+def getSubprojectUsers(grp_data, path):
+
+    users = []
+    for p in grp_data['subprojects']:
+        if (p == path) or p.startswith(path + '/'):
+            for usr in grp_data['subprojects'][p]['users']:
+                if (usr in grp_data['users']) and (not usr in users):
+                    users.append(usr)
+
+    return users
+
+###################################################################################################
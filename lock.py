@@ -0,0 +1,255 @@
+###################################################################################################
+#
+# This file is part of the HPC allocator code for the UMD astronomy department
+#
+# (c) Benedikt Diemer
+#
+###################################################################################################
+
+import os
+import time
+import socket
+import fcntl
+import yaml
+
+import config
+import context
+
+###################################################################################################
+
+# Only one instance of the check may run at a time. The lock is an advisory lock (flock) on a lock
+# file, which also contains information about the holder. If another instance holds the lock, the
+# policy set in the config determines what happens:
+#
+# - skip:     the new instance exits without running
+# - wait:     the new instance waits for the lock, up to a maximum time
+# - coalesce: the new instance leaves a marker file and exits; the holder runs the check once more
+#             after finishing, which covers all requests that arrived in the meantime.
+#
+# If the state of the allocator is kept in memory (see context.py), the lock, its holder, and the
+# marker belong to the allocator's context instead, so that independent allocators in the same 
+# process and directory do not block each other. The functions below take the open lock file, or
+# None for the lock of the context.
+
+###################################################################################################
+
+def getPendingFile():
+
+    cfg = config.getConfig()
+
+    return cfg['lock']['file'] + '.pending'
+
+###################################################################################################
+
+# The holder file can be read while it is being written, in which case it can be incomplete
+
+def readHolder(f):
+
+    f.seek(0)
+    try:
+        holder = yaml.safe_load(f.read())
+    except yaml.YAMLError:
+        holder = None
+
+    return holder
+
+###################################################################################################
+
+def holderString(holder):
+
+    if not isinstance(holder, dict):
+        return 'unknown holder'
+    pid = holder.get('pid', None)
+    host = holder.get('host', None)
+    t = holder.get('time', None)
+    if (pid is None) or (host is None) or (t is None):
+        return 'unknown holder'
+    s = 'pid %d on %s, running for %.0f seconds' % (pid, host, time.time() - t)
+
+    return s
+
+###################################################################################################
+
+def tryLock(f):
+
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return False
+
+    return True
+
+###################################################################################################
+
+def openLock():
+
+    cfg = config.getConfig()
+
+    if context.get().store is not None:
+        return None
+
+    return open(cfg['lock']['file'], 'a+')
+
+###################################################################################################
+
+def closeLock(f):
+
+    if f is not None:
+        f.close()
+
+    return
+
+###################################################################################################
+
+def acquireLock(f):
+
+    if f is None:
+        return context.get().check_lock.acquire(blocking = False)
+
+    return tryLock(f)
+
+###################################################################################################
+
+def releaseLock(f):
+
+    if f is None:
+        ctx = context.get()
+        ctx.check_holder = None
+        ctx.check_lock.release()
+        return
+
+    f.seek(0)
+    f.truncate()
+    f.flush()
+    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    return
+
+###################################################################################################
+
+def getHolder(f):
+
+    if f is None:
+        return context.get().check_holder
+
+    return readHolder(f)
+
+###################################################################################################
+
+def setHolder(f):
+
+    holder = {'pid': os.getpid(), 'host': socket.gethostname(), 'time': time.time()}
+    if f is None:
+        context.get().check_holder = holder
+        return
+
+    f.seek(0)
+    f.truncate()
+    f.write(yaml.dump(holder))
+    f.flush()
+
+    return
+
+###################################################################################################
+
+# The marker for a follow-up run
+
+def isPending(f):
+
+    if f is None:
+        return context.get().check_pending
+
+    return os.path.exists(getPendingFile())
+
+###################################################################################################
+
+def setPending(f, pending):
+
+    if f is None:
+        context.get().check_pending = pending
+    elif pending:
+        open(getPendingFile(), 'w').close()
+    elif os.path.exists(getPendingFile()):
+        os.remove(getPendingFile())
+
+    return
+
+###################################################################################################
+
+# Run a function while holding the lock. Returns True if the function was run, False otherwise.
+
+def runExclusive(func, **kwargs):
+
+    cfg = config.getConfig()
+    policy = cfg['lock']['policy']
+    if not policy in ['skip', 'wait', 'coalesce']:
+        raise Exception('Unknown lock policy, "%s". Allowed are [skip, wait, coalesce].' % (policy))
+
+    f = openLock()
+    if not acquireLock(f):
+        print('Another check is running (%s).' % (holderString(getHolder(f))))
+        if policy == 'skip':
+            print('Skipping this run.')
+            closeLock(f)
+            return False
+        elif policy == 'coalesce':
+            print('Requesting a follow-up run from the running instance.')
+            setPending(f, True)
+            closeLock(f)
+            return False
+        else:
+            print('Waiting for lock...')
+            t_start = time.time()
+            while not acquireLock(f):
+                if time.time() - t_start > cfg['lock']['wait_timeout']:
+                    closeLock(f)
+                    raise Exception('Could not acquire lock within %.0f seconds.' % (cfg['lock']['wait_timeout']))
+                time.sleep(1.0)
+
+    # A request for a follow-up run can arrive after the holder last checked for one but before it
+    # released the lock. The holder thus checks again after releasing the lock, and runs again if 
+    # it can take the lock back. Otherwise, another instance has taken it and runs the check.
+    try:
+        while True:
+            try:
+                setHolder(f)
+                while True:
+                    setPending(f, False)
+                    func(**kwargs)
+                    if (policy != 'coalesce') or (not isPending(f)):
+                        break
+                    print('Running follow-up check requested by an overlapping run...')
+            finally:
+                releaseLock(f)
+
+            if (policy != 'coalesce') or (not isPending(f)) or (not acquireLock(f)):
+                break
+            print('Running follow-up check requested by an overlapping run...')
+    finally:
+        closeLock(f)
+
+    return True
+
+###################################################################################################
+
+def printLockInfo():
+
+    cfg = config.getConfig()
+
+    if (context.get().store is None) and (not os.path.exists(cfg['lock']['file'])):
+        print('No check is running.')
+        return
+
+    f = openLock()
+    if acquireLock(f):
+        releaseLock(f)
+        print('No check is running.')
+    else:
+        print('Check is running (%s).' % (holderString(getHolder(f))))
+    if isPending(f):
+        print('A follow-up run has been requested.')
+    closeLock(f)
+
+    return
+
+###################################################################################################
@@ -0,0 +1,205 @@
+###################################################################################################
+#
+# This file is part of the HPC allocator code for the UMD astronomy department
+#
+# (c) Benedikt Diemer
+#
+###################################################################################################
+
+import config
+import utils
+import context
+import cluster
+
+###################################################################################################
+
+# Group membership from bulk queries. The members of all groups are read at once from the Unix
+# groups (zt-<grp>, e.g., from "getent group") and from the user associations of the groups' Slurm
+# accounts (<grp>-<slurm_account>, e.g., from "sacctmgr show associations"); a user is a member if
+# they appear in either. This replaces the user lists from the per-group scratch quota queries, so
+# that users without any scratch usage are also found.
+#
+# The result is cached in a yaml file and only read again after the refresh interval. Each time
+# it is read, it is compared to the previous version, and the users that were added to or removed
+# from each group are printed and stored with the membership. The new state is kept in the active
+# context (see context.py) until it is saved once the check has succeeded.
+
+###################################################################################################
+
+def isEnabled():
+
+    cfg = config.getConfig()
+
+    return cfg['membership']['enabled']
+
+###################################################################################################
+
+def loadState():
+
+    cfg = config.getConfig()
+
+    st = utils.readYaml(cfg['membership']['yaml_file'])
+    if st is None:
+        st = {'time': None, 'groups': {}, 'changes': {}}
+
+    return st
+
+###################################################################################################
+
+def saveState():
+
+    cfg = config.getConfig()
+    ctx = context.get()
+
+    if ctx.membership_state is not None:
+        utils.writeYaml(cfg['membership']['yaml_file'], ctx.membership_state)
+        ctx.membership_state = None
+
+    return
+
+###################################################################################################
+
+# Parse the Unix group database in the format of /etc/group (name:password:gid:user1,user2,...).
+# Only the zt-* groups of configured groups are considered.
+
+def parseUnixGroups(rettxt, members):
+
+    for line in rettxt.splitlines():
+        w = line.strip().split(':')
+        if (len(w) < 4) or (not w[0].startswith('zt-')):
+            continue
+        grp = w[0][3:]
+        if not grp in members:
+            continue
+        for usr in w[3].split(','):
+            usr = usr.strip()
+            if (usr != '') and (not usr in members[grp]):
+                members[grp].append(usr)
+
+    return
+
+###################################################################################################
+
+# Parse the Slurm associations in the format account|user. Associations without a user belong to
+# the account itself and are skipped.
+
+def parseAssociations(rettxt, members):
+
+    cfg = config.getConfig()
+
+    ext = '-%s' % (cfg['slurm_account'])
+    for line in rettxt.splitlines():
+        w = line.strip().split('|')
+        if (len(w) < 2) or (not w[0].endswith(ext)):
+            continue
+        grp = w[0][:-len(ext)]
+        usr = w[1].strip()
+        if (not grp in members) or (usr == ''):
+            continue
+        if not usr in members[grp]:
+            members[grp].append(usr)
+
+    return
+
+###################################################################################################
+
+# Query the members of all configured groups. Each of the two sources is read with one command; a
+# source is skipped if its command is null.
+
+def collectMembership():
+
+    cfg = config.getConfig()
+
+    members = {}
+    for grp in cfg['groups']:
+        members[grp] = []
+    if cfg['membership']['unix_command'] is not None:
+        parseUnixGroups(cluster.runCommand(cfg['membership']['unix_command']), members)
+    if cfg['membership']['slurm_command'] is not None:
+        parseAssociations(cluster.runCommand(cfg['membership']['slurm_command']), members)
+    for grp in members:
+        members[grp].sort()
+
+    return members
+
+###################################################################################################
+
+# Compare two versions of the membership. Returns a dictionary of the groups whose members changed,
+# with the lists of added and removed users. Groups that are new or no longer present are not
+# counted as changes.
+
+def diffMembership(members_old, members_new):
+
+    changes = {}
+    for grp in members_new:
+        if not grp in members_old:
+            continue
+        added = [usr for usr in members_new[grp] if not usr in members_old[grp]]
+        removed = [usr for usr in members_old[grp] if not usr in members_new[grp]]
+        if (len(added) > 0) or (len(removed) > 0):
+            changes[grp] = {'added': added, 'removed': removed}
+
+    return changes
+
+###################################################################################################
+
+# The membership is read again after the refresh interval, or if groups were added to the config
+# since it was cached. If the interval is None, it is only read if there is no cached membership.
+
+def isRefreshDue(st = None, t_now = None):
+
+    cfg = config.getConfig()
+
+    if st is None:
+        st = loadState()
+    if st['time'] is None:
+        return True
+    for grp in cfg['groups']:
+        if not grp in st['groups']:
+            return True
+
+    return utils.isRefreshDue(st['time'], cfg['membership']['refresh'], t_now = t_now)
+
+###################################################################################################
+
+# Get the members of all groups, from the cache if it is recent enough. Groups without members 
+# have zero weight, which is most likely a mistake in the config or the group databases.
+
+def getMembership(t_now = None, verbose = True):
+
+    ctx = context.get()
+    ctx.membership_state = None
+    st = loadState()
+    if not isRefreshDue(st = st, t_now = t_now):
+        if verbose:
+            print('    Using cached group membership.')
+        warnEmptyGroups(st['groups'])
+        return st['groups']
+
+    if t_now is None:
+        t_now = utils.getNow().timestamp()
+    members = collectMembership()
+    changes = diffMembership(st['groups'], members)
+    if verbose:
+        n_usr = sum([len(members[grp]) for grp in members])
+        print('    Found %d memberships in %d groups.' % (n_usr, len(members)))
+        for grp in changes:
+            for k in ['added', 'removed']:
+                if len(changes[grp][k]) > 0:
+                    print('    Membership of group %-15s %s %s.' % (grp, k, ', '.join(changes[grp][k])))
+    ctx.membership_state = {'time': t_now, 'groups': members, 'changes': changes}
+    warnEmptyGroups(members)
+
+    return members
+
+###################################################################################################
+
+def warnEmptyGroups(members):
+
+    for grp in members:
+        if len(members[grp]) == 0:
+            print('    WARNING: Found no members of group %s, its weight will be zero.' % (grp))
+
+    return
+
+###################################################################################################
@@ -9,9 +9,13 @@
 import smtplib
 from email.message import EmailMessage
 import datetime
+import queue
 
 import config
 import utils
+import context
+import hierarchy
+import archive
 
 ###################################################################################################
 
@@ -22,6 +26,15 @@ email_start = 'Dear HPC user,\n\n'
 email_end = "For any other questions regarding our allocation system or Zaratan in general, please see the astro wiki at https://wiki.astro.umd.edu/computing/zaratan."
 email_end += '\n\nHappy computing!\n\nYour friendly HPC allocation robot'
 
+# The following are kept in the active context (see context.py):
+#
+# - In digest mode, the messages queued per recipient; None if digest mode is off.
+# - The outbox; if it is a list, messages are appended to it instead of being saved or sent (see 
+#   simulate.py).
+# - The mailer; if it is set, it is called with each message instead of sending it via SMTP.
+# - While the sender is running, messages are put into a bounded queue and sent by a background 
+#   thread, so that a slow mail server does not hold up the processing of further groups.
+
 ###################################################################################################
 
 def testMessage(do_send = False):
@@ -32,24 +45,26 @@ def testMessage(do_send = False):
     content = 'This is a test message.\nThe date and time is %s.\n\nThe HPC admin' \
                         % (str(datetime.datetime.now()))
     
-    sendMessage(cfg['email']['test_email'], subject, content, do_send = do_send, verbose = True)
+    sendMessage(cfg['email']['test_email'], subject, content, msg_type = 'test', do_send = do_send, verbose = True)
 
     return
 
 ###################################################################################################
 
-# This message is sent to the lead and all members at the beginning of a new period. Only the lead
-# sees how the weight is computed.
+# This message is sent to the lead and all members at the beginning of a new period. The breakdown
+# of how the allocation was computed is marked as lead-only; it is dropped from the members' copy
+# when messages are collected into digests.
 
 def messageNewPeriod(prd_data, prd_data_prev, p, grp, do_send = False):
     
     cfg = config.getConfig()
-    is_final_period = (p == len(cfg['periods']) - 1)
+    is_bucket = ('bucket' in prd_data)
+    is_final_period = (p == len(cfg['periods']) - 1) and (not is_bucket)
     
     subject = '%s New allocation period' % (subject_prefix)
 
-    content = email_start
-    content += 'You are receiving this email because you are a member of the user group %s.' % (grp)
+    chunks = []
+    content = 'You are receiving this email because you are a member of the user group %s.' % (grp)
     content += " We are beginning this quarter's %s allocation period, which runs from %s to %s. " \
         % (cfg['periods'][p]['label'], prd_data['start_date'].strftime('%Y/%m/%d'), prd_data['end_date'].strftime('%Y/%m/%d'))
 
@@ -86,38 +101,82 @@ def messageNewPeriod(prd_data, prd_data_prev, p, grp, do_send = False):
                 continue
             content += ll[i] + '\n'
 
-        content += "Your group's total allocation for this period is %.1f kSU. This is calculated as follows:" \
-            % (prd_data['groups'][grp]['alloc'] / 1000.0)
+        if is_bucket:
+            content += "Your group currently has %.1f kSU available. This amount is refilled continuously by %.1f kSU per day, up to at most %.1f kSU, and any usage is subtracted from it." \
+                % (prd_data['groups'][grp]['alloc'] / 1000.0, prd_data['groups'][grp]['bucket']['rate'] / 1000.0, 
+                   prd_data['groups'][grp]['bucket']['capacity'] / 1000.0)
+        else:
+            content += "Your group's total allocation for this period is %.1f kSU." \
+                % (prd_data['groups'][grp]['alloc'] / 1000.0)
+        subs = prd_data['groups'][grp].get('subprojects', {})
+        if len(subs) > 0:
+            content += " It is split among your group's sub-projects as follows (the fraction is relative to the allocation of the parent):"
+            content += '\n'
+            content += '\n'
+            content += '    | Sub-project                    | Fraction |  Penalty |    Alloc |\n'
+            content += '    -----------------------------------------------------------------\n'
+            for path in sorted(subs.keys()):
+                content += '    | %-30s | %7.1f%% | %8.1f | %8.1f |\n' \
+                    % (path, subs[path]['weight_frac'] * 100.0, subs[path]['penalty_old'] / 1000.0, 
+                       subs[path]['alloc'] / 1000.0)
+            content += '    -----------------------------------------------------------------\n'
+            content += '\n'
+            content += 'Penalties and allocations are given in kSU. Users who are not listed in a sub-project count only towards the allocation of the group as a whole.'
+        chunks.append([content, 'all'])
+        chunks.append(['\n\n', 'member'])
+        content = ' This is calculated as follows:'
         content += '\n'
         content += '\n'
         content += 'Remaining quarterly allocation for astronomy:        %7.1f kSU\n' % (prd_data['su_avail'] / 1000.0)
-        content += 'Over/under-subscription factor for this period:      %7.1f\n' % (cfg['periods'][p]['alloc_frac'])
-        content += 'Total allocation for this period:                    %7.1f kSU\n' % (prd_data['su_alloc'] / 1000.0)
+        if is_bucket:
+            content += 'Days remaining in this quarter:                      %7.1f\n' % (prd_data['bucket']['days_left'])
+        else:
+            content += 'Over/under-subscription factor for this period:      %7.1f\n' % (cfg['periods'][p]['alloc_frac'])
+            content += 'Total allocation for this period:                    %7.1f kSU\n' % (prd_data['su_alloc'] / 1000.0)
+        if 'demand' in prd_data:
+            content += "Your group's fraction by weight:                     %7.1f %%\n" % (prd_data['groups'][grp]['weight_frac_static'] * 100.0)
+            content += "Your group's share of demand in last period:         %7.1f %%\n" \
+                % (prd_data['groups'][grp]['demand'] / max(prd_data['demand']['total'], 1.0) * 100.0)
+            content += "Weight of demand in the allocation:                  %7.1f %%\n" % (prd_data['demand']['blend'] * 100.0)
         content += "Your group's fractional allocation:                  %7.1f %%\n" % (prd_data['groups'][grp]['weight_frac'] * 100.0)
-        content += "Your group's allocation before penalties:            %7.1f kSU\n" % (prd_data['groups'][grp]['weight_frac'] * prd_data['su_alloc'] / 1000.0)
-        content += "Penalty from previous period(s):                     %7.1f kSU\n" % (prd_data['groups'][grp]['penalty_old'] / 1000.0)
-        content += "Your group's allocation for this period:             %7.1f kSU\n" % (prd_data['groups'][grp]['alloc'] / 1000.0)
+        if is_bucket:
+            b = prd_data['groups'][grp]['bucket']
+            content += "Your group's refill rate:                            %7.1f kSU/day\n" % (b['rate'] / 1000.0)
+            content += "Maximum available (%.0f days of refill):               %7.1f kSU\n" % (prd_data['bucket']['capacity_days'], b['capacity'] / 1000.0)
+            content += "Penalty from previous period(s):                     %7.1f kSU\n" % (prd_data['groups'][grp]['penalty_old'] / 1000.0)
+            content += "Your group's available allocation now:               %7.1f kSU\n" % (prd_data['groups'][grp]['alloc'] / 1000.0)
+        else:
+            content += "Your group's allocation before penalties:            %7.1f kSU\n" % (prd_data['groups'][grp]['weight_frac'] * prd_data['su_alloc'] / 1000.0)
+            content += "Penalty from previous period(s):                     %7.1f kSU\n" % (prd_data['groups'][grp]['penalty_old'] / 1000.0)
+            content += "Your group's allocation for this period:             %7.1f kSU\n" % (prd_data['groups'][grp]['alloc'] / 1000.0)
         content += "Your group's current cumulative usage this quarter:  %7.1f kSU\n" % (su_usage_cum_old / 1000.0)
-        content += "Your group's maximum cumulative usage this period:   %7.1f kSU\n" % ((su_usage_cum_old / 1000.0 + prd_data['groups'][grp]['alloc']) / 1000.0)
+        if not is_bucket:
+            content += "Your group's maximum cumulative usage this period:   %7.1f kSU\n" % ((su_usage_cum_old / 1000.0 + prd_data['groups'][grp]['alloc']) / 1000.0)
         content += '\n'
+        chunks.append([content, 'lead'])
+        content = ''
+        if len(prd_data['groups'][grp].get('pools', {})) > 0:
+            content += 'Your group has received the following allocations of all resources:'
+            content += '\n'
+            content += '\n'
+            content += makeResourceTable(prd_data['groups'][grp])
+            content += '\n'
         content += "It is the responsibility of all group members to monitor your group's usage."
         content += " You will receive a warning email when your group's usage exceeds %d percent of this period's allocation. " \
-            % (cfg['warning_levels'][0])
-    
-    content += email_end
+            % (hierarchy.getWarningLevels(prd_data['groups'][grp])[0])
+    chunks.append([content, 'all'])
     
     # Send
-    recipients = ''
-    for usr in prd_data['groups'][grp]['users'].keys():
-        recipients += '%s@umd.edu, ' % (usr)
-    recipients = recipients[:-2]
-    sendMessage(recipients, subject, content, do_send = do_send, verbose = False, recipient_label = grp)
+    dispatchMessage(prd_data, grp, subject, chunks, 'new_period', do_send = do_send)
 
     return
 
 ###################################################################################################
 
-def messageUsageWarning(prd_data, grp, warn_idx, do_send = False):
+# This message is sent when a group's usage exceeds a warning level. If a list of the group's top
+# jobs is given, it is included so that users can see which jobs consumed the allocation.
+
+def messageUsageWarning(prd_data, grp, warn_idx, do_send = False, top_jobs = None):
 
     cfg = config.getConfig()
     
@@ -125,7 +184,7 @@ def messageUsageWarning(prd_data, grp, warn_idx, do_send = False):
     if not zero_alloc:
         used_frac = prd_data['groups'][grp]['su_usage'] / prd_data['groups'][grp]['alloc']
 
-    content = email_start
+    content = ''
 
     if zero_alloc or (used_frac >= 1.0):
         subject = '%s Warning: allocation exceeded!' % (subject_prefix)
@@ -140,6 +199,8 @@ def messageUsageWarning(prd_data, grp, warn_idx, do_send = False):
     content += "Used:                                        %7.1f kSU\n" % (prd_data['groups'][grp]['su_usage'] / 1000.0)
     content += "Remaining:                                   %7.1f kSU\n" \
         % (prd_data['groups'][grp]['alloc'] / 1000.0 - prd_data['groups'][grp]['su_usage'] / 1000.0)
+    if 'bucket' in prd_data['groups'][grp]:
+        content += "Refilled per day:                            %7.1f kSU\n" % (prd_data['groups'][grp]['bucket']['rate'] / 1000.0)
     content += '\n'
     content += 'The following table shows the consumption of SUs (and scratch space) by user:'
     content += '\n'
@@ -152,6 +213,25 @@ def messageUsageWarning(prd_data, grp, warn_idx, do_send = False):
             continue
         content += ll[i] + '\n'
     
+    if len(prd_data['groups'][grp].get('pools', {})) > 0:
+        content += 'The following table shows the allocation and usage of all resources of your group:'
+        content += '\n'
+        content += '\n'
+        content += makeResourceTable(prd_data['groups'][grp])
+        content += '\n'
+    
+    if (top_jobs is not None) and (len(top_jobs) > 0):
+        content += 'The following table shows the %d most expensive jobs that finished in this period:' % (len(top_jobs))
+        content += '\n'
+        content += '\n'
+        content += '    | Job ID       | User        | Partition    |      kSU | End                 |\n'
+        content += '    ----------------------------------------------------------------------------\n'
+        for job in top_jobs:
+            content += '    | %-12s | %-12s| %-12s | %8.2f | %-19s |\n' \
+                % (job['id'], job['user'], job['partition'], job['su'] / 1000.0, job['end'].replace('T', ' '))
+        content += '    ----------------------------------------------------------------------------\n'
+        content += '\n'
+    
     content += "The current allocation period runs from %s to %s." \
         % (prd_data['start_date'].strftime('%Y/%m/%d'), prd_data['end_date'].strftime('%Y/%m/%d'))
     
@@ -161,49 +241,497 @@ def messageUsageWarning(prd_data, grp, warn_idx, do_send = False):
     else:
         content += " Please carefully keep track of your group's usage."
         content += " You will receive another warning email when your group's usage exceeds %d percent of this period's allocation." \
-            % (cfg['warning_levels'][warn_idx + 1])
+            % (hierarchy.getWarningLevels(prd_data['groups'][grp])[warn_idx + 1])
+    
+    # Send
+    dispatchMessage(prd_data, grp, subject, [[content, 'all']], 'warning', do_send = do_send)
+
+    return
+
+###################################################################################################
+
+def messageSubprojectWarning(prd_data, grp, path, warn_idx, do_send = False):
+
+    grp_data = prd_data['groups'][grp]
+    sub = grp_data['subprojects'][path]
+    zero_alloc = (sub['alloc'] <= 0.0)
+    if not zero_alloc:
+        used_frac = sub['su_usage'] / sub['alloc']
+
+    if zero_alloc or (used_frac >= 1.0):
+        subject = '%s Warning: sub-project allocation exceeded!' % (subject_prefix)
+        content = "The allocation of sub-project %s of your group %s has been exceeded." % (path, grp)
+    else:
+        subject = '%s Warning: %.0f%% of sub-project allocation used up' % (subject_prefix, used_frac * 100.0)
+        content = "As of today, %.0f%% of the allocation of sub-project %s of your group %s has been used up." \
+            % (used_frac * 100.0, path, grp)
+
+    content += '\n'
+    content += '\n'
+    content += "The sub-project's allocation for this period: %7.1f kSU\n" % (sub['alloc'] / 1000.0)
+    content += "Used:                                        %7.1f kSU\n" % (sub['su_usage'] / 1000.0)
+    content += "Remaining:                                   %7.1f kSU\n" % ((sub['alloc'] - sub['su_usage']) / 1000.0)
+    content += '\n'
+    content += 'The following table shows the consumption of SUs by the members of the sub-project:'
+    content += '\n'
+    content += '\n'
+    content += '    | User        |   kSU |\n'
+    content += '    -----------------------\n'
+    users = hierarchy.getSubprojectUsers(grp_data, path)
+    for usr in users:
+        content += '    | %-12s| %5.1f |\n' % (usr, grp_data['users'][usr].get('su_usage', 0.0) / 1000.0)
+    content += '    -----------------------\n'
+    content += '\n'
+
+    if zero_alloc or (used_frac >= 1.0):
+        content += "Any additional usage will be multiplied by a penalty factor and subtracted from the sub-project's next allocation."
+    elif warn_idx < len(sub['warning_levels']) - 1:
+        content += "You will receive another warning email when the sub-project's usage exceeds %d percent of its allocation." \
+            % (sub['warning_levels'][warn_idx + 1])
+    content += '\n\n'
+
+    # Send to the members of the sub-project and the lead of the group
+    lead = grp_data.get('lead', None)
+    if (lead is not None) and (lead in grp_data['users']) and (not lead in users):
+        users.append(lead)
+    dispatchMessage(prd_data, grp, subject, [[content, 'all']], 'warning', do_send = do_send, users = users)
+
+    return
+
+###################################################################################################
+
+# A table of the allocation and usage of all resources of a group, the SUs and any additional pools.
+
+def makeResourceTable(grp_data):
+
+    cfg = config.getConfig()
+    
+    rows = [['SU', 'kSU', grp_data['alloc'] / 1000.0, grp_data['penalty_old'] / 1000.0, 
+             grp_data['su_usage'] / 1000.0]]
+    for r in grp_data.get('pools', {}):
+        pool = grp_data['pools'][r]
+        rows.append([cfg['pools'][r]['label'], cfg['pools'][r]['unit'], pool['alloc'], pool['penalty_old'], pool['usage']])
+    
+    txt = '    | Resource             | Unit   |      Alloc |    Penalty |       Used |   Used |\n'
+    txt += '    -------------------------------------------------------------------------------\n'
+    for label, unit, alloc, penalty, usage in rows:
+        if alloc > 0.0:
+            used_str = '%5.1f%%' % (usage / alloc * 100.0)
+        else:
+            used_str = '     -'
+        txt += '    | %-20s | %-6s | %10.1f | %10.1f | %10.1f | %s |\n' % (label, unit, alloc, penalty, usage, used_str)
+    txt += '    -------------------------------------------------------------------------------\n'
     
-    content += email_end
+    return txt
+
+###################################################################################################
+
+# Warning about the usage of additional resource pools. The crossed list contains the pools that 
+# crossed a warning level as [pool, index of the level], where the index is None if the group has
+# no allocation in the pool.
+
+def messagePoolWarning(prd_data, grp, crossed, do_send = False):
+
+    cfg = config.getConfig()
+    
+    grp_data = prd_data['groups'][grp]
+    labels = []
+    exceeded = False
+    content = 'As of today, your group %s has used:\n' % (grp)
+    content += '\n'
+    for r, warn_idx in crossed:
+        pool = grp_data['pools'][r]
+        label = cfg['pools'][r]['label']
+        labels.append(label)
+        if pool['alloc'] <= 0.0:
+            exceeded = True
+            content += '    %.1f %s of %s without any allocation\n' % (pool['usage'], cfg['pools'][r]['unit'], label)
+        else:
+            used_frac = pool['usage'] / pool['alloc']
+            exceeded = exceeded or (used_frac >= 1.0)
+            content += '    %.0f%% of its allocation of %s\n' % (used_frac * 100.0, label)
+    content += '\n'
+    content += 'The following table shows the allocation and usage of all resources of your group for this period:'
+    content += '\n'
+    content += '\n'
+    content += makeResourceTable(grp_data)
+    content += '\n'
+    
+    if exceeded:
+        subject = '%s Warning: %s allocation exceeded!' % (subject_prefix, ', '.join(labels))
+        content += 'Any additional usage of resources whose allocation has been exceeded will be multiplied by a penalty factor and subtracted from your next allocation.'
+    else:
+        if len(crossed) == 1:
+            r = crossed[0][0]
+            subject = '%s Warning: %.0f%% of %s allocation used up' \
+                % (subject_prefix, grp_data['pools'][r]['usage'] / grp_data['pools'][r]['alloc'] * 100.0, labels[0])
+        else:
+            subject = '%s Warning: usage of %s' % (subject_prefix, ', '.join(labels))
+        ll = []
+        for r, warn_idx in crossed:
+            levels = cfg['pools'][r]['warning_levels']
+            if warn_idx < len(levels) - 1:
+                ll.append("You will receive another warning email when your group's usage of %s exceeds %d percent of this period's allocation." \
+                    % (cfg['pools'][r]['label'], levels[warn_idx + 1]))
+        content += ' '.join(ll)
+    content += '\n\n'
+    
+    # Send
+    dispatchMessage(prd_data, grp, subject, [[content, 'all']], 'warning', do_send = do_send)
+
+    return
+
+###################################################################################################
+
+# This message is sent when a group's scratch usage exceeds a warning level. If the group's scratch
+# directory was scanned, the largest and oldest files of each user are listed as candidates for 
+# deletion.
+
+def messageScratchWarning(prd_data, grp, warn_idx, scan = None, do_send = False):
+
+    cfg = config.getConfig()
+    
+    grp_data = prd_data['groups'][grp]
+    used_frac = grp_data['scratch_usage'] / grp_data['scratch_quota']
+    if used_frac >= 1.0:
+        subject = '%s Warning: scratch quota exceeded!' % (subject_prefix)
+    else:
+        subject = '%s Warning: %.0f%% of scratch quota used' % (subject_prefix, used_frac * 100.0)
+    
+    content = "Your group %s is using %.0f%% of its scratch quota." % (grp, used_frac * 100.0)
+    content += '\n'
+    content += '\n'
+    content += "Your group's scratch quota:                  %7.1f GB\n" % (grp_data['scratch_quota'])
+    content += "Used:                                        %7.1f GB\n" % (grp_data['scratch_usage'])
+    content += '\n'
+    
+    if (scan is not None) and (len(scan['users']) > 0):
+        content += 'The following list shows the largest and the oldest (least recently modified) files of each user in %s.' \
+            % (scan['root'])
+        content += ' Please delete or move any files that you no longer need.\n'
+        content += '\n'
+        usrs = sorted(scan['users'].keys(), key = lambda u: scan['users'][u]['size'], reverse = True)
+        for usr in usrs:
+            s = scan['users'][usr]
+            content += '%s: %.1f GB in %d files\n' % (usr, s['size'], s['n_files'])
+            for label, files in [['Largest', s['largest']], ['Oldest', s['oldest']]]:
+                content += '    %s:\n' % (label)
+                for path, size, mtime in files:
+                    if size >= 1.0:
+                        size_str = '%7.1f GB' % (size)
+                    else:
+                        size_str = '%7.1f MB' % (size * 1024.0)
+                    content += '        %s  %s  %s\n' \
+                        % (size_str, datetime.datetime.fromtimestamp(mtime).strftime('%Y/%m/%d'), path)
+            content += '\n'
+    
+    if used_frac >= 1.0:
+        content += "Jobs that write to scratch will fail until the usage is below the quota. Please delete files as soon as possible."
+    elif warn_idx < len(cfg['scratch']['warning_levels']) - 1:
+        content += "You will receive another warning email when your group's usage exceeds %d percent of its scratch quota." \
+            % (cfg['scratch']['warning_levels'][warn_idx + 1])
+    content += '\n\n'
     
     # Send
-    recipients = ''
-    for usr in prd_data['groups'][grp]['users'].keys():
-        recipients += '%s@umd.edu, ' % (usr)
-    recipients = recipients[:-2]
-    sendMessage(recipients, subject, content, do_send = do_send, verbose = False, recipient_label = grp)
+    dispatchMessage(prd_data, grp, subject, [[content, 'all']], 'scratch', do_send = do_send)
 
     return
 
 ###################################################################################################
 
-# This function saves messages to text file and, if do_send is True, attempts to send them via
-# email.
+# This message is sent when the allocation of a group has been changed during a period because 
+# unused allocation was redistributed.
 
-def sendMessage(recipients, subject, content, recipient_label = None, 
-                do_send = False, safe_mode = False, verbose = False):
+def messageRebalance(prd_data, grp, alloc_old, do_send = False):
+
+    alloc_new = prd_data['groups'][grp]['alloc']
+    if alloc_new < alloc_old:
+        subject = '%s Allocation reduced' % (subject_prefix)
+        content = "Based on its usage so far, your group %s is projected to leave a significant part of its allocation unused in this period." % (grp)
+        content += ' Part of the unused allocation has been redistributed to groups that are close to their limit.'
+    else:
+        subject = '%s Allocation increased' % (subject_prefix)
+        content = "Your group %s is close to or projected to exceed its allocation in this period." % (grp)
+        content += ' It has received a share of the allocation that other groups are projected to leave unused.'
+    content += '\n'
+    content += '\n'
+    content += "Your group's previous allocation for this period:  %7.1f kSU\n" % (alloc_old / 1000.0)
+    content += "Your group's new allocation for this period:       %7.1f kSU\n" % (alloc_new / 1000.0)
+    content += "Used so far:                                       %7.1f kSU\n" % (prd_data['groups'][grp]['su_usage'] / 1000.0)
+    content += '\n'
+    content += "The current allocation period runs from %s to %s. " \
+        % (prd_data['start_date'].strftime('%Y/%m/%d'), prd_data['end_date'].strftime('%Y/%m/%d'))
+    content += 'Warnings and penalties are computed with respect to the new allocation.\n\n'
     
+    # Send
+    dispatchMessage(prd_data, grp, subject, [[content, 'all']], 'rebalance', do_send = do_send)
+
+    return
+
+###################################################################################################
+
+# This message is sent when a group was added during a period (if alloc_old is None), or when its
+# allocation changed because the weights of the groups changed during the period.
+
+def messageReallocation(prd_data, grp, alloc_old, do_send = False):
+
+    grp_data = prd_data['groups'][grp]
+    if alloc_old is None:
+        subject = '%s Allocation for your group' % (subject_prefix)
+        content = 'You are receiving this email because you are a member of the user group %s,' % (grp)
+        content += ' which has been added to the astronomy allocation during the current period.'
+        if 'bucket' in grp_data:
+            content += " Your group currently has %.1f kSU available. This amount is refilled continuously by %.1f kSU per day, up to at most %.1f kSU, and any usage is subtracted from it." \
+                % (grp_data['alloc'] / 1000.0, grp_data['bucket']['rate'] / 1000.0, grp_data['bucket']['capacity'] / 1000.0)
+        else:
+            content += " Your group's allocation for the rest of this period is %.1f kSU." % (grp_data['alloc'] / 1000.0)
+        content += '\n'
+        content += '\n'
+        if len(grp_data.get('pools', {})) > 0:
+            content += 'Your group has received the following allocations of all resources:'
+            content += '\n'
+            content += '\n'
+            content += makeResourceTable(grp_data)
+            content += '\n'
+    else:
+        if grp_data['alloc'] < alloc_old:
+            subject = '%s Allocation reduced' % (subject_prefix)
+        else:
+            subject = '%s Allocation increased' % (subject_prefix)
+        content = 'The members of the groups in the astronomy allocation have changed during the current period, for example because users joined or left a group.'
+        content += " The allocation that remains for this period has been split again according to the new weights, and your group's share has changed."
+        content += '\n'
+        content += '\n'
+        content += "Your group's previous allocation for this period:  %7.1f kSU\n" % (alloc_old / 1000.0)
+        content += "Your group's new allocation for this period:       %7.1f kSU\n" % (grp_data['alloc'] / 1000.0)
+        content += "Used so far:                                       %7.1f kSU\n" % (grp_data['su_usage'] / 1000.0)
+        content += '\n'
+    content += "The current allocation period runs from %s to %s. " \
+        % (prd_data['start_date'].strftime('%Y/%m/%d'), prd_data['end_date'].strftime('%Y/%m/%d'))
+    content += "You will receive a warning email when your group's usage exceeds %d percent of its allocation.\n\n" \
+        % (hierarchy.getWarningLevels(grp_data)[0])
+
+    # Send
+    dispatchMessage(prd_data, grp, subject, [[content, 'all']], 'reallocation', do_send = do_send)
+
+    return
+
+###################################################################################################
+
+# Group messages consist of chunks of text that are addressed to 'all' members, only to the 'lead',
+# or only to the non-lead members ('member'). Outside of digest mode, all members receive the full
+# lead version, as before. In digest mode, the messages are instead queued per recipient and sent 
+# when the digest is flushed. The message type is stored in the email archive.
+
+def dispatchMessage(prd_data, grp, subject, chunks, msg_type, do_send = False, users = None):
+
+    content_lead = ''
+    content_member = ''
+    for c, who in chunks:
+        if who in ['all', 'lead']:
+            content_lead += c
+        if who in ['all', 'member']:
+            content_member += c
+    if users is None:
+        users = list(prd_data['groups'][grp]['users'].keys())
+    
+    digest_queue = context.get().digest_queue
+    if digest_queue is None:
+        recipients = ', '.join(['%s%s' % (usr, email_ext) for usr in users])
+        sendMessage(recipients, subject, email_start + content_lead + email_end, do_send = do_send, 
+                    verbose = False, recipient_label = grp, msg_type = msg_type, groups = [grp])
+    else:
+        lead = prd_data['groups'][grp].get('lead', None)
+        for usr in users:
+            if usr == lead:
+                content = content_lead
+            else:
+                content = content_member
+            if not usr in digest_queue:
+                digest_queue[usr] = []
+            digest_queue[usr].append({'grp': grp, 'subject': subject, 'content': content, 'type': msg_type})
+        
+    return
+
+###################################################################################################
+
+# In digest mode, all group messages of a run are collected and each recipient receives one 
+# consolidated email. Identical sections (e.g., the same message reaching a user through two 
+# groups) are sent only once.
+
+def startDigest():
+    
+    context.get().digest_queue = {}
+
+    return
+
+###################################################################################################
+
+def flushDigest(do_send = False, verbose = True):
+    
+    ctx = context.get()
+    queue = ctx.digest_queue
+    ctx.digest_queue = None
+    if (queue is None) or (len(queue) == 0):
+        return
+    
+    n_msg = 0
+    smtp = None
+    if do_send and (ctx.outbox is None) and (ctx.mailer is None):
+        smtp = connectSMTP()
+    
+    for usr in sorted(queue.keys()):
+        
+        items = []
+        contents = []
+        for item in queue[usr]:
+            n_msg += 1
+            if item['content'] in contents:
+                continue
+            contents.append(item['content'])
+            items.append(item)
+        
+        if len(items) == 1:
+            subject = items[0]['subject']
+            content = email_start + items[0]['content'] + email_end
+            msg_type = items[0]['type']
+        else:
+            subject = '%s Allocation digest (%d notices)' % (subject_prefix, len(items))
+            msg_type = 'digest'
+            content = email_start
+            content += 'This email combines %d notices regarding your HPC groups.\n\n' % (len(items))
+            for item in items:
+                content += '=== Group %s: %s ===\n\n' % (item['grp'], item['subject'].replace(subject_prefix, '').strip())
+                content += item['content']
+                content += '\n\n'
+            content += email_end
+        
+        grps = sorted(set([item['grp'] for item in items]))
+        sendMessage(usr + email_ext, subject, content, recipient_label = usr, msg_type = msg_type, 
+                    groups = grps, do_send = do_send, smtp = smtp)
+    
+    if smtp is not None:
+        smtp.quit()
+    if verbose:
+        print('    Sent %d digest emails in place of %d group messages.' % (len(queue), n_msg))
+
+    return
+
+###################################################################################################
+
+def connectSMTP(verbose = False):
+
     cfg = config.getConfig()
+
+    if verbose:
+        print('    Connecting to server...')
+    s = smtplib.SMTP('smtp.gmail.com')
+    
+    # Identify yourself to an ESMTP server using EHLO
+    if verbose:
+        print('    Sending EHLO...')
+    s.ehlo()
+    
+    # Secure the SMTP connection
+    if verbose:
+        print('    Starting TLS...')
+    s.starttls()
+    
+    # Login to the server (if required)
+    if verbose:
+        print('    Logging in...')
+    s.login(cfg['email']['sender_email'] , cfg['email']['sender_password'])
+
+    return s
+
+###################################################################################################
+
+def startSender(queue_size):
+    
+    ctx = context.get()
+    ctx.send_queue = queue.Queue(maxsize = queue_size)
+    ctx.send_errors = []
+    ctx.send_thread = context.startThread(runSender, args = (ctx.send_queue,))
+    
+    return
+
+###################################################################################################
+
+# Errors in the sender thread are collected and returned when the sender is stopped. The sender 
+# must be stopped before switching to another department's config.
+
+def runSender(q):
+    
+    while True:
+        kwargs = q.get()
+        if kwargs is None:
+            break
+        try:
+            deliverMessage(**kwargs)
+        except Exception as e:
+            context.get().send_errors.append('Could not send message "%s" to %s (%s).' % (kwargs['subject'], kwargs['recipients'], str(e)))
+    
+    return
+
+###################################################################################################
+
+# Wait until all queued messages have been sent. Returns a list of errors that occurred while 
+# sending. The caller decides whether to raise them, so that stopping the sender in a finally block
+# does not replace an exception that is already being raised.
+
+def stopSender():
+    
+    ctx = context.get()
+    if ctx.send_queue is None:
+        return []
+    ctx.send_queue.put(None)
+    ctx.send_thread.join()
+    ctx.send_queue = None
+    ctx.send_thread = None
+    send_errors = ctx.send_errors
+    ctx.send_errors = []
+    
+    return send_errors
+
+###################################################################################################
+
+# This function stores messages in the email archive and, if do_send is True, attempts to send them
+# via email. If an open SMTP connection is passed, it is used and left open. If the sender is 
+# running, the message is queued instead.
+
+def sendMessage(recipients, subject, content, recipient_label = None, msg_type = 'other', groups = None,
+                do_send = False, safe_mode = False, verbose = False, smtp = None):
+    
+    kwargs = {'recipients': recipients, 'subject': subject, 'content': content, 
+              'recipient_label': recipient_label, 'msg_type': msg_type, 'groups': groups, 
+              'do_send': do_send, 'safe_mode': safe_mode, 'verbose': verbose, 'smtp': smtp}
+    send_queue = context.get().send_queue
+    if (send_queue is not None) and (smtp is None):
+        send_queue.put(kwargs)
+    else:
+        deliverMessage(**kwargs)
+    
+    return
+
+###################################################################################################
+
+def deliverMessage(recipients, subject, content, recipient_label = None, msg_type = 'other', groups = None,
+                   do_send = False, safe_mode = False, verbose = False, smtp = None):
+    
+    cfg = config.getConfig()
+    ctx = context.get()
+    
+    if ctx.outbox is not None:
+        ctx.outbox.append({'to': recipients, 'subject': subject, 'content': content})
+        return
     
     do_send = do_send and ((not safe_mode) or (recipient_label == 'diemer-prj'))
         
     if do_send:
-        email_dir = cfg['email_dir_sent']
+        kind = 'sent'
     else:
-        email_dir = cfg['email_dir_draft']
-    
-    if recipient_label is None:
-        recipient_label = recipients
-    
-    time_str = str(datetime.datetime.now())[:-2]
-    time_str = time_str.replace(' ', '_').replace('-', '_').replace(':', '_')
-    fname = email_dir + time_str + '_' + recipient_label + '.txt'
-    f = open(fname, 'w')
-    f.write('From:    %s\n' % (cfg['email']['sender_email']))
-    f.write('To:      %s\n' % (recipients))
-    f.write('Subject: %s\n' % (subject))
-    f.write('\n\n')
-    f.write(content)
-    f.close()
+        kind = 'draft'
+    archive.storeMessage(kind, recipients, subject, content, msg_type = msg_type, groups = groups)
     
     if do_send:
 
@@ -215,30 +743,21 @@ def sendMessage(recipients, subject, content, recipient_label = None,
 
         if verbose:
             print('Sending email "%s"...' % (msg['Subject']))
-            print('    Connecting to server...')
-        s = smtplib.SMTP('smtp.gmail.com')
-        
-        # Identify yourself to an ESMTP server using EHLO
-        if verbose:
-            print('    Sending EHLO...')
-        s.ehlo()
-        
-        # Secure the SMTP connection
-        if verbose:
-            print('    Starting TLS...')
-        s.starttls()
-        
-        # Login to the server (if required)
-        if verbose:
-            print('    Logging in...')
-        s.login(cfg['email']['sender_email'] , cfg['email']['sender_password'])
+        if ctx.mailer is not None:
+            ctx.mailer(msg)
+            return
+        if smtp is None:
+            s = connectSMTP(verbose = verbose)
+        else:
+            s = smtp
         
         # Send message
         if verbose:
             print('    Sending message...')
         s.send_message(msg)
         
-        s.quit()
+        if smtp is None:
+            s.quit()
 
     return
 
@@ -0,0 +1,163 @@
+###################################################################################################
+#
+# This file is part of the HPC allocator code for the UMD astronomy department
+#
+# (c) Benedikt Diemer
+#
+###################################################################################################
+
+import datetime
+
+import config
+import utils
+import hierarchy
+
+###################################################################################################
+
+# Adaptive polling of the SU usage. Instead of querying all groups at every refresh, each group has
+# its own time when its usage is next due. After each poll, the burn rate of the group is estimated
+# from the change in its cumulative usage since its previous poll, smoothed over polls. The time
+# until the usage reaches the next warning level of the group (or its allocation) at this rate
+# determines when the group is polled again: after a fraction safety of that time, but no sooner
+# than min_interval and no later than max_interval. Groups that are close to a level are thus
+# polled often, and idle groups or groups that have crossed all levels rarely.
+#
+# The state contains, for each group, the time and cumulative usage of its last poll, its burn
+# rate (in SU per second), and the time of its next poll. The rate of a group that has not been
+# polled before is estimated from its usage since the beginning of the period; if that is not
+# possible, the group is polled again after min_interval.
+
+###################################################################################################
+
+def isEnabled():
+
+    cfg = config.getConfig()
+
+    return cfg['polling']['enabled']
+
+###################################################################################################
+
+def loadState():
+
+    cfg = config.getConfig()
+
+    st = utils.readYaml(cfg['polling']['yaml_file'])
+    if st is None:
+        st = {}
+
+    return st
+
+###################################################################################################
+
+def saveState(st):
+
+    cfg = config.getConfig()
+
+    utils.writeYaml(cfg['polling']['yaml_file'], st)
+
+    return
+
+###################################################################################################
+
+# The groups whose usage is due to be polled at time t_now, in the order of the config. Groups that
+# have never been polled are always due.
+
+def getDueGroups(st, t_now):
+
+    cfg = config.getConfig()
+
+    grps = []
+    for grp in cfg['groups']:
+        if (not grp in st) or (st[grp]['next'] <= t_now):
+            grps.append(grp)
+
+    return grps
+
+###################################################################################################
+
+# The average burn rate of a group since the beginning of the period, or None if it is not known.
+
+def getPeriodRate(prd_cur, grp, t_now):
+
+    if not grp in prd_cur['groups']:
+        return None
+    t_start = datetime.datetime.combine(prd_cur['start_date'], datetime.time()).timestamp()
+    if t_now <= t_start:
+        return None
+
+    return prd_cur['groups'][grp]['su_usage'] / (t_now - t_start)
+
+###################################################################################################
+
+# The time (in seconds) until the usage of a group reaches its next warning level, given its burn
+# rate. Returns None if the group is idle or there is no level left to cross in this period.
+
+def getTimeToLevel(grp_data, rate):
+
+    alloc = grp_data['alloc']
+    usage = grp_data['su_usage']
+    if (rate <= 0.0) or (alloc <= 0.0):
+        return None
+    for level in hierarchy.getWarningLevels(grp_data):
+        su_level = alloc * level / 100.0
+        if usage < su_level:
+            return (su_level - usage) / rate
+
+    return None
+
+###################################################################################################
+
+# Update the state after a check. The groups that were polled get a new burn rate from their
+# cumulative usage in grps_cur; a group with stale data is tried again after min_interval. The
+# next poll of every group in the period is then scheduled from its last poll, so that changes in
+# the allocations are taken into account for all groups.
+
+def updateState(st, prd_cur, grps_cur, grps_polled, t_now):
+
+    cfg = config.getConfig()
+    cfg_p = cfg['polling']
+
+    retry = []
+    for grp in grps_polled:
+        if not grp in grps_cur:
+            continue
+        if grps_cur[grp].get('stale', False):
+            if grp in st:
+                st[grp]['next'] = t_now + cfg_p['min_interval'] * 60.0
+                retry.append(grp)
+            continue
+        su_usage = grps_cur[grp]['su_usage']
+        if grp in st:
+            s = st[grp]
+            dt = t_now - s['time']
+
+            # The cumulative usage is reset at the beginning of a quarter, in which case the
+            # previous rate is kept
+            if (dt > 0.0) and (su_usage >= s['su_usage']):
+                rate_new = (su_usage - s['su_usage']) / dt
+                if s['rate'] is None:
+                    s['rate'] = rate_new
+                else:
+                    s['rate'] = cfg_p['smoothing'] * rate_new + (1.0 - cfg_p['smoothing']) * s['rate']
+        else:
+            s = {'rate': getPeriodRate(prd_cur, grp, t_now)}
+            st[grp] = s
+        s['time'] = t_now
+        s['su_usage'] = su_usage
+
+    for grp in st:
+        if (not grp in prd_cur['groups']) or (grp in retry):
+            continue
+        if st[grp]['rate'] is None:
+            st[grp]['next'] = st[grp]['time'] + cfg_p['min_interval'] * 60.0
+            continue
+        dt_level = getTimeToLevel(prd_cur['groups'][grp], st[grp]['rate'])
+        if dt_level is None:
+            dt_next = cfg_p['max_interval'] * 60.0
+        else:
+            dt_next = min(max(cfg_p['safety'] * dt_level, cfg_p['min_interval'] * 60.0), cfg_p['max_interval'] * 60.0)
+        st[grp]['next'] = st[grp]['time'] + dt_next
+
+    return
+
+###################################################################################################
@@ -0,0 +1,277 @@
+###################################################################################################
+#
+# This file is part of the HPC allocator code for the UMD astronomy department
+#
+# (c) Benedikt Diemer
+#
+###################################################################################################
+
+import config
+import hierarchy
+
+###################################################################################################
+
+# Allocation of resources that are billed separately from the SUs, such as GPU time. Each pool has
+# a fixed amount per quarter, its own allocation fractions by period, penalty factor, and warning
+# levels. The usage of each pool is computed from the job records (see accounting.py). The pools
+# are allocated to groups with the same weights as the SUs; sub-projects only split the SUs.
+#
+# All quantities are kept as matrices with one row per group and one column per pool, so that the
+# allocations of all groups and pools are computed in the same pass. In the group and period data,
+# each group has a dictionary of pools.
+
+###################################################################################################
+
+def getPools():
+
+    cfg = config.getConfig()
+
+    if cfg['pools'] is None:
+        return []
+    pool_names = list(cfg['pools'].keys())
+    if (len(pool_names) > 0) and (not cfg['accounting']['enabled']):
+        raise Exception('Resource pools (%s) require job accounting to be enabled.' % (', '.join(pool_names)))
+
+    return pool_names
+
+###################################################################################################
+
+def getUserUsageFromData(grp_data):
+
+    usr_pool_usage = {}
+    for usr in grp_data['users']:
+        usr_pool_usage[usr] = dict(grp_data['users'][usr].get('pool_usage', {}))
+
+    return usr_pool_usage
+
+###################################################################################################
+
+# Set the cumulative usage of each pool this quarter for the users of a group, given as a
+# dictionary of users with a dictionary of pools, and the sum over the users.
+
+def setGroupUsage(grp_data, usr_pool_usage):
+
+    pool_names = getPools()
+
+    grp_data['pool_usage'] = {}
+    for r in pool_names:
+        grp_data['pool_usage'][r] = 0.0
+    for usr in grp_data['users']:
+        grp_data['users'][usr]['pool_usage'] = {}
+        for r in pool_names:
+            u = usr_pool_usage.get(usr, {}).get(r, 0.0)
+            grp_data['users'][usr]['pool_usage'][r] = u
+            grp_data['pool_usage'][r] += u
+
+    return
+
+###################################################################################################
+
+# Get the matrix of a quantity for the given groups and pools. Groups or pools that are missing
+# from the data are set to the default value.
+
+def getMatrix(groups, grps, pool_names, key, default = 0.0):
+
+    m = []
+    for grp in grps:
+        if grp in groups:
+            dic = groups[grp].get('pools', {})
+        else:
+            dic = {}
+        m.append([dic.get(r, {}).get(key, default) for r in pool_names])
+
+    return m
+
+###################################################################################################
+
+def getUsageMatrix(groups, grps, pool_names):
+
+    m = []
+    for grp in grps:
+        if grp in groups:
+            dic = groups[grp].get('pool_usage', {})
+        else:
+            dic = {}
+        m.append([dic.get(r, 0.0) for r in pool_names])
+
+    return m
+
+###################################################################################################
+
+def setMatrix(groups, grps, pool_names, key, m):
+
+    for i in range(len(grps)):
+        if not 'pools' in groups[grps[i]]:
+            groups[grps[i]]['pools'] = {}
+        for j in range(len(pool_names)):
+            if not pool_names[j] in groups[grps[i]]['pools']:
+                groups[grps[i]]['pools'][pool_names[j]] = {}
+            groups[grps[i]]['pools'][pool_names[j]][key] = m[i][j]
+
+    return
+
+###################################################################################################
+
+# The fraction of the remaining amount of a pool that is allocated in period p. If the pool does 
+# not set its own fractions, those of the SUs are used.
+
+def getAllocFraction(r, p):
+
+    cfg = config.getConfig()
+
+    fracs = cfg['pools'][r].get('alloc_frac', None)
+    if fracs is None:
+        return cfg['periods'][p]['alloc_frac']
+
+    return fracs[p]
+
+###################################################################################################
+
+# Start a new period: set the final usage of all pools in the previous period, and allocate the
+# pools for the new period. This follows the same logic as the SU allocation in run.py; the period
+# must already contain the groups with their weight fractions. If this is a new quarter, the usage
+# has been reset and the final usage of the previous period is taken from the previous group data.
+
+def startPeriod(prd_new, prd_old, grps_cur, grps_prev, p, new_quarter):
+
+    cfg = config.getConfig()
+
+    pool_names = getPools()
+    if len(pool_names) == 0:
+        return
+    cfg_pools = [cfg['pools'][r] for r in pool_names]
+    is_final_period = (p == cfg['n_periods'] - 1)
+    grps = list(prd_new['groups'].keys())
+    n_grps = len(grps)
+    n_pools = len(pool_names)
+
+    # Final usage and penalties of the previous period. Pools that did not exist in the previous 
+    # period have no allocation there and carry no penalty.
+    grps_old = [grp for grp in grps if (grp in prd_old['groups']) and ('pools' in prd_old['groups'][grp])]
+    if new_quarter:
+        cum_old = getUsageMatrix(grps_prev, grps_old, pool_names)
+    else:
+        cum_old = getUsageMatrix(grps_cur, grps_old, pool_names)
+    start_old = getMatrix(prd_old['groups'], grps_old, pool_names, 'usage_start')
+    alloc_old = getMatrix(prd_old['groups'], grps_old, pool_names, 'alloc', default = None)
+    pen_old = getMatrix(prd_old['groups'], grps_old, pool_names, 'penalty_new')
+    used_old = [[cum_old[i][j] - start_old[i][j] for j in range(n_pools)] for i in range(len(grps_old))]
+
+    pen_grp = {}
+    for i in range(len(grps_old)):
+        pen_grp[grps_old[i]] = [0.0] * n_pools
+        for j in range(n_pools):
+            if alloc_old[i][j] is None:
+                continue
+            prd_old['groups'][grps_old[i]]['pools'][pool_names[j]]['usage'] = used_old[i][j]
+            pen_grp[grps_old[i]][j] = (pen_old[i][j] + max(used_old[i][j] - alloc_old[i][j], 0.0)) \
+                * cfg_pools[j]['penalty_factor']
+    penalty = [pen_grp.get(grp, [0.0] * n_pools) for grp in grps]
+
+    # Available amount of each pool: what remains of the quarter total
+    cum = getUsageMatrix(grps_cur, grps, pool_names)
+    avail = [max(cfg_pools[j]['quarter_total'] - sum([cum[i][j] for i in range(n_grps)]), 0.0) for j in range(n_pools)]
+    if is_final_period:
+        alloc_prd = avail
+    else:
+        alloc_prd = [avail[j] * getAllocFraction(r, p) for j, r in enumerate(pool_names)]
+
+    # Allocate all groups and pools
+    w_frac = [prd_new['groups'][grp]['weight_frac'] for grp in grps]
+    if is_final_period:
+        share = [list(alloc_prd) for i in range(n_grps)]
+        alloc = share
+        pen_new = penalty
+    else:
+        share = [[alloc_prd[j] * w_frac[i] for j in range(n_pools)] for i in range(n_grps)]
+        alloc = [[max(share[i][j] - penalty[i][j], 0.0) for j in range(n_pools)] for i in range(n_grps)]
+        pen_new = [[max(penalty[i][j] - share[i][j], 0.0) for j in range(n_pools)] for i in range(n_grps)]
+    if new_quarter:
+        start = [[0.0] * n_pools for i in range(n_grps)]
+    else:
+        start = cum
+
+    prd_new['pools'] = {}
+    for j in range(n_pools):
+        prd_new['pools'][pool_names[j]] = {'avail': avail[j], 'alloc': alloc_prd[j]}
+    setMatrix(prd_new['groups'], grps, pool_names, 'alloc', alloc)
+    setMatrix(prd_new['groups'], grps, pool_names, 'penalty_old', penalty)
+    setMatrix(prd_new['groups'], grps, pool_names, 'penalty_new', pen_new)
+    setMatrix(prd_new['groups'], grps, pool_names, 'usage_start', start)
+    setMatrix(prd_new['groups'], grps, pool_names, 'usage', [[0.0] * n_pools for i in range(n_grps)])
+
+    return
+
+###################################################################################################
+
+# Update the pool allocations after the weight fractions of the groups changed during a period
+# (see reallocate.py), given the previous fractions and the remaining fraction of the period. Each
+# group's allocation changes by the remaining part of the period's pool allocation times the
+# change in its weight fraction. Groups without an allocation in a pool start with zero usage; in
+# the final period, they receive the full allocation like all other groups.
+
+def reallocatePeriod(prd_cur, grps_cur, wf_old, f_remaining, p):
+
+    cfg = config.getConfig()
+
+    pool_names = [r for r in getPools() if r in prd_cur.get('pools', {})]
+    if len(pool_names) == 0:
+        return
+    is_final_period = (p == cfg['n_periods'] - 1)
+
+    for grp in prd_cur['groups']:
+        grp_data = prd_cur['groups'][grp]
+        if not 'pools' in grp_data:
+            grp_data['pools'] = {}
+        for r in pool_names:
+            is_new = (not r in grp_data['pools'])
+            if is_new:
+                usage_start = grps_cur.get(grp, {}).get('pool_usage', {}).get(r, 0.0)
+                grp_data['pools'][r] = {'alloc': 0.0, 'penalty_old': 0.0, 'penalty_new': 0.0,
+                                        'usage_start': usage_start, 'usage': 0.0}
+            pool = grp_data['pools'][r]
+            if is_final_period:
+                if is_new:
+                    pool['alloc'] = prd_cur['pools'][r]['alloc']
+                continue
+            if is_new:
+                w_frac_old = 0.0
+            else:
+                w_frac_old = wf_old.get(grp, 0.0)
+            x = pool['alloc'] - pool['penalty_new'] \
+                + prd_cur['pools'][r]['alloc'] * f_remaining * (grp_data['weight_frac'] - w_frac_old)
+            pool['alloc'] = max(x, 0.0)
+            pool['penalty_new'] = max(-x, 0.0)
+
+    return
+
+###################################################################################################
+
+# Update the usage of all pools of a group in the current period. Returns a list of the pools whose
+# usage crossed one of their warning levels, as [pool, index of the level]. If a group has no
+# allocation in a pool, the index is None and a warning is sent whenever the usage increases.
+
+def updateGroupUsage(prd_cur, grp, grp_cur):
+
+    cfg = config.getConfig()
+
+    crossed = []
+    if not 'pools' in prd_cur['groups'][grp]:
+        return crossed
+    for r in getPools():
+        if not r in prd_cur['groups'][grp]['pools']:
+            continue
+        pool = prd_cur['groups'][grp]['pools'][r]
+        usage_old = pool['usage']
+        usage_new = grp_cur.get('pool_usage', {}).get(r, 0.0) - pool['usage_start']
+        pool['usage'] = usage_new
+        if pool['alloc'] > 0.0:
+            i = hierarchy.getCrossedLevel(usage_old, usage_new, pool['alloc'], cfg['pools'][r]['warning_levels'])
+            if i >= 0:
+                crossed.append([r, i])
+        elif usage_new > usage_old:
+            crossed.append([r, None])
+
+    return crossed
+
+###################################################################################################
@@ -0,0 +1,186 @@
+###################################################################################################
+#
+# This file is part of the HPC allocator code for the UMD astronomy department
+#
+# (c) Benedikt Diemer
+#
+###################################################################################################
+
+import config
+import messaging
+import hierarchy
+import bucket
+import pools
+
+###################################################################################################
+
+# Incremental reallocation during a period. Groups that were added to the config since the period
+# started are added to it, with zero usage so far, and the weights of groups whose members changed
+# (e.g., because users joined or left) are updated. The period record is updated in place.
+#
+# Only the part of the period allocation that corresponds to the remaining days is re-split. Each
+# group's allocation changes by this remaining allocation times the change in its weight fraction,
+# so that the usage up to now is not affected and the total allocation is conserved. The fractions
+# of the groups whose weight did not change shift only because the total weight changed. Groups
+# whose allocation changed by more than notify_frac, and all groups that were added, are notified.
+#
+# In the final period of a quarter, all groups have access to the full remaining allocation, so
+# that only the added groups receive an allocation. In the continuous mode (see bucket.py), the
+# added groups receive a full bucket, and the new weight fractions change the refill rates.
+
+# Weights that differ by less than this are considered unchanged
+weight_tol = 1E-6
+
+###################################################################################################
+
+def reallocatePeriod(prd_cur, grps_cur, p, date_today, do_send = False):
+
+    cfg = config.getConfig()
+    cfg_ra = cfg['reallocate']
+    is_bucket = ('bucket' in prd_cur)
+    is_final_period = (p == cfg['n_periods'] - 1) and (not is_bucket)
+
+    added = [grp for grp in grps_cur if not grp in prd_cur['groups']]
+    changed = [grp for grp in grps_cur if (grp in prd_cur['groups']) \
+               and (abs(grps_cur[grp]['weight'] - prd_cur['groups'][grp]['weight']) > weight_tol)]
+    if (len(added) == 0) and (len(changed) == 0):
+        return
+
+    print('Reallocating for %d added and %d changed groups...' % (len(added), len(changed)))
+
+    # The allocation weight of each group can differ from its weight if the demand is blended in
+    # (see demand.py). It is scaled with the change of the group's weight; added groups start with
+    # their weight.
+    wf_old = {}
+    alloc_old = {}
+    w_alloc = {}
+    for grp in prd_cur['groups']:
+        grp_data = prd_cur['groups'][grp]
+        wf_old[grp] = grp_data['weight_frac']
+        alloc_old[grp] = grp_data['alloc']
+        w_alloc[grp] = grp_data.get('weight_alloc', grp_data['weight'])
+        if grp in changed:
+            if grp_data['weight'] > 0.0:
+                w_alloc[grp] *= grps_cur[grp]['weight'] / grp_data['weight']
+            else:
+                w_alloc[grp] = grps_cur[grp]['weight']
+    for grp in added:
+        w_alloc[grp] = grps_cur[grp]['weight']
+    w_alloc_tot = sum(w_alloc.values())
+
+    # Update the weights of the changed groups and their users. Users who left no longer count
+    # towards the weights of sub-projects.
+    for grp in changed:
+        grp_data = prd_cur['groups'][grp]
+        print('    Group %-15s weight %.2f -> %.2f.' % (grp, grp_data['weight'], grps_cur[grp]['weight']))
+        grp_data['weight'] = grps_cur[grp]['weight']
+        for usr in grp_data['users']:
+            if usr in grps_cur[grp]['users']:
+                for k in ['weight', 'multi_grp']:
+                    grp_data['users'][usr][k] = grps_cur[grp]['users'][usr][k]
+            else:
+                grp_data['users'][usr]['weight'] = 0.0
+
+    # Add the new groups to the period, as at the start of a period but with the current usage as
+    # the starting point
+    for grp in added:
+        print('    Adding group %s to current period.' % (grp))
+        grp_data = {}
+        for k in grps_cur[grp].keys():
+            if k in ['users', 'su_usage', 'su_quota', 'stale']:
+                continue
+            grp_data[k] = grps_cur[grp][k]
+        grp_data['users'] = {}
+        for usr in grps_cur[grp]['users']:
+            grp_data['users'][usr] = {}
+            for k in grps_cur[grp]['users'][usr].keys():
+                if k == 'su_usage':
+                    continue
+                grp_data['users'][usr][k] = grps_cur[grp]['users'][usr][k]
+            grp_data['users'][usr]['su_usage_start'] = grps_cur[grp]['users'][usr]['su_usage']
+            grp_data['users'][usr]['su_usage'] = 0.0
+        grp_data['su_usage_start'] = grps_cur[grp]['su_usage']
+        grp_data['su_usage'] = 0.0
+        grp_data['alloc'] = 0.0
+        grp_data['penalty_old'] = 0.0
+        grp_data['penalty_new'] = 0.0
+        grp_data['subprojects'] = hierarchy.makeSubprojects(cfg['groups'].get(grp, {}),
+                                                            hierarchy.getWarningLevels(grp_data))
+        for path in grp_data['subprojects']:
+            grp_data['subprojects'][path]['penalty_old'] = 0.0
+            grp_data['subprojects'][path]['su_usage'] = 0.0
+        if 'demand' in prd_cur:
+            grp_data['demand'] = 0.0
+        prd_cur['groups'][grp] = grp_data
+
+    # New weight fractions
+    prd_cur['w_tot'] = sum([prd_cur['groups'][grp]['weight'] for grp in prd_cur['groups']])
+    for grp in prd_cur['groups']:
+        grp_data = prd_cur['groups'][grp]
+        if w_alloc_tot > 0.0:
+            grp_data['weight_frac'] = w_alloc[grp] / w_alloc_tot
+        else:
+            grp_data['weight_frac'] = 0.0
+        if 'demand' in prd_cur:
+            grp_data['weight_alloc'] = w_alloc[grp]
+            if prd_cur['w_tot'] > 0.0:
+                grp_data['weight_frac_static'] = grp_data['weight'] / prd_cur['w_tot']
+            else:
+                grp_data['weight_frac_static'] = 0.0
+
+    # Re-split the remaining allocation
+    n_days = (prd_cur['end_date'] - prd_cur['start_date']).days + 1
+    n_remaining = (prd_cur['end_date'] - date_today).days + 1
+    f_remaining = min(max(n_remaining / n_days, 0.0), 1.0)
+    su_remaining = prd_cur['su_alloc'] * f_remaining
+    for grp in prd_cur['groups']:
+        grp_data = prd_cur['groups'][grp]
+        if is_bucket:
+            if grp in added:
+                bucket.addGroup(prd_cur, grp, p)
+        elif is_final_period:
+            if grp in added:
+                grp_data['alloc'] = prd_cur['su_alloc']
+        else:
+            x = grp_data['alloc'] - grp_data['penalty_new'] + su_remaining * (grp_data['weight_frac'] - wf_old.get(grp, 0.0))
+            grp_data['alloc'] = max(x, 0.0)
+            grp_data['penalty_new'] = max(-x, 0.0)
+        grp_data['alloc_reallocate'] = grp_data.get('alloc_reallocate', 0.0) + grp_data['alloc'] - alloc_old.get(grp, 0.0)
+    pools.reallocatePeriod(prd_cur, grps_cur, wf_old, f_remaining, p)
+
+    # The sub-projects of the groups whose members or allocation changed are split again
+    grps_split = []
+    for grp in prd_cur['groups']:
+        if len(prd_cur['groups'][grp].get('subprojects', {})) == 0:
+            continue
+        if (grp in added) or (grp in changed) or (prd_cur['groups'][grp]['alloc'] != alloc_old[grp]):
+            grps_split.append(grp)
+    if len(grps_split) > 0:
+        tr = hierarchy.buildTree(prd_cur, grps_split)
+        hierarchy.aggregateTree(tr)
+        hierarchy.splitTree(tr, prd_cur)
+        hierarchy.storeTree(tr, prd_cur, ['weight', 'weight_frac'])
+
+    # Record the event and notify the groups whose allocation changed significantly
+    event = {'date': date_today, 'added': list(added), 'changed': list(changed), 'su_remaining': su_remaining,
+             'allocs': {}}
+    for grp in prd_cur['groups']:
+        alloc_new = prd_cur['groups'][grp]['alloc']
+        if grp in added:
+            event['allocs'][grp] = alloc_new
+            print('    Group %-15s fractional weight %.4f, allocation %6.1f kSU.' \
+                  % (grp, prd_cur['groups'][grp]['weight_frac'], alloc_new / 1000.0))
+            messaging.messageReallocation(prd_cur, grp, None, do_send = do_send)
+        elif abs(alloc_new - alloc_old[grp]) > cfg_ra['notify_frac'] * max(alloc_old[grp], 1.0):
+            event['allocs'][grp] = alloc_new
+            print('    Group %-15s fractional weight %.4f -> %.4f, allocation %6.1f -> %6.1f kSU.' \
+                  % (grp, wf_old[grp], prd_cur['groups'][grp]['weight_frac'], alloc_old[grp] / 1000.0,
+                     alloc_new / 1000.0))
+            messaging.messageReallocation(prd_cur, grp, alloc_old[grp], do_send = do_send)
+    if not 'reallocate' in prd_cur:
+        prd_cur['reallocate'] = []
+    prd_cur['reallocate'].append(event)
+
+    return
+
+###################################################################################################
@@ -0,0 +1,118 @@
+###################################################################################################
+#
+# This file is part of the HPC allocator code for the UMD astronomy department
+#
+# (c) Benedikt Diemer
+#
+###################################################################################################
+
+import config
+import messaging
+import hierarchy
+
+###################################################################################################
+
+# Mid-period redistribution of allocation. The usage of each group is extrapolated linearly to the
+# end of the period. Groups whose projected usage is well below their allocation donate part of
+# the projected unused allocation, which is distributed by weight among the groups that are close
+# to or projected to exceed their allocation, up to their projected need. Each group donates at 
+# most once per period. All changes are recorded in the period data, and only the affected groups
+# are notified.
+
+###################################################################################################
+
+def rebalancePeriod(prd_cur, date_today, do_send = False):
+
+    cfg = config.getConfig()
+    cfg_rb = cfg['rebalance']
+
+    n_days = (prd_cur['end_date'] - prd_cur['start_date']).days + 1
+    n_elapsed = (date_today - prd_cur['start_date']).days + 1
+    f_elapsed = min(n_elapsed / n_days, 1.0)
+    if f_elapsed < cfg_rb['min_elapsed']:
+        return
+
+    if not 'rebalance' in prd_cur:
+        prd_cur['rebalance'] = []
+    donated = []
+    for event in prd_cur['rebalance']:
+        donated += list(event['donors'].keys())
+
+    # Find donors and recipients
+    donors = {}
+    recipients = {}
+    for grp in prd_cur['groups']:
+        grp_data = prd_cur['groups'][grp]
+        alloc = grp_data['alloc']
+        if alloc <= 0.0:
+            continue
+        su_proj = grp_data['su_usage'] / f_elapsed
+        if (su_proj < cfg_rb['idle_frac'] * alloc) and (not grp in donated):
+            unused = alloc - max(su_proj * cfg_rb['margin'], grp_data['su_usage'])
+            if unused > 0.0:
+                donors[grp] = unused * cfg_rb['reclaim_frac']
+        elif (grp_data['su_usage'] >= cfg_rb['need_frac'] * alloc) or (su_proj >= alloc):
+            su_need = su_proj * cfg_rb['margin'] - alloc
+            if (grp_data['weight'] > 0.0) and (su_need > 0.0):
+                recipients[grp] = [grp_data['weight'], su_need]
+
+    if (len(donors) == 0) or (len(recipients) == 0):
+        return
+
+    # Distribute the pool by weight, but give no group more than its projected need. Whatever a 
+    # capped group does not take is distributed among the others in the next iteration.
+    su_pool = sum(donors.values())
+    su_add = {}
+    for grp in recipients:
+        su_add[grp] = 0.0
+    su_left = su_pool
+    open_grps = list(recipients.keys())
+    while (su_left > 1.0) and (len(open_grps) > 0):
+        w_tot = 0.0
+        for grp in open_grps:
+            w_tot += recipients[grp][0]
+        su_dist = su_left
+        for grp in list(open_grps):
+            su_share = su_dist * recipients[grp][0] / w_tot
+            su_missing = recipients[grp][1] - su_add[grp]
+            if su_share >= su_missing:
+                su_share = su_missing
+                open_grps.remove(grp)
+            su_add[grp] += su_share
+            su_left -= su_share
+    
+    # Donors give up only what was actually distributed, in proportion to their offers
+    su_moved = su_pool - su_left
+    event = {'date': date_today, 'donors': {}, 'recipients': {}}
+    changes = {}
+    for grp in donors:
+        event['donors'][grp] = donors[grp] * su_moved / su_pool
+        changes[grp] = -event['donors'][grp]
+    for grp in recipients:
+        event['recipients'][grp] = su_add[grp]
+        changes[grp] = su_add[grp]
+    prd_cur['rebalance'].append(event)
+
+    print('Redistributing %.1f kSU from %d to %d groups...' % (su_moved / 1000.0, len(donors), len(recipients)))
+    alloc_old = {}
+    for grp in sorted(changes.keys()):
+        grp_data = prd_cur['groups'][grp]
+        alloc_old[grp] = grp_data['alloc']
+        grp_data['alloc'] = alloc_old[grp] + changes[grp]
+        grp_data['alloc_rebalance'] = grp_data.get('alloc_rebalance', 0.0) + changes[grp]
+        print('    Group %-15s allocation %6.1f -> %6.1f kSU.' % (grp, alloc_old[grp] / 1000.0, grp_data['alloc'] / 1000.0))
+
+    # The sub-projects of the groups whose allocation changed are split again
+    grps_split = [grp for grp in sorted(changes.keys()) if len(prd_cur['groups'][grp].get('subprojects', {})) > 0]
+    if len(grps_split) > 0:
+        tr = hierarchy.buildTree(prd_cur, grps_split)
+        hierarchy.aggregateTree(tr)
+        hierarchy.splitTree(tr, prd_cur)
+        hierarchy.storeTree(tr, prd_cur, ['weight', 'weight_frac'])
+
+    for grp in sorted(changes.keys()):
+        messaging.messageRebalance(prd_cur, grp, alloc_old[grp], do_send = do_send)
+
+    return
+
+###################################################################################################
@@ -6,42 +6,69 @@
 #
 ###################################################################################################
 
+import os
+import glob
 import argparse
-import subprocess
 import copy
-import os
-import yaml
+import time
+import queue
+import datetime
+import getpass
 
 import config
 import utils
 import messaging
+import snapshot
+import cluster
+import enforce
+import lock
+import rebalance
+import reallocate
+import hierarchy
+import pools
+import demand
+import bucket
+import accounting
+import simulate
+import archive
+import scratch
+import membership
+import polling
+import context
+import allocator
 
 ###################################################################################################
 # MODES
 ###################################################################################################
 
-# In test mode, the code can be executed on a machine other than an HPC cluster. The command-line
-# queries are replaced by previously loaded data.
-global test_mode 
-test_mode = False
-
-# If dry_run == True, the function runs but does not set the config to the new dates and saves 
-# emails for review instead of sending them.
-global dry_run
-dry_run = True
-
-###################################################################################################
+# The modes are settings of the active context (see context.py):
+#
+# - In test mode, the code can be executed on a machine other than an HPC cluster. The 
+#   command-line queries are replaced by previously loaded data.
+# - If dry_run == True, the function runs but does not set the config to the new dates and saves 
+#   emails for review instead of sending them.
+# - In a simulation, all state is kept in memory and emails are collected (see simulate.py). The 
+#   limits are computed but not pushed. Per-user records are only written if the state is kept
+#   on disk rather than in an in-memory store. Recordings are replayed in the same way.
+#
+# The command-line interface runs each operation through an allocator (see allocator.py).
 
 def main():
     
-    global test_mode
-    global dry_run
-
     parser = argparse.ArgumentParser(description = 'Welcome to the HPC allocator.')
-    parser.add_argument('-mode', type = str, default = 'check', help = 'Operation, can be check, groupinfo, userlist, or emailtest')
+    parser.add_argument('-mode', type = str, default = 'check', help = 'Operation, can be check, simulate, groupinfo, userlist, scratch, serve, myusage, mails, rollback, lockinfo, or emailtest')
     parser.add_argument('-test', default = False, action = 'store_true', help = 'Test mode, means not run on cluster')
     parser.add_argument('-action', default = False, action = 'store_true', help = 'If true, script is live and emails are sent')
     parser.add_argument('-future', type = int, default = 0, help = 'Run the script as if the date was shifted by this many days')
+    parser.add_argument('-record', type = str, default = None, help = 'Append all cluster commands and their output to this file (check mode)')
+    parser.add_argument('-replay', type = str, default = None, help = 'Replay all runs from a recording instead of querying the cluster (check and simulate modes)')
+    parser.add_argument('-start', type = str, default = None, help = 'First day, as YYYY-MM-DD (simulate and mails modes)')
+    parser.add_argument('-end', type = str, default = None, help = 'Last day, as YYYY-MM-DD (simulate and mails modes)')
+    parser.add_argument('-report', type = str, default = None, help = 'Write the full simulation report including all emails to this file (simulate mode)')
+    parser.add_argument('-grp', type = str, default = None, help = 'Only show emails regarding this group (mails mode)')
+    parser.add_argument('-user', type = str, default = None, help = 'Only show emails to this user (mails mode)')
+    parser.add_argument('-type', type = str, default = None, help = 'Only show emails of this type, e.g., new_period, warning, rebalance, digest (mails mode)')
+    parser.add_argument('-show', default = False, action = 'store_true', help = 'Show the full text of the emails (mails mode)')
 
     args = parser.parse_args()
     mode = args.mode
@@ -49,6 +76,14 @@ def main():
     dry_run = (not args.action)
     future = args.future
 
+    # This mode is run at login by many users at once, so it skips all output and reads only the 
+    # location of the records from the config instead of loading the full config
+    if mode == 'myusage':
+        printMyUsage(snapshot_dir = config.readSetting(context.config_path, 'snapshot_dir'))
+        return
+
+    alloc = allocator.Allocator(test_mode = test_mode, dry_run = dry_run)
+
     utils.printLine()
     print('Welcome to the HPC Allocator')
     utils.printLine()
@@ -56,15 +91,32 @@ def main():
           % (mode, str(test_mode), str(dry_run), future))
     
     if mode == 'check':
-        checkStatus(days_future = future)
+        alloc.check(days_future = future, record_file = args.record, replay_file = args.replay)
+    elif mode == 'simulate':
+        alloc.simulate(args.start, args.end, replay_file = args.replay, report_file = args.report)
     elif mode == 'groupinfo':
-        printCurrentGroups(show_weight = True, show_su = False, show_scratch = False)
+        alloc.run(printCurrentGroups, show_weight = True, show_su = False, show_scratch = False)
     elif mode == 'userlist':
-        printUserEmails()
+        alloc.run(printUserEmails)
     elif mode == 'scratch':
-        printScratchAllocations()
+        alloc.run(printScratchAllocations)
+    elif mode == 'serve':
+        alloc.serve()
+    elif mode == 'mails':
+        date_start = None
+        date_end = None
+        if args.start is not None:
+            date_start = datetime.date.fromisoformat(args.start)
+        if args.end is not None:
+            date_end = datetime.date.fromisoformat(args.end)
+        alloc.run(archive.printMessages, grp = args.grp, usr = args.user, msg_type = args.type, 
+                  date_start = date_start, date_end = date_end, show_content = args.show)
+    elif mode == 'rollback':
+        alloc.run(lock.runExclusive, enforce.rollbackLimits)
+    elif mode == 'lockinfo':
+        alloc.run(lock.printLockInfo)
     elif mode == 'emailtest':
-        messaging.testMessage(do_send = True)
+        alloc.run(messaging.testMessage, do_send = True)
     else:
         raise Exception('Unknown operation, "%s". Allowed are [config, check].' % (mode))
         
@@ -72,6 +124,43 @@ def main():
 
 ###################################################################################################
 
+# Run the check for each department in the config, or for the base config if there are no 
+# departments. All departments share one pass over the cluster data, so that identical queries
+# (such as the bulk scratch query) are only run once. A failure in one department does not stop the
+# others; the errors are raised after all departments have been processed.
+
+def checkDepartments(days_future = 0):
+    
+    depts = config.getDepartments()
+    if len(depts) == 0:
+        checkStatus(days_future = days_future)
+        return
+    
+    failed = []
+    cluster.startSharedPass()
+    try:
+        for dept in depts:
+            utils.printLine()
+            print('Department %s' % (dept))
+            utils.printLine()
+            config.setDepartment(dept)
+            try:
+                checkStatus(days_future = days_future)
+            except Exception as e:
+                print('ERROR: check failed for department %s (%s).' % (dept, str(e)))
+                failed.append(dept)
+    finally:
+        config.setDepartment(None)
+        n_cached = cluster.endSharedPass()
+    print('Checked %d departments using %d distinct cluster queries.' % (len(depts), n_cached))
+    
+    if len(failed) > 0:
+        raise Exception('Check failed for departments %s.' % (str(failed)))
+    
+    return
+
+###################################################################################################
+
 # This function should be executed regularly. It:
 # 
 # - Load the base config (last quarter/period, group allocations for this quarter)
@@ -93,10 +182,9 @@ def checkStatus(days_future = 0, verbose = False):
     
     print('Setting overall config...')
     cfg = config.getConfig()
-    if os.path.exists(cfg['yaml_file_cfg']):
-        pFile = open(cfg['yaml_file_cfg'], 'r')
-        dic_cfg = yaml.safe_load(pFile)
-        pFile.close()
+    ctx = context.get()
+    dic_cfg = utils.readYaml(cfg['yaml_file_cfg'])
+    if dic_cfg is not None:
         prev_q_all = dic_cfg['prev_q_all']
         prev_p = dic_cfg['prev_p']
         prev_d = dic_cfg['prev_d']
@@ -106,6 +194,9 @@ def checkStatus(days_future = 0, verbose = False):
         prev_d = -1
         print('    WARNING: found no previous config. Re-setting variables.')
         
+    if cfg['email_digest']:
+        messaging.startDigest()
+        
     yr, q_yr, q_all, p, d, p_start, p_end = utils.getTimes(days_future = days_future)
     new_quarter = (prev_q_all != q_all)
     new_period = (prev_p != p)
@@ -113,50 +204,12 @@ def checkStatus(days_future = 0, verbose = False):
     print('    Quarter = %d (prev. %d), period = %d (prev. %d), day = %d (prev. %d).' \
           % (q_all, prev_q_all, p, prev_p, d, prev_d))
     
-    # ---------------------------------------------------------------------------------------------
-    # Group data
-
-    print('Setting group data...')
-    grp_file_found = os.path.exists(cfg['yaml_file_grps_cur'])
-
-    if (new_period or new_day or (not grp_file_found)):
-        if grp_file_found:
-            print('    Updating current group data...')
-            pFile = open(cfg['yaml_file_grps_cur'], 'r')
-            dic_grps_prev = yaml.safe_load(pFile)
-            pFile.close()
-            grps_prev = dic_grps_prev['grps_cur']               
-        else:
-            print('    WARNING: could not find file with current group data. Will create from scratch.')
-            grps_prev = {}
-        
-        grps_cur = collectGroupData(verbose = False)
-        print('    Saving current group data to file...')
-        dic_grps = {}
-        dic_grps['grps_cur'] = grps_cur
-        if not dry_run:
-            output_file = open(cfg['yaml_file_grps_cur'], 'w')
-            yaml.dump(dic_grps, output_file)
-            output_file.close()
-        if verbose:
-            utils.printLine()
-            print('    Current group data')
-            utils.printLine()
-            utils.printGroupData(grps_cur)
-            utils.printLine()
-    else:
-        print('    Current group data already up to date, loading from file...')
-        pFile = open(cfg['yaml_file_grps_cur'], 'r')
-        dic_grps = yaml.safe_load(pFile)
-        pFile.close()
-        grps_cur = dic_grps['grps_cur']
-
     # ---------------------------------------------------------------------------------------------
     # Quarter data
 
     print('Setting quarter data...')
     yaml_file_quarter = utils.getYamlNameQuarter(q_all, yr, q_yr)
-    found_yaml_q = os.path.exists(yaml_file_quarter)
+    found_yaml_q = utils.fileExists(yaml_file_quarter)
     
     # We need to refresh the overall usage only if we are starting a new period or if we have no 
     # information.
@@ -178,258 +231,415 @@ def checkStatus(days_future = 0, verbose = False):
         
         # Load previous file
         yaml_file_quarter_prev = utils.getYamlNameQuarter(q_all, yr, q_yr, previous = True)
-        found_yaml_q_prev = os.path.exists(yaml_file_quarter_prev)
-        if found_yaml_q_prev:
-            pFile = open(yaml_file_quarter_prev, 'r')
-            dic_q_prev = yaml.safe_load(pFile)
-            pFile.close()
-        else:
+        dic_q_prev = utils.readYaml(yaml_file_quarter_prev)
+        if dic_q_prev is None:
             print('    WARNING: Could not find data from previous quarter (%s). Will assume this is first quarter.' \
                   % (yaml_file_quarter_prev))
-            dic_q_prev = None  
     else:
-        pFile = open(yaml_file_quarter, 'r')
-        dic_q = yaml.safe_load(pFile)
-        pFile.close()
+        dic_q = utils.readYaml(yaml_file_quarter)
     
     # Shortcut for periods in current quarter
     prds = dic_q['periods']
 
     # ---------------------------------------------------------------------------------------------
-    # Period changes
+    # Group data
+
+    print('Setting group data...')
+    dic_grps_prev = utils.readYaml(cfg['yaml_file_grps_cur'])
+    grp_file_found = (dic_grps_prev is not None)
+    if grp_file_found:
+        grps_prev = dic_grps_prev['grps_cur']               
+    else:
+        print('    WARNING: could not find file with current group data. Will create from scratch.')
+        dic_grps_prev = {}
+        grps_prev = {}
     
-    if new_period:
+    # SU usage and scratch data are refreshed independently, each according to its own interval. 
+    # At the beginning of a period, on each new day, or if we have no data, everything is 
+    # refreshed. SU usage is also refreshed if a group has no data yet (e.g., because its queries
+    # failed when it was first collected).
+    t_now = utils.getNow().timestamp()
+    grps_missing = [grp for grp in cfg['groups'] if not grp in grps_prev]
+    refresh_su = (new_period or new_day or (not grp_file_found) or (len(grps_missing) > 0) \
+                  or utils.isRefreshDue(dic_grps_prev.get('time_su', None), cfg['refresh']['su_usage'], t_now = t_now))
+    refresh_scratch = (new_period or new_day or (not grp_file_found) \
+                  or utils.isRefreshDue(dic_grps_prev.get('time_scratch', None), cfg['refresh']['scratch'], t_now = t_now))
+    
+    # If the membership is read separately, it has its own refresh interval. A change in membership 
+    # does not require any usage queries.
+    refresh_members = membership.isEnabled() and membership.isRefreshDue(t_now = t_now)
+    
+    # With adaptive polling, the SU usage is refreshed only for the groups that are due (see 
+    # polling.py) instead of at fixed intervals, except at the beginning of a period or if we have
+    # no data.
+    poll_state = None
+    su_groups = None
+    if polling.isEnabled():
+        poll_state = polling.loadState()
+        if (not new_period) and grp_file_found:
+            su_groups = polling.getDueGroups(poll_state, t_now)
+            refresh_su = (len(su_groups) > 0)
+            print('    SU usage of %d of %d groups is due to be polled.' % (len(su_groups), len(cfg['groups'])))
+    grps_polled = []
+    if refresh_su:
+        if su_groups is None:
+            grps_polled = list(cfg['groups'].keys())
+        else:
+            grps_polled = su_groups
 
-        # Create new period dataset
-        print('Starting new period...')
-        prds[p] = {}
+    # If there is no new period, each group's usage is checked against its allocation as soon as 
+    # its data arrive, while the other groups are still being collected. Messages are sent from a
+    # background thread in the meantime. A new period needs the total weight of all groups, so 
+    # its allocations are computed once all groups have been collected.
+    messaging.startSender(cfg['cluster']['queue_size'])
+    try:
+        check_usage = (not new_period)
+        users_added = []
+        if check_usage:
+            print('Checking usage against allocations...')
+            prd_cur = prds[p]
         
-        print('    Period runs from %s to %s.' % (p_start.strftime('%Y/%m/%d'), p_end.strftime('%Y/%m/%d')))
-        prds[p]['start_date'] = p_start
-        prds[p]['end_date'] = p_end
-        prds[p]['groups'] = {}
-        
-        # Set shortcuts for new and previous period
-        prd_new = prds[p]
-        if p > 0:
-            prd_old = prds[p - 1]
+        if refresh_su or refresh_scratch or refresh_members:
+            print('    Updating current group data (SU usage %s, scratch %s, membership %s)...' \
+                  % (str(refresh_su), str(refresh_scratch), str(refresh_members)))
+            q_start = p_start - datetime.timedelta(days = cfg['periods'][p]['start_day'])
+            grps_cur = {}
+            for grp, grp_data in streamGroupData(grps_prev = grps_prev, refresh_su = refresh_su, 
+                                        refresh_scratch = refresh_scratch, q_all = q_all, 
+                                        q_start = q_start, p_start = p_start, su_groups = su_groups):
+                grps_cur[grp] = grp_data
+                if check_usage:
+                    checkGroupUsage(prd_cur, grp, grp_data, users_added)
+            
+            # Barrier: the weights depend on the users of all groups. The groups are put back into 
+            # the order of the config, which does not depend on the order in which they arrived.
+            if not ctx.test_mode:
+                grps_cur = {grp: grps_cur[grp] for grp in cfg['groups'] if grp in grps_cur}
+                setGroupWeights(grps_cur)
+            for grp, usr in users_added:
+                for k in ['weight', 'multi_grp']:
+                    prd_cur['groups'][grp]['users'][usr][k] = grps_cur[grp]['users'][usr][k]
+            
+            print('    Saving current group data to file...')
+            dic_grps = {}
+            dic_grps['grps_cur'] = grps_cur
+            for k, refreshed in [['time_su', refresh_su], ['time_scratch', refresh_scratch]]:
+                if refreshed:
+                    dic_grps[k] = t_now
+                else:
+                    dic_grps[k] = dic_grps_prev.get(k, None)
+            if not ctx.dry_run:
+                utils.writeYaml(cfg['yaml_file_grps_cur'], dic_grps)
+            if verbose:
+                utils.printLine()
+                print('    Current group data')
+                utils.printLine()
+                utils.printGroupData(grps_cur)
+                utils.printLine()
         else:
-            if dic_q_prev is not None:
-                prd_old = dic_q_prev['periods'][cfg['n_periods'] - 1]
-            else:
-                prd_old = {}
-                prd_old['groups'] = {}
+            print('    Current group data already up to date, using data from file...')
+            dic_grps = dic_grps_prev
+            grps_cur = dic_grps['grps_cur']
+            if check_usage:
+                for grp in grps_cur:
+                    checkGroupUsage(prd_cur, grp, grps_cur[grp], users_added)
+
+        # -----------------------------------------------------------------------------------------
+        # Period changes
+
+        if new_period:
+
+            # Create new period dataset
+            print('Starting new period...')
+            prds[p] = {}
         
-        # Add groups to period
-        for grp in grps_cur:
-            prd_new['groups'][grp] = {}
-            for k in grps_cur[grp].keys():
-                if k in ['users', 'su_usage', 'su_quota']:
-                    continue
-                prd_new['groups'][grp][k] = grps_cur[grp][k]
-
-        # Compute total weight
-        w_tot_cur = utils.getTotalWeight(grps_cur)
-        prd_new['w_tot'] = w_tot_cur
-
-        # Compute available allocation
-        if p < cfg['n_periods'] - 1:
-            alloc_period = q_su_avail_astr * cfg['periods'][p]['alloc_frac']
-        else:
-            alloc_period = q_su_avail_astr
-        prd_new['su_avail'] = q_su_avail_astr
-        prd_new['su_alloc'] = alloc_period
+            print('    Period runs from %s to %s.' % (p_start.strftime('%Y/%m/%d'), p_end.strftime('%Y/%m/%d')))
+            prds[p]['start_date'] = p_start
+            prds[p]['end_date'] = p_end
+            prds[p]['groups'] = {}
         
-        # Go through groups to assign allocations and notify
-        for grp in grps_cur:
-            
-            # Compute weight
-            w_frac = prd_new['groups'][grp]['weight'] / prd_new['w_tot']
-            prd_new['groups'][grp]['weight_frac'] = w_frac
-
-            # Add current users
-            prd_new['groups'][grp]['users'] = {}
-            for usr in grps_cur[grp]['users']:
-                prd_new['groups'][grp]['users'][usr] = {}
-                for k in grps_cur[grp]['users'][usr].keys():
-                    if k == 'su_usage':
-                        continue
-                    prd_new['groups'][grp]['users'][usr][k] = grps_cur[grp]['users'][usr][k]
-
-            # Compute cumulative usage in the previous period. If this is a new quarter, the usage 
-            # has been reset to zero and we need to use the previous group data. This technically 
-            # misses any usage between the last run of the script and this run, but that is 
-            # inevitable; this info is simply lost.
-            if new_quarter:
-                if grp in grps_prev:
-                    grp_su_usage_cum = grps_prev[grp]['su_usage']
+            # Set shortcuts for new and previous period
+            prd_new = prds[p]
+            if p > 0:
+                prd_old = prds[p - 1]
+            else:
+                if dic_q_prev is not None:
+                    prd_old = dic_q_prev['periods'][cfg['n_periods'] - 1]
                 else:
-                    grp_su_usage_cum = 0.0
-                prd_new['groups'][grp]['su_usage_start'] = 0.0
+                    prd_old = {}
+                    prd_old['groups'] = {}
+        
+            # Add groups to period
+            for grp in grps_cur:
+                prd_new['groups'][grp] = {}
+                for k in grps_cur[grp].keys():
+                    if k in ['users', 'su_usage', 'su_quota', 'stale']:
+                        continue
+                    prd_new['groups'][grp][k] = grps_cur[grp][k]
+
+            # Compute total weight
+            w_tot_cur = utils.getTotalWeight(grps_cur)
+            prd_new['w_tot'] = w_tot_cur
+
+            # Compute available allocation
+            if p < cfg['n_periods'] - 1:
+                alloc_period = q_su_avail_astr * cfg['periods'][p]['alloc_frac']
             else:
-                grp_su_usage_cum = grps_cur[grp]['su_usage']
-                prd_new['groups'][grp]['su_usage_start'] = grp_su_usage_cum
-            prd_new['groups'][grp]['su_usage'] = 0.0
+                alloc_period = q_su_avail_astr
+            prd_new['su_avail'] = q_su_avail_astr
+            prd_new['su_alloc'] = alloc_period
+        
+            # Go through groups to assign allocations and notify
+            for grp in grps_cur:
             
-            # Update old period with final usage and set penalty, if allocation exceeded
-            if grp in prd_old['groups']:
-                prd_old['groups'][grp]['su_usage'] = grp_su_usage_cum - prd_old['groups'][grp]['su_usage_start']
-                penalty_old = prd_old['groups'][grp]['penalty_new']
-                if prd_old['groups'][grp]['su_usage'] > prd_old['groups'][grp]['alloc']:
-                    penalty_old += prd_old['groups'][grp]['su_usage'] - prd_old['groups'][grp]['alloc']
-            else:
-                penalty_old = 0.0
-                
-            # Now repeat the process for individual users. Users could be only in the old or only 
-            # in the new dataset, so we need to consider a superset of possible users and check
-            # whether they are in each set.
-            all_users = []
-            if grp in prd_old['groups']:
-                all_users += list(prd_old['groups'][grp]['users'].keys())
-            all_users += list(prd_new['groups'][grp]['users'].keys())
-            all_users = list(set(all_users))
-            for usr in all_users:
-
-                # Find old cumulative usage
+                # Compute weight
+                w_frac = prd_new['groups'][grp]['weight'] / prd_new['w_tot']
+                prd_new['groups'][grp]['weight_frac'] = w_frac
+
+                # Add current users
+                prd_new['groups'][grp]['users'] = {}
+                for usr in grps_cur[grp]['users']:
+                    prd_new['groups'][grp]['users'][usr] = {}
+                    for k in grps_cur[grp]['users'][usr].keys():
+                        if k == 'su_usage':
+                            continue
+                        prd_new['groups'][grp]['users'][usr][k] = grps_cur[grp]['users'][usr][k]
+
+                # Compute cumulative usage in the previous period. If this is a new quarter, the usage 
+                # has been reset to zero and we need to use the previous group data. This technically 
+                # misses any usage between the last run of the script and this run, but that is 
+                # inevitable; this info is simply lost.
                 if new_quarter:
-                    if (grp in grps_prev) and (usr in grps_prev[grp]['users']):
-                        # User existed in previous quarter, we take the cumulative usage from there
-                        usr_su_usage_cum = grps_prev[grp]['users'][usr]['su_usage']
+                    if grp in grps_prev:
+                        grp_su_usage_cum = grps_prev[grp]['su_usage']
                     else:
-                        # User did not exist in previous quarter
-                        usr_su_usage_cum = 0.0
-                    # In new quarter, cumulative usage always starts at zero
-                    if usr in prd_new['groups'][grp]['users']:
-                        prd_new['groups'][grp]['users'][usr]['su_usage_start'] = 0.0
+                        grp_su_usage_cum = 0.0
+                    prd_new['groups'][grp]['su_usage_start'] = 0.0
                 else:
-                    if usr in prd_new['groups'][grp]['users']:
-                        # User is in current quarter, we take current cumulative usage
-                        usr_su_usage_cum = grps_cur[grp]['users'][usr]['su_usage']
-                        prd_new['groups'][grp]['users'][usr]['su_usage_start'] = usr_su_usage_cum
+                    grp_su_usage_cum = grps_cur[grp]['su_usage']
+                    prd_new['groups'][grp]['su_usage_start'] = grp_su_usage_cum
+                prd_new['groups'][grp]['su_usage'] = 0.0
+            
+                # Update old period with final usage and set penalty, if allocation exceeded
+                if grp in prd_old['groups']:
+                    prd_old['groups'][grp]['su_usage'] = grp_su_usage_cum - prd_old['groups'][grp]['su_usage_start']
+                    penalty_old = prd_old['groups'][grp]['penalty_new']
+                    if prd_old['groups'][grp]['su_usage'] > prd_old['groups'][grp]['alloc']:
+                        penalty_old += prd_old['groups'][grp]['su_usage'] - prd_old['groups'][grp]['alloc']
+                else:
+                    penalty_old = 0.0
+                
+                # Now repeat the process for individual users. Users could be only in the old or only 
+                # in the new dataset, so we need to consider a superset of possible users and check
+                # whether they are in each set.
+                all_users = []
+                if grp in prd_old['groups']:
+                    all_users += list(prd_old['groups'][grp]['users'].keys())
+                all_users += list(prd_new['groups'][grp]['users'].keys())
+                all_users = list(set(all_users))
+                for usr in all_users:
+
+                    # Find old cumulative usage
+                    if new_quarter:
+                        if (grp in grps_prev) and (usr in grps_prev[grp]['users']):
+                            # User existed in previous quarter, we take the cumulative usage from there
+                            usr_su_usage_cum = grps_prev[grp]['users'][usr]['su_usage']
+                        else:
+                            # User did not exist in previous quarter
+                            usr_su_usage_cum = 0.0
+                        # In new quarter, cumulative usage always starts at zero
+                        if usr in prd_new['groups'][grp]['users']:
+                            prd_new['groups'][grp]['users'][usr]['su_usage_start'] = 0.0
                     else:
-                        # User is not in current period, so can only be on this list because they 
-                        # were in the old period.
-                        usr_su_usage_cum = prd_old['groups'][grp]['users'][usr]['su_usage']
+                        if usr in prd_new['groups'][grp]['users']:
+                            # User is in current quarter, we take current cumulative usage
+                            usr_su_usage_cum = grps_cur[grp]['users'][usr]['su_usage']
+                            prd_new['groups'][grp]['users'][usr]['su_usage_start'] = usr_su_usage_cum
+                        else:
+                            # User is not in current period, so can only be on this list because they 
+                            # were in the old period.
+                            usr_su_usage_cum = prd_old['groups'][grp]['users'][usr]['su_usage']
 
-                # Set usage in old period
-                if (grp in prd_old['groups']) and (usr in prd_old['groups'][grp]['users']):
-                    prd_old['groups'][grp]['users'][usr]['su_usage'] = usr_su_usage_cum - prd_old['groups'][grp]['users'][usr]['su_usage_start']
+                    # Set usage in old period
+                    if (grp in prd_old['groups']) and (usr in prd_old['groups'][grp]['users']):
+                        prd_old['groups'][grp]['users'][usr]['su_usage'] = usr_su_usage_cum - prd_old['groups'][grp]['users'][usr]['su_usage_start']
                 
-                # Initialize new period, if user exists
-                if usr in prd_new['groups'][grp]['users']:
-                    prd_new['groups'][grp]['users'][usr]['su_usage'] = 0.0
+                    # Initialize new period, if user exists
+                    if usr in prd_new['groups'][grp]['users']:
+                        prd_new['groups'][grp]['users'][usr]['su_usage'] = 0.0
                 
-            # Multiply penalty by penalty factor
-            penalty_old *= cfg['penalty_factor']
-            
-            # Distinguish the last period in each quarter
-            if p < cfg['n_periods'] - 1:
-                alloc_grp = alloc_period * w_frac
-                if penalty_old <= alloc_grp:
-                    alloc_grp_final = alloc_grp - penalty_old
-                    penalty_new = 0.0
-                else:
-                    alloc_grp_final = 0.0
-                    penalty_new = penalty_old - alloc_grp
-                print('    Group %-15s fractional weight %.4f, allocation %6.1f kSU, penalty %6.1f kSU, final %6.1f kSU.' \
-                      % (grp, w_frac, alloc_grp / 1000.0, penalty_old / 1000.0, alloc_grp_final / 1000.0))
-            else:
-                alloc_grp_final = q_su_avail_astr
-                penalty_new = penalty_old
-                print('    Assigned full remaining allocation to all groups.')
+                # Multiply penalty by penalty factor
+                penalty_old *= cfg['penalty_factor']
+                prd_new['groups'][grp]['penalty_old'] = penalty_old
+                
+                # Set up the sub-projects of the group, if any
+                prd_new['groups'][grp]['subprojects'] = hierarchy.makeSubprojects(cfg['groups'].get(grp, {}), 
+                                                        hierarchy.getWarningLevels(prd_new['groups'][grp]))
+
+            # If enabled, the weights are blended with the demand in the previous period
+            if cfg['demand']['enabled']:
+                demand.applyDemand(prd_new, p_start)
 
-            # Store new data
-            prd_new['groups'][grp]['alloc'] = alloc_grp_final
-            prd_new['groups'][grp]['penalty_old'] = penalty_old
-            prd_new['groups'][grp]['penalty_new'] = penalty_new
+            # The final usage of the sub-projects in the previous period follows from the final 
+            # usage of their users, which has now been set.
+            tr_old = hierarchy.buildTree(prd_old)
+            hierarchy.aggregateTree(tr_old)
+            hierarchy.storeTree(tr_old, prd_old, ['su_usage'])
+            
+            # Split the allocation among the groups and their sub-projects in one pass over the tree.
+            # In the last period of each quarter, all groups get the full remaining allocation.
+            tr = hierarchy.buildTree(prd_new)
+            hierarchy.setPenalties(tr, prd_new, prd_old)
+            hierarchy.aggregateTree(tr)
+            hierarchy.allocateTree(tr, alloc_period, split = (p < cfg['n_periods'] - 1))
+            hierarchy.storeTree(tr, prd_new, ['weight_frac', 'alloc', 'penalty_new'], include_groups = True)
+            hierarchy.storeTree(tr, prd_new, ['weight', 'weight_frac', 'penalty_old', 'su_usage'])
+            
+            # In the continuous mode, the allocations are replaced by the contents of the groups' 
+            # token buckets, which are carried over from the previous period.
+            if bucket.isEnabled():
+                bucket.startPeriod(prd_new, prd_old, p, new_quarter)
+                hierarchy.splitTree(tr, prd_new)
+                print('    Refilling buckets from %.1f kSU over %.1f days, capacity %.1f days.' \
+                      % (prd_new['bucket']['su_remaining'] / 1000.0, prd_new['bucket']['days_left'], 
+                         prd_new['bucket']['capacity_days']))
+            
+            # Allocate the additional resource pools, if any, with the same weights
+            pools.startPeriod(prd_new, prd_old, grps_cur, grps_prev, p, new_quarter)
+            for r in prd_new.get('pools', {}):
+                print('    Pool %-15s %.1f %s available, %.1f %s allocated.' \
+                      % (r, prd_new['pools'][r]['avail'], cfg['pools'][r]['unit'], prd_new['pools'][r]['alloc'], 
+                         cfg['pools'][r]['unit']))
 
             # Write changes to previous period to file
-            if (p == 0) and (dic_q_prev is not None) and (not dry_run):
-                output_file = open(yaml_file_quarter_prev, 'w')
-                yaml.dump(dic_q_prev, output_file)
-                output_file.close()
+            if (p == 0) and (dic_q_prev is not None) and (not ctx.dry_run):
+                utils.writeYaml(yaml_file_quarter_prev, dic_q_prev)
 
-            # Send out email with allocation details, oversubscription warning, usage in previous 
-            # period, penalties if applicable, and so on to the lead. The members receive a 
-            # simplified version that does not state how the allocation was computed.
-            messaging.messageNewPeriod(prd_new, prd_old, p, grp, do_send = (not dry_run))
+            if (p == cfg['n_periods'] - 1) and (not bucket.isEnabled()):
+                print('    Assigned full remaining allocation to all groups.')
+            for grp in grps_cur:
+                grp_new = prd_new['groups'][grp]
+                if bucket.isEnabled():
+                    print('    Group %-15s fractional weight %.4f, refill %6.1f kSU/day, penalty %6.1f kSU, tokens %6.1f kSU.' \
+                          % (grp, grp_new['weight_frac'], grp_new['bucket']['rate'] / 1000.0, 
+                             grp_new['penalty_old'] / 1000.0, grp_new['bucket']['tokens'] / 1000.0))
+                elif p < cfg['n_periods'] - 1:
+                    print('    Group %-15s fractional weight %.4f, allocation %6.1f kSU, penalty %6.1f kSU, final %6.1f kSU.' \
+                          % (grp, grp_new['weight_frac'], alloc_period * grp_new['weight_frac'] / 1000.0, 
+                             grp_new['penalty_old'] / 1000.0, grp_new['alloc'] / 1000.0))
+                    for path in sorted(grp_new['subprojects'].keys()):
+                        sub = grp_new['subprojects'][path]
+                        print('        Sub-project %-23s fractional weight %.4f, penalty %6.1f kSU, final %6.1f kSU.' \
+                              % (path, sub['weight_frac'], sub['penalty_old'] / 1000.0, sub['alloc'] / 1000.0))
 
-    # ---------------------------------------------------------------------------------------------
-    # If there is no new period: Usage warnings
+                # Send out email with allocation details, oversubscription warning, usage in previous 
+                # period, penalties if applicable, and so on to the lead. The members receive a 
+                # simplified version that does not state how the allocation was computed.
+                messaging.messageNewPeriod(prd_new, prd_old, p, grp, do_send = (not ctx.dry_run))
 
-    # For dry runs, we execute the following part since any new period data will not be stored in 
-    # the yaml files.
-    if (not new_period) or dry_run:
+        # -----------------------------------------------------------------------------------------
+        # Demand snapshot
         
-        print('Checking usage against allocations...')
-        prd_cur = prds[p]
-        for grp in grps_cur:
-            
-            # The group could have been added after the period was created.
-            if not grp in prd_cur['groups']:
-                print('    WARNING: Could not find group "%s" in current period.' % (grp))
-                continue
+        # The pending and running work of all groups is recorded at each run (except in test mode,
+        # where there is no cluster). A failed query only means that one sample is missing.
+        demand_state = None
+        if cfg['demand']['enabled'] and (not ctx.test_mode):
+            print('Recording demand...')
+            try:
+                demand_state = demand.pollDemand(p_start)
+            except Exception as e:
+                print('    WARNING: could not record demand (%s).' % (str(e)))
+
+        # -----------------------------------------------------------------------------------------
+        # Usage warnings
+
+        # For dry runs, we check the usage even in a new period since any new period data will not 
+        # be stored in the yaml files.
+        if new_period and ctx.dry_run:
+            print('Checking usage against allocations...')
+            prd_cur = prds[p]
+            for grp in grps_cur:
+                checkGroupUsage(prd_cur, grp, grps_cur[grp], users_added)
         
-            # Update SU usage from cumulative
-            grp_su_usage_old = prd_cur['groups'][grp]['su_usage']
-            grp_su_usage_new = grps_cur[grp]['su_usage'] - prd_cur['groups'][grp]['su_usage_start']
-            prd_cur['groups'][grp]['su_usage'] = grp_su_usage_new
-            
-            # Update HDD data
-            prd_cur['groups'][grp]['scratch_usage'] = grps_cur[grp]['scratch_usage']
-            prd_cur['groups'][grp]['scratch_quota'] = grps_cur[grp]['scratch_quota']
-            
-            # Update individual user data. If a user doesn't exist in the period yet, they were 
-            # presumably just added. 
-            for usr in grps_cur[grp]['users']:
-                if not usr in prd_cur['groups'][grp]['users']:
-                    print('    Adding user %s to group %s.' % (usr, grp))
-                    prd_cur['groups'][grp]['users'][usr] = {}
-                    for k in grps_cur[grp]['users'][usr].keys():
-                        prd_cur['groups'][grp]['users'][usr][k] = grps_cur[grp]['users'][usr][k]
-                    prd_cur['groups'][grp]['users'][usr]['su_usage_start'] = 0.0
-                    prd_cur['groups'][grp]['users'][usr]['su_usage'] = 0.0
-                usr_su_usage_new = grps_cur[grp]['users'][usr]['su_usage'] - prd_cur['groups'][grp]['users'][usr]['su_usage_start']
-                prd_cur['groups'][grp]['users'][usr]['su_usage'] = usr_su_usage_new
-            
-            # Compute fraction of allocation and warn users if necessary. In the case where a 
-            # group has a finite allocation, we check for fractions that exceed a warning level 
-            # but did not exceed it given the old usage (so that emails are only sent once).
-            #          
-            # If a group got an allocation of zero (presumably due to a penalty), we send out an
-            # email every time the absolute usage has changed.
-            su_alloc = prd_cur['groups'][grp]['alloc']
-            if su_alloc > 0.0:
-                usage_prct_old = grp_su_usage_old / su_alloc * 100.0
-                usage_prct_new = grp_su_usage_new / su_alloc * 100.0
-                warned_level = -1
-                if grp_su_usage_new > 0.0:
-                    for ii in range(len(cfg['warning_levels'])):
-                        i = len(cfg['warning_levels']) - ii - 1
-                        if (usage_prct_new > cfg['warning_levels'][i]) and (usage_prct_old <= cfg['warning_levels'][i]):
-                            messaging.messageUsageWarning(prd_cur, grp, i, do_send = (not dry_run))
-                            warned_level = i
-                            break
-                s = '    Group %-15s allocation %6.1f kSU, usage %6.1f -> %6.1f kSU, fraction %5.1f -> %5.1f%%' \
-                      % (grp, su_alloc / 1000.0, grp_su_usage_old / 1000.0, grp_su_usage_new / 1000.0, 
-                         usage_prct_old, usage_prct_new)
-                if warned_level >= 0:
-                    s += ' (%d%% warning)' % (cfg['warning_levels'][warned_level])
-                print(s)
-            else:
-                if grp_su_usage_new > grp_su_usage_old + 1.0:
-                    messaging.messageUsageWarning(prd_cur, grp, None, do_send = (not dry_run))
+        if (not new_period) or ctx.dry_run:
+            date_today = p_start + datetime.timedelta(days = d - cfg['periods'][p]['start_day'])
+
+            # Groups that were added and changes in the weights of groups are incorporated into the
+            # current period, which is updated in place.
+            if cfg['reallocate']['enabled']:
+                reallocate.reallocatePeriod(prd_cur, grps_cur, p, date_today, do_send = (not ctx.dry_run))
+
+            # The refill rates of the token buckets follow the SUs that remain after this check.
+            # Redistribution is not needed in this mode, since idle groups do not accumulate
+            # allocation beyond the capacity of their buckets.
+            if bucket.isEnabled():
+                bucket.updateRates(prd_cur, p)
+
+            # Redistribute allocation that is projected to remain unused. In the final period, all 
+            # groups have access to the full remaining allocation anyway.
+            elif cfg['rebalance']['enabled'] and (p < cfg['n_periods'] - 1):
+                rebalance.rebalancePeriod(prd_cur, date_today, do_send = (not ctx.dry_run))
+
+    finally:
+        send_errors = messaging.stopSender()
+    if len(send_errors) > 0:
+        raise Exception(' '.join(send_errors))
+
+    # ---------------------------------------------------------------------------------------------
+    # Translate allocations into Slurm limits
+
+    # The emails have been sent at this point, so a failed push must not prevent the state from 
+    # being saved; otherwise, the next check would send them again. The limits that were not pushed
+    # remain different from the last pushed limits and are pushed in the next check.
+    if cfg['enforce']['enabled']:
+        print('Updating Slurm limits...')
+        try:
+            enforce.pushLimits(prds[p], do_push = ((not ctx.dry_run) and (not ctx.simulation)))
+        except Exception as e:
+            print('    WARNING: could not update Slurm limits (%s).' % (str(e)))
+
+    # ---------------------------------------------------------------------------------------------
+    # In digest mode, send all collected messages, one per recipient
+
+    if cfg['email_digest']:
+        print('Sending digest emails...')
+        messaging.flushDigest(do_send = (not ctx.dry_run))
 
     # ---------------------------------------------------------------------------------------------
     # Store changes to current quarter/period data and status
 
-    if not dry_run:
+    if not ctx.dry_run:
         
         # Write quarter file
         print('Updating quarter yaml...')
-        output_file = open(yaml_file_quarter, 'w')
-        yaml.dump(dic_q, output_file)
-        output_file.close()
+        utils.writeYaml(yaml_file_quarter, dic_q)
+
+        # Write the snapshot that is served to users; this file is replaced atomically
+        print('Updating usage snapshot...')
+        snap = snapshot.makeSnapshot(prds[p], q_all, p)
+        snapshot.writeSnapshot(snap)
+        if ctx.store is None:
+            snapshot.writeRecords(snap)
+
+        # Write state of the circuit breakers for cluster queries
+        cluster.saveCircuitState()
+
+        # Write checkpoints of the job accounting
+        if cfg['accounting']['enabled']:
+            accounting.saveState()
+
+        # Write the group membership, if it was read in this check
+        if membership.isEnabled():
+            membership.saveState()
+
+        # Write the mean demand of the current period
+        if demand_state is not None:
+            demand.saveState(demand_state)
+
+        # Write the polling schedule, which depends on the usage and allocations after this check
+        if poll_state is not None:
+            polling.updateState(poll_state, prds[p], grps_cur, grps_polled, t_now)
+            polling.saveState(poll_state)
 
         # Write config (after function has successfully run)
         print('Updating config yaml...')
@@ -437,25 +647,245 @@ def checkStatus(days_future = 0, verbose = False):
         dic['prev_q_all'] = q_all
         dic['prev_p'] = p
         dic['prev_d'] = d
-        output_file = open(cfg['yaml_file_cfg'], 'w')
-        yaml.dump(dic, output_file)
-        output_file.close()
+        utils.writeYaml(cfg['yaml_file_cfg'], dic)
     
     return
         
 ###################################################################################################
 
+# Update the usage of one group in the current period and send warnings if the usage crosses one of
+# the warning levels. Users that were added to the period are appended to users_added, since their
+# weights are final only once all groups are known.
+
+def checkGroupUsage(prd_cur, grp, grp_cur, users_added):
+    
+    cfg = config.getConfig()
+    ctx = context.get()
+    
+    # The group could have been added after the period was created. If reallocation is enabled, it
+    # is added to the period once all groups have been collected.
+    if not grp in prd_cur['groups']:
+        if not cfg['reallocate']['enabled']:
+            print('    WARNING: Could not find group "%s" in current period.' % (grp))
+        return
+
+    # If some of the cluster queries for the group failed, the corresponding data are the last 
+    # known values (see collectGroup()). They are checked like current data; since they have not
+    # changed, they do not trigger new warnings by themselves.
+    if grp_cur.get('stale', False):
+        print('    WARNING: Using stale data for group "%s".' % (grp))
+        
+    # Update SU usage from cumulative
+    grp_su_usage_old = prd_cur['groups'][grp]['su_usage']
+    grp_su_usage_new = grp_cur['su_usage'] - prd_cur['groups'][grp]['su_usage_start']
+    prd_cur['groups'][grp]['su_usage'] = grp_su_usage_new
+    
+    # In the continuous mode, the allocation changes with the contents of the group's bucket
+    su_alloc_old = prd_cur['groups'][grp]['alloc']
+    if bucket.isEnabled():
+        bucket.updateGroup(prd_cur, grp)
+    
+    # Update HDD data
+    scratch_usage_old = prd_cur['groups'][grp]['scratch_usage']
+    prd_cur['groups'][grp]['scratch_usage'] = grp_cur['scratch_usage']
+    prd_cur['groups'][grp]['scratch_quota'] = grp_cur['scratch_quota']
+    
+    # Update individual user data. If a user doesn't exist in the period yet, they were 
+    # presumably just added. 
+    for usr in grp_cur['users']:
+        if not usr in prd_cur['groups'][grp]['users']:
+            print('    Adding user %s to group %s.' % (usr, grp))
+            prd_cur['groups'][grp]['users'][usr] = {}
+            for k in grp_cur['users'][usr].keys():
+                prd_cur['groups'][grp]['users'][usr][k] = grp_cur['users'][usr][k]
+            prd_cur['groups'][grp]['users'][usr]['su_usage_start'] = 0.0
+            prd_cur['groups'][grp]['users'][usr]['su_usage'] = 0.0
+            users_added.append([grp, usr])
+        usr_su_usage_new = grp_cur['users'][usr]['su_usage'] - prd_cur['groups'][grp]['users'][usr]['su_usage_start']
+        prd_cur['groups'][grp]['users'][usr]['su_usage'] = usr_su_usage_new
+    
+    # Compute fraction of allocation and warn users if necessary. In the case where a 
+    # group has a finite allocation, we check for fractions that exceed a warning level 
+    # but did not exceed it given the old usage (so that emails are only sent once).
+    #          
+    # If a group got an allocation of zero (presumably due to a penalty), we send out an
+    # email every time the absolute usage has changed.
+    su_alloc = prd_cur['groups'][grp]['alloc']
+    levels = hierarchy.getWarningLevels(prd_cur['groups'][grp])
+    if su_alloc > 0.0:
+        if su_alloc_old > 0.0:
+            usage_prct_old = grp_su_usage_old / su_alloc_old * 100.0
+        else:
+            usage_prct_old = 100.0
+        usage_prct_new = grp_su_usage_new / su_alloc * 100.0
+        warned_level = hierarchy.getCrossedLevel(grp_su_usage_old, grp_su_usage_new, su_alloc, levels,
+                                                 su_alloc_old = su_alloc_old)
+        if warned_level >= 0:
+            messaging.messageUsageWarning(prd_cur, grp, warned_level, do_send = (not ctx.dry_run), 
+                                          top_jobs = getTopJobs(grp))
+        s = '    Group %-15s allocation %6.1f kSU, usage %6.1f -> %6.1f kSU, fraction %5.1f -> %5.1f%%' \
+              % (grp, su_alloc / 1000.0, grp_su_usage_old / 1000.0, grp_su_usage_new / 1000.0, 
+                 usage_prct_old, usage_prct_new)
+        if warned_level >= 0:
+            s += ' (%d%% warning)' % (levels[warned_level])
+        print(s)
+    else:
+        if grp_su_usage_new > grp_su_usage_old + 1.0:
+            messaging.messageUsageWarning(prd_cur, grp, None, do_send = (not ctx.dry_run),
+                                          top_jobs = getTopJobs(grp))
+
+    # The additional resource pools have their own warning levels. All pools that crossed a level
+    # are reported in one message.
+    crossed = pools.updateGroupUsage(prd_cur, grp, grp_cur)
+    if len(crossed) > 0:
+        for r, i in crossed:
+            if i is None:
+                print('    Group %-15s pool %s usage %.1f %s, no allocation' \
+                      % (grp, r, prd_cur['groups'][grp]['pools'][r]['usage'], cfg['pools'][r]['unit']))
+            else:
+                print('    Group %-15s pool %s usage %.1f of %.1f %s (%d%% warning)' \
+                      % (grp, r, prd_cur['groups'][grp]['pools'][r]['usage'], prd_cur['groups'][grp]['pools'][r]['alloc'], 
+                         cfg['pools'][r]['unit'], cfg['pools'][r]['warning_levels'][i]))
+        messaging.messagePoolWarning(prd_cur, grp, crossed, do_send = (not ctx.dry_run))
+
+    # The sub-projects of the group are checked in the same way, with their own allocations and 
+    # warning levels. Their usage is the sum over their users and their own sub-projects.
+    subs = prd_cur['groups'][grp].get('subprojects', {})
+    if len(subs) > 0:
+        tr = hierarchy.buildTree(prd_cur, [grp])
+        hierarchy.aggregateTree(tr)
+        subs_alloc_old = {path: subs[path]['alloc'] for path in subs}
+        if bucket.isEnabled():
+            hierarchy.splitTree(tr, prd_cur)
+        for i in range(2, len(tr['grp'])):
+            path = tr['sub'][i]
+            sub_su_usage_old = subs[path]['su_usage']
+            sub_su_usage_new = tr['su_usage'][i]
+            subs[path]['su_usage'] = sub_su_usage_new
+            if subs[path]['alloc'] > 0.0:
+                warned_level = hierarchy.getCrossedLevel(sub_su_usage_old, sub_su_usage_new, 
+                                                         subs[path]['alloc'], subs[path]['warning_levels'],
+                                                         su_alloc_old = subs_alloc_old[path])
+                if warned_level >= 0:
+                    print('        Sub-project %-23s allocation %6.1f kSU, usage %6.1f -> %6.1f kSU (%d%% warning)' \
+                          % (path, subs[path]['alloc'] / 1000.0, sub_su_usage_old / 1000.0, 
+                             sub_su_usage_new / 1000.0, subs[path]['warning_levels'][warned_level]))
+                    messaging.messageSubprojectWarning(prd_cur, grp, path, warned_level, do_send = (not ctx.dry_run))
+            elif sub_su_usage_new > sub_su_usage_old + 1.0:
+                messaging.messageSubprojectWarning(prd_cur, grp, path, None, do_send = (not ctx.dry_run))
+
+    # The same logic applies to the scratch usage. The scan for files that could be 
+    # deleted is only run when a warning is sent.
+    scratch_quota = prd_cur['groups'][grp]['scratch_quota']
+    if scratch_quota > 0.0:
+        levels = cfg['scratch']['warning_levels']
+        scratch_prct_old = scratch_usage_old / scratch_quota * 100.0
+        scratch_prct_new = prd_cur['groups'][grp]['scratch_usage'] / scratch_quota * 100.0
+        for ii in range(len(levels)):
+            i = len(levels) - ii - 1
+            if (scratch_prct_new > levels[i]) and (scratch_prct_old <= levels[i]):
+                print('    Group %-15s scratch usage %5.1f -> %5.1f%% (%d%% warning)' \
+                      % (grp, scratch_prct_old, scratch_prct_new, levels[i]))
+                messaging.messageScratchWarning(prd_cur, grp, i, scan = scanScratch(grp), 
+                                                do_send = (not ctx.dry_run))
+                break
+
+    return
+
+###################################################################################################
+
+# Run the check once for each run in a recording, at the recorded time and with the recorded 
+# cluster outputs. Since no commands are executed, this reproduces past runs deterministically and 
+# measures the time spent in the allocator itself.
+
+def replayRecording(fname):
+    
+    ctx = context.get()
+    runs = cluster.loadRecording(fname)
+    print('Replaying %d runs from %s...' % (len(runs), fname))
+    
+    # The recorded outputs replace the cluster queries, so the check runs as on the cluster. As in
+    # a simulation, the clock is set to the time of each run and all state is kept in memory, so 
+    # that the runs build on each other without changing the live state or sending emails.
+    test_mode_prev = ctx.test_mode
+    dry_run_prev = ctx.dry_run
+    ctx.test_mode = False
+    ctx.dry_run = False
+    ctx.simulation = True
+    t_tot = 0.0
+    try:
+        with simulate.isolateState():
+            for i in range(len(runs)):
+                ctx.clock = runs[i]['time']
+                utils.printLine()
+                print('Replay run %d of %d, time %s' % (i + 1, len(runs), ctx.clock.strftime('%Y/%m/%d %H:%M:%S')))
+                utils.printLine()
+                cluster.startReplay(runs[i]['cmds'])
+                t0 = time.perf_counter()
+                try:
+                    checkDepartments()
+                finally:
+                    n_left = cluster.stopReplay()
+                dt = time.perf_counter() - t0
+                t_tot += dt
+                print('Replay run %d took %.3f seconds, %d of %d recorded commands unused.' \
+                      % (i + 1, dt, n_left, len(runs[i]['cmds'])))
+            n_emails = len(ctx.outbox)
+    finally:
+        ctx.test_mode = test_mode_prev
+        ctx.dry_run = dry_run_prev
+        ctx.simulation = False
+
+    utils.printLine()
+    print('Replayed %d runs in %.3f seconds, %d emails collected.' % (len(runs), t_tot, n_emails))
+    
+    return
+
+###################################################################################################
+
+# Simulate the check for each day from date_start to date_end (inclusive, given as YYYY-MM-DD) in 
+# one process, see simulate.py. The usage is replayed from a recording if one is given; otherwise,
+# synthetic usage is added to the current group data, which are used as in test mode.
+
+def simulateRange(date_start, date_end, replay_file = None, report_file = None):
+    
+    ctx = context.get()
+    if (date_start is None) or (date_end is None):
+        raise Exception('A simulation needs a start and end date (-start and -end).')
+
+    runs = None
+    if replay_file is not None:
+        runs = cluster.loadRecording(replay_file)
+    
+    test_mode_prev = ctx.test_mode
+    dry_run_prev = ctx.dry_run
+    ctx.test_mode = (runs is None)
+    ctx.dry_run = False
+    ctx.simulation = True
+    try:
+        simulate.runSimulation(checkDepartments, datetime.date.fromisoformat(date_start), 
+                               datetime.date.fromisoformat(date_end), runs = runs, report_file = report_file)
+    finally:
+        ctx.test_mode = test_mode_prev
+        ctx.dry_run = dry_run_prev
+        ctx.simulation = False
+    
+    return
+
+###################################################################################################
+
 # Check the allocation for astronomy for the quarter
 
 def collectAllocation():
 
-    if test_mode:
+    ctx = context.get()
+    if ctx.test_mode:
         alloc_guess = 8333.2 * 1000.0
         return alloc_guess, alloc_guess * 0.5
 
-    ret = subprocess.run(['sbalance', '-account', 'astr'], 
-                         capture_output = True, text = True, check = True)
-    rettxt = ret.stdout
+    cfg = config.getConfig()
+    
+    rettxt = cluster.runCommand(['sbalance', '-account', cfg['slurm_account']])
     ll = rettxt.splitlines()
     w = ll[1].split()
     q_su_quota_astr = float(w[1]) * 1000.0
@@ -503,123 +933,226 @@ def collectUserData(verbose = False):
 
 ###################################################################################################
 
-def collectGroupData(verbose = False):
+# Collect the members, scratch usage, and SU usage of all groups, and yield each group as soon as
+# its data are complete. The groups are collected by a number of worker threads, which put their
+# results into a bounded queue, so that the caller can process each group while the others are 
+# still being collected. The groups are thus not returned in a fixed order, and the user weights 
+# are not final, since users in multiple groups can only be found once all groups are known (see 
+# setGroupWeights()). In test mode, the groups are loaded from file and their weights are final.
+#
+# If refresh_su or refresh_scratch are False, the respective data are taken from grps_prev (if the
+# group exists there). Scratch data are queried for all groups at once if a bulk command is set in 
+# the config, otherwise group by group. SU usage is taken from sbalance or, if job accounting is 
+# enabled, computed from the job records of the quarter starting at q_start (for the period 
+# starting at p_start), which are read for all groups at once. If a list of su_groups is given, the
+# SU usage is refreshed only for these groups.
+
+def streamGroupData(grps_prev = None, refresh_su = True, refresh_scratch = True, q_all = None, 
+                    q_start = None, p_start = None, su_groups = None):
     
     cfg = config.getConfig()
+    ctx = context.get()
     
     # In test mode, we just load a previously determined set of group data
-    if test_mode:
-        pFile = open(cfg['yaml_file_grps_cur'], 'r')
-        dic_grps = yaml.safe_load(pFile)
-        pFile.close()
-        grps_cur = dic_grps['grps_cur']
-        return grps_cur
+    if ctx.test_mode:
+        dic_grps = utils.readYaml(cfg['yaml_file_grps_cur'])
+        if dic_grps is None:
+            raise Exception('Test mode and synthetic simulations require current group data in %s.' \
+                            % (cfg['yaml_file_grps_cur']))
+        for grp in dic_grps['grps_cur']:
+            yield grp, dic_grps['grps_cur'][grp]
+        return
     
+    if grps_prev is None:
+        grps_prev = {}
+        
     # Get user data
     known_users = collectUserData(verbose = False)
     
-    # Get group users
-    groups = copy.copy(cfg['groups'])
-    all_users = {}
-    for grp in groups.keys():
-        
-        groups[grp]['users'] = {}
-        
-        # Analyze scratch_quota to get full user list
-        ret = subprocess.run(['scratch_quota', '--group', 'zt-%s' % (grp), '--users'], 
-                             capture_output = True, text = True, check = True)
-        rettxt = ret.stdout
-        ll = rettxt.splitlines()
-        i = 2
-        w = ll[i].split()
-        if w[0] != 'zt-%s' % (grp):
-            raise Exception('Expected "zt-%s" in third line of output.' % (grp))
+    # Get scratch data for all groups in one pass, if possible
+    scratch_bulk = None
+    if refresh_scratch and (cfg['scratch']['bulk_command'] is not None):
         try:
-            groups[grp]['scratch_quota'] = utils.getSizeFromString(w[3], w[4])
-        except:
-            raise Exception('Could not get scratch quota for group %s, found string %s.' % (grp, ll[i]))
+            scratch_bulk = collectScratchBulk()
+        except Exception as e:
+            print('    WARNING: bulk scratch query failed (%s).' % (str(e)))
+            scratch_bulk = {}
+    
+    # Get the SU usage from the job records of all groups in one pass, if enabled
+    su_bulk = None
+    if refresh_su and cfg['accounting']['enabled']:
+        if su_groups is None:
+            grps_su = list(cfg['groups'].keys())
+        else:
+            grps_su = su_groups
         try:
-            groups[grp]['scratch_usage'] = utils.getSizeFromString(w[1], w[2])
-        except:
-            raise Exception('Could not get scratch usage for group %s, found string %s.' % (grp, ll[i]))
-        i += 1
-        if ll[i].strip() != '# User quotas':
-            raise Exception('Expected "# User quotas" in line 4 of output.')
-        i += 2
-        
-        # Find users in list
-        while i < len(ll):
-            w = ll[i].split()
-            usr = w[0]
-            groups[grp]['users'][usr] = {}
-            groups[grp]['users'][usr]['scratch_usage'] = utils.getSizeFromString(w[1], w[2])
-            
-            # Get user details from known users if possible. Weight may or may not have been set.
-            weight = None
-            user_active = True
-            if usr in known_users:
-                ptype = known_users[usr]['people_type']
-                past_user = known_users[usr]['past_user']
-                if 'active' in known_users[usr]:
-                    user_active = known_users[usr]['active']
-                if 'weight' in known_users[usr]:
-                    weight = known_users[usr]['weight']
-            else:
-                print('    Could not find group %-12s user %-12s in user list. Setting weight to default.' % (grp, usr))
-                ptype = 'tbd'
-                past_user = False
-            
-            # If weight has not been set explicitly, make it zero for past users and dependent on 
-            # people type otherwise.
-            if weight is None:
-                if past_user:
-                    weight = 0.0
-                else:
-                    weight = cfg['people_types'][ptype]['weight']
-            groups[grp]['users'][usr]['people_type'] = ptype
-            groups[grp]['users'][usr]['past_user'] = past_user
-            groups[grp]['users'][usr]['active'] = user_active
-            groups[grp]['users'][usr]['weight'] = weight
-            groups[grp]['users'][usr]['multi_grp'] = False
-            groups[grp]['users'][usr]['su_usage'] = 0.0
-            
-            # Add user to all-list to check for duplicates
-            if usr in all_users:
-                all_users[usr] += 1
-            else:
-                all_users[usr] = 1
-            
-            # Move on to next line in output
-            i += 1
-
-        # Analyze s_balance to get SU usage
-        ret = subprocess.run(['sbalance', '-account', '%s-astr' % (grp), '--all'], 
-                             capture_output = True, text = True, check = True)
-        rettxt = ret.stdout
-        ll = rettxt.splitlines()
-        i = 1
-        w = ll[i].split()
-        groups[grp]['su_quota'] = float(w[1]) * 1000.0
-        i += 2
-        w = ll[i].split()
-        groups[grp]['su_usage'] = float(w[1]) * 1000.0
-        i += 1
-        while i < len(ll):
-            w = ll[i].split()
-            if w[0] != 'User':
-                raise Exception('Expected "User" in sbalance return, found "%s".' % (w[0]))
-            usr = w[1].strip()
-            if not usr in groups[grp]['users']:
-                raise Exception('Found user "%s" in sbalance return but not in group users.' % (usr))
-            groups[grp]['users'][usr]['su_usage'] = float(w[3]) * 1000.0
-            i += 1
-
-    # Add weights, checking for duplicate users
+            su_bulk = accounting.collectSU(grps_su, q_all, q_start, p_start)
+        except Exception as e:
+            print('    WARNING: job accounting query failed (%s).' % (str(e)))
+            su_bulk = {}
+    
+    # Get the members of all groups in one pass, if enabled. Otherwise, or if the queries fail, the
+    # members are taken from the scratch data of each group.
+    members = None
+    if membership.isEnabled():
+        try:
+            members = membership.getMembership()
+        except Exception as e:
+            print('    WARNING: could not get group membership, using scratch data (%s).' % (str(e)))
+    
+    # Start workers that take groups from the list of groups to do and put the results into the 
+    # output queue. Each worker puts None into the queue when it is done.
+    grps_todo = queue.Queue()
+    for grp in cfg['groups']:
+        grps_todo.put(grp)
+    q_out = queue.Queue(maxsize = cfg['cluster']['queue_size'])
+    kwargs = {'grps_prev': grps_prev, 'known_users': known_users, 'scratch_bulk': scratch_bulk, 
+              'su_bulk': su_bulk, 'members': members, 'refresh_su': refresh_su, 'su_groups': su_groups,
+              'refresh_scratch': refresh_scratch}
+    n_workers = max(1, min(cfg['cluster']['workers'], len(cfg['groups'])))
+    for i in range(n_workers):
+        context.startThread(runGroupWorker, args = (grps_todo, q_out, kwargs))
+    
+    n_done = 0
+    while n_done < n_workers:
+        item = q_out.get()
+        if item is None:
+            n_done += 1
+            continue
+        grp, grp_data, err = item
+        if err is not None:
+            raise Exception('Could not collect data for group %s (%s).' % (grp, err))
+        if grp_data is not None:
+            yield grp, grp_data
+    
+    return
+
+###################################################################################################
+
+def runGroupWorker(grps_todo, q_out, kwargs):
+    
+    while True:
+        try:
+            grp = grps_todo.get_nowait()
+        except queue.Empty:
+            break
+        try:
+            q_out.put([grp, collectGroup(grp, **kwargs), None])
+        except Exception as e:
+            q_out.put([grp, None, str(e)])
+    q_out.put(None)
+    
+    return
+
+###################################################################################################
+
+# Collect the data for one group. If the queries for a group fail, we fall back to the last known 
+# good data for that group from grps_prev and mark the group as stale, so that one failing group or
+# backend does not stop the processing of all other groups. If there are no previous data, the 
+# group is skipped (and None is returned) until its queries succeed, since made-up values would
+# become the starting point of its usage in the period.
+
+def collectGroup(grp, grps_prev = None, known_users = None, scratch_bulk = None, su_bulk = None, members = None, 
+                 refresh_su = True, su_groups = None, refresh_scratch = True):
+    
+    cfg = config.getConfig()
+    
+    grp_data = copy.deepcopy(cfg['groups'][grp])
+    grp_data.pop('subprojects', None)
+    grp_data['stale'] = False
+    
+    # Analyze scratch_quota to get scratch usage and, without membership data, the user list
+    try:
+        if (not refresh_scratch) and (grp in grps_prev):
+            scratch_quota, scratch_usage, usr_scratch = getGroupScratchFromData(grps_prev[grp])
+        elif scratch_bulk is not None:
+            if not grp in scratch_bulk:
+                raise Exception('Group not found in bulk scratch data.')
+            scratch_quota, scratch_usage, usr_scratch = scratch_bulk[grp]
+        else:
+            scratch_quota, scratch_usage, usr_scratch = collectGroupScratch(grp)
+    except Exception as e:
+        if not grp in grps_prev:
+            print('    WARNING: could not get scratch data for group %s and found no previous data, skipping group (%s).' \
+                  % (grp, str(e)))
+            return None
+        print('    WARNING: could not get scratch data for group %s, using last known values (%s).' % (grp, str(e)))
+        grp_data['stale'] = True
+        scratch_quota, scratch_usage, usr_scratch = getGroupScratchFromData(grps_prev[grp])
+    grp_data['scratch_quota'] = scratch_quota
+    grp_data['scratch_usage'] = scratch_usage
+    
+    # Set user data from the membership or from the list of scratch users. Members without any
+    # scratch usage have zero usage.
+    if (members is not None) and (grp in members):
+        grp_users = members[grp]
+    else:
+        grp_users = list(usr_scratch.keys())
+    grp_data['users'] = {}
+    for usr in grp_users:
+        grp_data['users'][usr] = makeUserRecord(grp, usr, known_users)
+        grp_data['users'][usr]['scratch_usage'] = usr_scratch.get(usr, 0.0)
+
+    # Analyze s_balance to get SU usage
+    poll_su = refresh_su and ((su_groups is None) or (grp in su_groups))
+    su_from_prev = False
+    try:
+        if (not poll_su) and (grp in grps_prev):
+            su_from_prev = True
+            su_quota, su_usage, usr_su_usage = getGroupSUFromData(grps_prev[grp], grp_data['users'])
+        elif cfg['accounting']['enabled']:
+            if (su_bulk is None) or (not grp in su_bulk):
+                raise Exception('Group not found in job accounting data.')
+            su_quota, su_usage, usr_su_usage = su_bulk[grp]
+        else:
+            su_quota, su_usage, usr_su_usage = collectGroupSU(grp)
+    except Exception as e:
+        if not grp in grps_prev:
+            print('    WARNING: could not get SU usage for group %s and found no previous data, skipping group (%s).' \
+                  % (grp, str(e)))
+            return None
+        print('    WARNING: could not get SU usage for group %s, using last known values (%s).' % (grp, str(e)))
+        su_from_prev = True
+        su_quota, su_usage, usr_su_usage = getGroupSUFromData(grps_prev[grp], grp_data['users'])
+        grp_data['stale'] = True
+    grp_data['su_quota'] = su_quota
+    grp_data['su_usage'] = su_usage
+    
+    # Users with usage this quarter who are no longer members (e.g., because they left the Unix 
+    # group) are kept with zero weight, so that their usage still counts towards the group.
+    for usr in usr_su_usage:
+        if not usr in grp_data['users']:
+            print('    Found user %s with SU usage in group %s but not among its members, adding with zero weight.' \
+                  % (usr, grp))
+            grp_data['users'][usr] = makeUserRecord(grp, usr, known_users)
+            grp_data['users'][usr]['weight'] = 0.0
+            grp_data['users'][usr]['past_user'] = True
+        grp_data['users'][usr]['su_usage'] = usr_su_usage[usr]
+    
+    # The usage of additional resource pools comes from the same job records as the SU usage
+    if len(pools.getPools()) > 0:
+        if su_from_prev:
+            usr_pool_usage = pools.getUserUsageFromData(grps_prev[grp])
+        else:
+            usr_pool_usage = accounting.getPoolUsage(grp)
+        pools.setGroupUsage(grp_data, usr_pool_usage)
+    
+    return grp_data
+
+###################################################################################################
+
+# Set the weights of all groups, reducing the weights of users that are in multiple groups.
+
+def setGroupWeights(groups):
+    
+    all_users = {}
+    for grp in groups:
+        for usr in groups[grp]['users']:
+            all_users[usr] = all_users.get(usr, 0) + 1
+
     for grp in groups.keys():
         w_grp = 0.0
         for usr in groups[grp]['users']:
-            if not usr in all_users:
-                raise Exception('Internal error, did not find user %s in all user list.' % (usr))
             if all_users[usr] > 1:
                 groups[grp]['users'][usr]['weight'] /= all_users[usr]
                 groups[grp]['users'][usr]['multi_grp'] = True
@@ -627,14 +1160,217 @@ def collectGroupData(verbose = False):
             w_grp += groups[grp]['users'][usr]['weight']
         groups[grp]['weight'] = w_grp
     
-    if verbose:
-        utils.printLine()
-        print('Group data')
-        utils.printLine()
-        utils.printGroupData(groups)
-        utils.printLine()
+    return
+
+###################################################################################################
+
+# Create the record for a user in a group, without usage data. The user details are taken from 
+# the known users if possible. The weight may or may not have been set explicitly.
+
+def makeUserRecord(grp, usr, known_users):
+
+    cfg = config.getConfig()
+    
+    weight = None
+    user_active = True
+    if usr in known_users:
+        ptype = known_users[usr]['people_type']
+        past_user = known_users[usr]['past_user']
+        if 'active' in known_users[usr]:
+            user_active = known_users[usr]['active']
+        if 'weight' in known_users[usr]:
+            weight = known_users[usr]['weight']
+    else:
+        print('    Could not find group %-12s user %-12s in user list. Setting weight to default.' % (grp, usr))
+        ptype = 'tbd'
+        past_user = False
+    
+    # If weight has not been set explicitly, make it zero for past users and dependent on 
+    # people type otherwise.
+    if weight is None:
+        if past_user:
+            weight = 0.0
+        else:
+            weight = cfg['people_types'][ptype]['weight']
+    
+    usr_data = {}
+    usr_data['people_type'] = ptype
+    usr_data['past_user'] = past_user
+    usr_data['active'] = user_active
+    usr_data['weight'] = weight
+    usr_data['multi_grp'] = False
+    usr_data['scratch_usage'] = 0.0
+    usr_data['su_usage'] = 0.0
+    
+    return usr_data
+
+###################################################################################################
+
+# Query scratch_quota for a group. Returns the group's quota and usage, and a dictionary of users
+# and their scratch usage.
+
+def collectGroupScratch(grp):
+    
+    rettxt = cluster.runCommand(['scratch_quota', '--group', 'zt-%s' % (grp), '--users'])
+    ll = rettxt.splitlines()
+    i = 2
+    w = ll[i].split()
+    if w[0] != 'zt-%s' % (grp):
+        raise Exception('Expected "zt-%s" in third line of output.' % (grp))
+    try:
+        scratch_quota = utils.getSizeFromString(w[3], w[4])
+    except:
+        raise Exception('Could not get scratch quota for group %s, found string %s.' % (grp, ll[i]))
+    try:
+        scratch_usage = utils.getSizeFromString(w[1], w[2])
+    except:
+        raise Exception('Could not get scratch usage for group %s, found string %s.' % (grp, ll[i]))
+    i += 1
+    if ll[i].strip() != '# User quotas':
+        raise Exception('Expected "# User quotas" in line 4 of output.')
+    i += 2
+    
+    # Find users in list
+    usr_scratch = {}
+    while i < len(ll):
+        w = ll[i].split()
+        usr_scratch[w[0]] = utils.getSizeFromString(w[1], w[2])
+        i += 1
+    
+    return scratch_quota, scratch_usage, usr_scratch
+
+###################################################################################################
+
+# The largest jobs of a group in the current period are only known if job accounting is enabled.
+
+def getTopJobs(grp):
+    
+    cfg = config.getConfig()
+    
+    if (not cfg['accounting']['enabled']) or (cfg['accounting']['top_jobs'] <= 0):
+        return None
+    
+    return accounting.getTopJobs(grp)
+
+###################################################################################################
+
+# Scan the scratch directory of a group for files that could be deleted. The scan is skipped if no 
+# path is configured, in test mode, and in simulations; a failed scan does not stop the warning.
+
+def scanScratch(grp):
+    
+    cfg = config.getConfig()
+    ctx = context.get()
+    
+    if (cfg['scratch']['path'] is None) or ctx.test_mode or ctx.simulation:
+        return None
+    
+    try:
+        scan = scratch.scanGroup(grp)
+    except Exception as e:
+        print('    WARNING: could not scan scratch directory of group %s (%s).' % (grp, str(e)))
+        scan = None
+    
+    return scan
+
+###################################################################################################
+
+# Query scratch data for all groups at once. The bulk command must return the same output as 
+# scratch_quota for each group, one block after the other. Returns a dictionary of groups with the
+# same data as collectGroupScratch().
+
+def collectScratchBulk():
+    
+    cfg = config.getConfig()
+    
+    rettxt = cluster.runCommand(cfg['scratch']['bulk_command'])
+    ll = rettxt.splitlines()
+    
+    scratch_bulk = {}
+    grp = None
+    in_users = False
+    for i in range(len(ll)):
+        w = ll[i].split()
+        if len(w) == 0:
+            continue
         
-    return groups
+        # A new group block starts with a line "zt-<grp> <usage> <unit> <quota> <unit>"
+        if w[0].startswith('zt-') and (len(w) >= 5):
+            grp = w[0][3:]
+            try:
+                scratch_quota = utils.getSizeFromString(w[3], w[4])
+                scratch_usage = utils.getSizeFromString(w[1], w[2])
+            except:
+                raise Exception('Could not get scratch quota or usage for group %s, found string %s.' % (grp, ll[i]))
+            scratch_bulk[grp] = [scratch_quota, scratch_usage, {}]
+            in_users = False
+            continue
+        if (grp is not None) and (ll[i].strip() == '# User quotas'):
+            in_users = True
+            continue
+        
+        # Inside a user block, every line with a valid size is a user; headers and separators are 
+        # skipped.
+        if in_users and (len(w) >= 3):
+            try:
+                scratch_bulk[grp][2][w[0]] = utils.getSizeFromString(w[1], w[2])
+            except:
+                pass
+    
+    return scratch_bulk
+
+###################################################################################################
+
+# Get the scratch and SU data of a group from previously collected group data, in the same format
+# as returned by the cluster queries. For the SU usage, only the given users are considered.
+
+def getGroupScratchFromData(grp_data):
+    
+    usr_scratch = {}
+    for usr in grp_data['users']:
+        usr_scratch[usr] = grp_data['users'][usr]['scratch_usage']
+    
+    return grp_data['scratch_quota'], grp_data['scratch_usage'], usr_scratch
+
+###################################################################################################
+
+def getGroupSUFromData(grp_data, users):
+    
+    usr_su_usage = {}
+    for usr in grp_data['users']:
+        if usr in users:
+            usr_su_usage[usr] = grp_data['users'][usr]['su_usage']
+    
+    return grp_data['su_quota'], grp_data['su_usage'], usr_su_usage
+
+###################################################################################################
+
+# Query sbalance for a group. Returns the group's SU quota and usage, and a dictionary of users and
+# their SU usage.
+
+def collectGroupSU(grp):
+    
+    cfg = config.getConfig()
+    
+    rettxt = cluster.runCommand(['sbalance', '-account', '%s-%s' % (grp, cfg['slurm_account']), '--all'])
+    ll = rettxt.splitlines()
+    i = 1
+    w = ll[i].split()
+    su_quota = float(w[1]) * 1000.0
+    i += 2
+    w = ll[i].split()
+    su_usage = float(w[1]) * 1000.0
+    i += 1
+    usr_su_usage = {}
+    while i < len(ll):
+        w = ll[i].split()
+        if w[0] != 'User':
+            raise Exception('Expected "User" in sbalance return, found "%s".' % (w[0]))
+        usr = w[1].strip()
+        usr_su_usage[usr] = float(w[3]) * 1000.0
+        i += 1
+    
+    return su_quota, su_usage, usr_su_usage
 
 ###################################################################################################
 
@@ -642,12 +1378,9 @@ def getGroupDataFromFile():
 
     cfg = config.getConfig()
     
-    if not os.path.exists(cfg['yaml_file_grps_cur']):
+    dic_grps = utils.readYaml(cfg['yaml_file_grps_cur'])
+    if dic_grps is None:
         raise Exception('Could not find yaml file for current groups.')
-
-    pFile = open(cfg['yaml_file_grps_cur'], 'r')
-    dic_grps = yaml.safe_load(pFile)
-    pFile.close()
     
     return dic_grps
 
@@ -707,6 +1440,36 @@ def printScratchAllocations():
     
     return
 
+###################################################################################################
+
+# Print the record of the calling user from the precomputed snapshot. The record is a plain text
+# file. If the snapshot directory is given, the config is not loaded, so that this mode reads only
+# one line of the config file and one small record file. With several departments, each has its
+# own directory within the snapshot directory (see config.py), and the records of the user in all
+# departments are printed.
+
+def printMyUsage(usr = None, snapshot_dir = None):
+
+    if snapshot_dir is None:
+        snapshot_dir = config.getConfig()['snapshot_dir']
+    if usr is None:
+        usr = getpass.getuser()
+    fnames = [snapshot.getRecordFile(usr, snapshot_dir)]
+    fnames += sorted(glob.glob(snapshot.getRecordFile(usr, os.path.join(snapshot_dir, '*'))))
+    n_found = 0
+    for fname in fnames:
+        try:
+            f = open(fname, 'r')
+        except FileNotFoundError:
+            continue
+        print(f.read(), end = '')
+        f.close()
+        n_found += 1
+    if n_found == 0:
+        print('No usage information found for user %s.' % (usr))
+    
+    return
+
 ###################################################################################################
 # Trigger
 ###################################################################################################
@@ -0,0 +1,273 @@
+###################################################################################################
+#
+# This file is part of the HPC allocator code for the UMD astronomy department
+#
+# (c) Benedikt Diemer
+#
+###################################################################################################
+
+import os
+import pwd
+import gzip
+import json
+import time
+import heapq
+import hashlib
+import multiprocessing
+import concurrent.futures
+
+import config
+
+###################################################################################################
+
+# Scanner for files that could be deleted from a group's scratch directory. The tree is split into
+# partitions (subdirectories near the top of the tree), which are walked in parallel by a pool of
+# processes using os.scandir. For each user, the scan finds the total size and number of files as
+# well as the largest and the oldest (least recently modified) files. Only a fixed number of files
+# is kept per user, so that the memory needed does not depend on the size of the tree.
+#
+# The scans are incremental. For each directory, the results for the files it contains directly
+# and the list of its subdirectories are cached, together with its modification time. If the
+# modification time has not changed, no files were added, removed, or renamed in the directory, and
+# the cached results are used without listing the directory or looking at its files. Since files
+# can still grow without changing the directory, the cache is ignored once it is older than the
+# configured maximum age. The cache is stored per partition, so that each process only reads and
+# writes its own part.
+
+###################################################################################################
+
+# Add a file to the per-user summary [n_files, size, largest, oldest]. The largest and oldest lists
+# are heaps of at most n_top entries [size, mtime, path] and [-mtime, size, path].
+
+def addFile(summary, uid, size, mtime, path, n_top):
+
+    if not uid in summary:
+        summary[uid] = [0, 0, [], []]
+    s = summary[uid]
+    s[0] += 1
+    s[1] += size
+
+    item = [size, mtime, path]
+    if len(s[2]) < n_top:
+        heapq.heappush(s[2], item)
+    elif item > s[2][0]:
+        heapq.heapreplace(s[2], item)
+
+    item = [-mtime, size, path]
+    if len(s[3]) < n_top:
+        heapq.heappush(s[3], item)
+    elif item > s[3][0]:
+        heapq.heapreplace(s[3], item)
+
+    return
+
+###################################################################################################
+
+# Merge the summary src into dest, keeping at most n_top files in each list.
+
+def mergeSummary(dest, src, n_top):
+
+    for uid in src:
+        if not uid in dest:
+            dest[uid] = [0, 0, [], []]
+        d = dest[uid]
+        s = src[uid]
+        d[0] += s[0]
+        d[1] += s[1]
+        for i in [2, 3]:
+            for item in s[i]:
+                if len(d[i]) < n_top:
+                    heapq.heappush(d[i], list(item))
+                elif list(item) > d[i][0]:
+                    heapq.heapreplace(d[i], list(item))
+
+    return
+
+###################################################################################################
+
+# Walk one partition of the tree. This function runs in a worker process. The cache file contains
+# the results of the previous scan of the same partition; paths in the results are relative to
+# the root of the group's tree.
+
+def scanPartition(root, part, cache_file, n_top, max_age):
+
+    cache = {}
+    if os.path.exists(cache_file):
+        try:
+            f = gzip.open(cache_file, 'rt')
+            dic = json.load(f)
+            f.close()
+            if time.time() - dic['time'] < max_age:
+                cache = dic['dirs']
+        except Exception:
+            cache = {}
+
+    cache_new = {}
+    summary = {}
+    n_scanned = 0
+    n_reused = 0
+    stack = [part]
+    while len(stack) > 0:
+        rel_dir = stack.pop()
+        full_dir = os.path.join(root, rel_dir)
+        try:
+            mtime_dir = os.lstat(full_dir).st_mtime_ns
+        except OSError:
+            continue
+
+        if (rel_dir in cache) and (cache[rel_dir]['m'] == mtime_dir):
+            c = cache[rel_dir]
+            n_reused += 1
+        else:
+            c = {'m': mtime_dir, 'd': [], 'f': {}}
+            try:
+                with os.scandir(full_dir) as it:
+                    for entry in it:
+                        try:
+                            if entry.is_dir(follow_symlinks = False):
+                                c['d'].append(entry.name)
+                                continue
+                            if not entry.is_file(follow_symlinks = False):
+                                continue
+                            st = entry.stat(follow_symlinks = False)
+                        except OSError:
+                            continue
+                        addFile(c['f'], str(st.st_uid), st.st_size, int(st.st_mtime),
+                                os.path.join(rel_dir, entry.name), n_top)
+            except OSError:
+                continue
+            n_scanned += 1
+
+        cache_new[rel_dir] = c
+        mergeSummary(summary, c['f'], n_top)
+        for d in c['d']:
+            stack.append(os.path.join(rel_dir, d))
+
+    f = gzip.open(cache_file + '.tmp', 'wt')
+    json.dump({'time': time.time(), 'dirs': cache_new}, f)
+    f.close()
+    os.replace(cache_file + '.tmp', cache_file)
+
+    return summary, n_scanned, n_reused
+
+###################################################################################################
+
+# Split the tree into partitions for the workers. Directories are split level by level until there
+# are enough partitions for all processes; files found along the way are added to the summary.
+
+def getPartitions(root, n_proc, summary, n_top, max_depth = 3):
+
+    parts = ['']
+    for depth in range(max_depth):
+        if len(parts) >= 2 * n_proc:
+            break
+        parts_new = []
+        for part in parts:
+            try:
+                with os.scandir(os.path.join(root, part)) as it:
+                    for entry in it:
+                        try:
+                            if entry.is_dir(follow_symlinks = False):
+                                parts_new.append(os.path.join(part, entry.name))
+                            elif entry.is_file(follow_symlinks = False):
+                                st = entry.stat(follow_symlinks = False)
+                                addFile(summary, str(st.st_uid), st.st_size, int(st.st_mtime),
+                                        os.path.join(part, entry.name), n_top)
+                        except OSError:
+                            continue
+            except OSError:
+                continue
+        parts = parts_new
+
+    return parts
+
+###################################################################################################
+
+def getUserName(uid, names):
+
+    if not uid in names:
+        try:
+            names[uid] = pwd.getpwuid(int(uid)).pw_name
+        except KeyError:
+            names[uid] = uid
+
+    return names[uid]
+
+###################################################################################################
+
+# The scans run while other threads are active (see run.py). Processes that are forked from this
+# process could inherit locks held by those threads and deadlock, so they are started from a fork
+# server instead, which has only one thread, or spawned where there is no fork server.
+
+def getPoolContext():
+
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+
+    return multiprocessing.get_context('spawn')
+
+###################################################################################################
+
+# Scan the scratch tree of a group. Returns a dictionary with the root directory and, for each
+# user, the number of files, the total size in GB, and the largest and oldest files as lists of
+# [path, size in GB, modification time], sorted by size and age, respectively.
+
+def scanGroup(grp, verbose = True):
+
+    cfg = config.getConfig()
+    cfg_s = cfg['scratch']
+
+    root = cfg_s['path'].replace('{grp}', grp)
+    if not os.path.isdir(root):
+        raise Exception('Could not find scratch directory %s.' % (root))
+    cache_dir = os.path.join(cfg_s['scan_dir'], grp)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    n_top = cfg_s['scan_top']
+    max_age = cfg_s['scan_max_age'] * 86400.0
+
+    t0 = time.time()
+    summary = {}
+    parts = getPartitions(root, cfg_s['scan_processes'], summary, n_top)
+    cache_files = []
+    for part in parts:
+        cache_files.append(os.path.join(cache_dir, hashlib.md5(part.encode()).hexdigest() + '.json.gz'))
+
+    n_scanned = 0
+    n_reused = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers = cfg_s['scan_processes'],
+                                                mp_context = getPoolContext()) as pool:
+        futures = []
+        for i in range(len(parts)):
+            futures.append(pool.submit(scanPartition, root, parts[i], cache_files[i], n_top, max_age))
+        for fut in futures:
+            s, n_s, n_r = fut.result()
+            mergeSummary(summary, s, n_top)
+            n_scanned += n_s
+            n_reused += n_r
+
+    # Remove caches of partitions that no longer exist
+    for fn in os.listdir(cache_dir):
+        if not os.path.join(cache_dir, fn) in cache_files:
+            os.remove(os.path.join(cache_dir, fn))
+
+    scan = {'root': root, 'time': time.time(), 'users': {}}
+    names = {}
+    for uid in summary:
+        s = summary[uid]
+        usr = getUserName(uid, names)
+        largest = []
+        for size, mtime, path in sorted(s[2], reverse = True):
+            largest.append([path, size / 1024.0**3, mtime])
+        oldest = []
+        for neg_mtime, size, path in sorted(s[3], reverse = True):
+            oldest.append([path, size / 1024.0**3, -neg_mtime])
+        scan['users'][usr] = {'n_files': s[0], 'size': s[1] / 1024.0**3, 'largest': largest, 'oldest': oldest}
+
+    if verbose:
+        print('    Scanned scratch directory of group %s in %.1f seconds (%d partitions, %d directories listed, %d unchanged).' \
+              % (grp, time.time() - t0, len(parts), n_scanned, n_reused))
+
+    return scan
+
+###################################################################################################
@@ -0,0 +1,192 @@
+###################################################################################################
+#
+# This file is part of the HPC allocator code for the UMD astronomy department
+#
+# (c) Benedikt Diemer
+#
+###################################################################################################
+
+import os
+import json
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import config
+import context
+import snapshot
+
+###################################################################################################
+
+# The server never computes anything per request. Whenever a new snapshot file appears, all
+# responses are rendered once into a dictionary that maps paths to encoded bodies. This dictionary
+# is replaced as a whole, so request threads see either the old or the new set of responses. The
+# responses are kept in the context (see context.py) of the server, which the request threads 
+# activate.
+
+content_type_json = 'application/json; charset=utf-8'
+content_type_metrics = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+# Minimum time in seconds between two checks of the snapshot file's modification time
+check_interval = 1.0
+
+###################################################################################################
+
+def jsonBody(dic):
+
+    return json.dumps(dic, sort_keys = True, indent = 1).encode('utf-8')
+
+###################################################################################################
+
+# Render the snapshot in the OpenMetrics text format. Label values are group and user names, which
+# cannot contain quotes or backslashes.
+
+def metricsBody(snap):
+
+    ll = []
+
+    ll.append('# TYPE hpc_period gauge')
+    ll.append('# HELP hpc_period Index of the current allocation period within the quarter.')
+    ll.append('hpc_period{quarter="%d",label="%s"} %d' % (snap['quarter'], snap['period_label'], snap['period']))
+
+    for name, key, desc in [['hpc_group_alloc_su', 'alloc', 'Allocation of the group in the current period (SU).'],
+                            ['hpc_group_usage_su', 'su_usage', 'Usage of the group in the current period (SU).'],
+                            ['hpc_group_scratch_usage_gb', 'scratch_usage', 'Scratch usage of the group (GB).'],
+                            ['hpc_group_scratch_quota_gb', 'scratch_quota', 'Scratch quota of the group (GB).']]:
+        ll.append('# TYPE %s gauge' % (name))
+        ll.append('# HELP %s %s' % (name, desc))
+        for grp in sorted(snap['groups'].keys()):
+            ll.append('%s{group="%s"} %.1f' % (name, grp, snap['groups'][grp][key]))
+
+    ll.append('# TYPE hpc_user_usage_su gauge')
+    ll.append('# HELP hpc_user_usage_su Usage of the user in the current period (SU).')
+    for usr in sorted(snap['users'].keys()):
+        for grp in sorted(snap['users'][usr]['groups'].keys()):
+            ll.append('hpc_user_usage_su{group="%s",user="%s"} %.1f' \
+                      % (grp, usr, snap['users'][usr]['groups'][grp]['su_usage']))
+
+    ll.append('# EOF')
+    body = ('\n'.join(ll) + '\n').encode('utf-8')
+
+    return body
+
+###################################################################################################
+
+def renderResponses(snap):
+
+    resp = {}
+
+    prd_info = {}
+    for k in ['time', 'quarter', 'period', 'period_label', 'start_date', 'end_date']:
+        prd_info[k] = snap[k]
+    summary = dict(prd_info)
+    summary['groups'] = sorted(list(snap['groups'].keys()))
+    resp['/'] = (content_type_json, jsonBody(summary))
+
+    for grp in snap['groups']:
+        dic = dict(prd_info)
+        dic['group'] = grp
+        dic.update(snap['groups'][grp])
+        resp['/groups/%s' % (grp)] = (content_type_json, jsonBody(dic))
+    for usr in snap['users']:
+        dic = dict(prd_info)
+        dic['user'] = usr
+        dic.update(snap['users'][usr])
+        resp['/users/%s' % (usr)] = (content_type_json, jsonBody(dic))
+    resp['/groups'] = (content_type_json, jsonBody(snap['groups']))
+    resp['/metrics'] = (content_type_metrics, metricsBody(snap))
+
+    return resp
+
+###################################################################################################
+
+# Check whether the snapshot file has changed and, if so, re-render all responses. Only one thread
+# performs the check at a time; others keep serving the current responses in the meantime.
+
+def refreshResponses(force = False):
+
+    cfg = config.getConfig()
+    ctx = context.get()
+
+    t = time.monotonic()
+    if (not force) and (t - ctx.server_last_check < check_interval):
+        return
+    if not ctx.server_lock.acquire(blocking = force):
+        return
+
+    try:
+        ctx.server_last_check = t
+        try:
+            mtime = os.stat(cfg['snapshot_file']).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == ctx.server_mtime:
+            return
+        ctx.server_responses = renderResponses(snapshot.loadSnapshot())
+        ctx.server_mtime = mtime
+        print('Loaded snapshot with %d responses.' % (len(ctx.server_responses)))
+    finally:
+        ctx.server_lock.release()
+
+    return
+
+###################################################################################################
+
+class StatusHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+
+        with context.activate(self.server.context):
+            refreshResponses()
+        responses = self.server.context.server_responses
+        path = self.path.split('?')[0]
+        if (len(path) > 1) and path.endswith('/'):
+            path = path[:-1]
+        resp = responses.get(path, None)
+
+        if resp is None:
+            if len(responses) == 0:
+                self.send_error(503, 'No snapshot available')
+            else:
+                self.send_error(404, 'Unknown path')
+            return
+
+        content_type, body = resp
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'max-age=%d' % (int(check_interval)))
+        self.end_headers()
+        self.wfile.write(body)
+
+        return
+
+    # Requests are frequent and uninteresting, so we do not log them
+    def log_message(self, format, *args):
+
+        return
+
+###################################################################################################
+
+def serve(host = None, port = None):
+
+    cfg = config.getConfig()
+
+    if host is None:
+        host = cfg['server_host']
+    if port is None:
+        port = cfg['server_port']
+
+    refreshResponses(force = True)
+    httpd = ThreadingHTTPServer((host, port), StatusHandler)
+    httpd.daemon_threads = True
+    httpd.context = context.get()
+    print('Serving usage snapshots on http://%s:%d/ ...' % (host, port))
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    httpd.server_close()
+
+    return
+
+###################################################################################################
@@ -0,0 +1,268 @@
+###################################################################################################
+#
+# This file is part of the HPC allocator code for the UMD astronomy department
+#
+# (c) Benedikt Diemer
+#
+###################################################################################################
+
+import os
+import zlib
+import contextlib
+import datetime
+import yaml
+
+import config
+import utils
+import context
+import cluster
+
+###################################################################################################
+
+# Simulation of the check over a range of days in one process. A simulated clock is advanced day by
+# day, and the full check is run for each day. State files are read from disk when they are first
+# needed but written only to an in-memory store, so that the simulation starts from the current
+# state without changing it. Emails are collected instead of being saved or sent.
+#
+# The usage is either replayed from a recording of cluster commands, in which case only days with
+# recorded runs are simulated, or synthetic. Synthetic usage is added to the current group data
+# (which are used as in test mode) after each day. Each group uses its share of the period's
+# allocation at a rate that differs between groups, so that some groups stay below their
+# allocation and others exceed it.
+
+###################################################################################################
+
+# Replace the clock, store, and outbox of the active context for the duration of a with block, so
+# that state files are written only to an in-memory store and emails are collected in the outbox.
+# The circuit breaker, accounting, and membership states start fresh; they are read from disk (or
+# the context's own store) when needed. All of these are restored at the end of the block. This is
+# used by simulations and by the replay of recordings (see replayRecording() in run.py).
+
+@contextlib.contextmanager
+def isolateState():
+
+    ctx = context.get()
+    clock_prev = ctx.clock
+    store_prev = ctx.store
+    outbox_prev = ctx.outbox
+    if store_prev is None:
+        ctx.store = {}
+    else:
+        ctx.store = dict(store_prev)
+    ctx.outbox = []
+    ctx.circuit_state = None
+    ctx.accounting_states = {}
+    ctx.membership_state = None
+
+    try:
+        yield ctx
+    finally:
+        ctx.clock = clock_prev
+        ctx.store = store_prev
+        ctx.outbox = outbox_prev
+        ctx.circuit_state = None
+        ctx.accounting_states = {}
+        ctx.membership_state = None
+
+    return
+
+###################################################################################################
+
+def runSimulation(check_func, date_start, date_end, runs = None, report_file = None):
+
+    if date_end < date_start:
+        raise Exception('End date of simulation (%s) is before start date (%s).' % (str(date_end), str(date_start)))
+
+    days = []
+    with isolateState() as ctx:
+        q_last = None
+        date = date_start
+        while date <= date_end:
+
+            if runs is None:
+                runs_day = [None]
+            else:
+                runs_day = []
+                for run in runs:
+                    if run['date'] == date.isoformat():
+                        runs_day.append(run)
+                if len(runs_day) == 0:
+                    print('No recorded runs on %s, skipping day.' % (date.strftime('%Y/%m/%d')))
+
+            # Several runs on one day are spread evenly over the day
+            for i in range(len(runs_day)):
+                ctx.clock = datetime.datetime.combine(date, datetime.time()) \
+                    + datetime.timedelta(days = (i + 1) / (len(runs_day) + 1))
+                utils.printLine()
+                print('Simulating %s' % (ctx.clock.strftime('%Y/%m/%d %H:%M')))
+                utils.printLine()
+
+                n_msg = len(ctx.outbox)
+                if runs_day[i] is not None:
+                    cluster.startReplay(runs_day[i]['cmds'])
+                try:
+                    check_func()
+                finally:
+                    if runs_day[i] is not None:
+                        cluster.stopReplay()
+
+                _, _, q_all, p, _, _, _ = utils.getTimes()
+                days.append({'time': ctx.clock, 'q_all': q_all, 'p': p,
+                             'emails': ctx.outbox[n_msg:]})
+
+            # Slurm resets the usage at the start of each quarter, after the first run has seen
+            # the final usage of the previous quarter.
+            if runs is None:
+                _, _, q_all, _, _, _, _ = utils.getTimes()
+                forEachDepartment(addSyntheticUsage, reset = ((q_last is not None) and (q_all != q_last)))
+                q_last = q_all
+
+            date += datetime.timedelta(days = 1)
+
+        store = ctx.store
+
+    utils.printLine()
+    print(makeReport(date_start, date_end, days, store, show_emails = False))
+    if report_file is not None:
+        f = open(report_file, 'w')
+        f.write(makeReport(date_start, date_end, days, store, show_emails = True))
+        f.close()
+        print('Wrote full report to %s.' % (report_file))
+
+    return
+
+###################################################################################################
+
+def forEachDepartment(func, **kwargs):
+
+    depts = config.getDepartments()
+    if len(depts) == 0:
+        func(**kwargs)
+        return
+
+    try:
+        for dept in depts:
+            config.setDepartment(dept)
+            func(**kwargs)
+    finally:
+        config.setDepartment(None)
+
+    return
+
+###################################################################################################
+
+# The usage rate of a group relative to its share of the allocation. The variation is derived from
+# the group name, so that it is the same in every simulation.
+
+def getUsageRate(grp):
+
+    cfg = config.getConfig()
+
+    u = (zlib.crc32(grp.encode()) % 1001) / 500.0 - 1.0
+    rate = cfg['simulate']['usage_rate'] * (1.0 + cfg['simulate']['usage_spread'] * u)
+
+    return rate
+
+###################################################################################################
+
+# Add one day of synthetic usage to the current group data, distributed among the users of each
+# group by weight. If reset is True, the cumulative usage is first set to zero.
+
+def addSyntheticUsage(reset = False):
+
+    cfg = config.getConfig()
+
+    dic_grps = utils.readYaml(cfg['yaml_file_grps_cur'])
+    if dic_grps is None:
+        raise Exception('Synthetic usage requires current group data in %s.' % (cfg['yaml_file_grps_cur']))
+    grps = dic_grps['grps_cur']
+
+    if reset:
+        for grp in grps:
+            grps[grp]['su_usage'] = 0.0
+            for usr in grps[grp]['users']:
+                grps[grp]['users'][usr]['su_usage'] = 0.0
+
+    yr, q_yr, q_all, p, _, _, _ = utils.getTimes()
+    dic_q = utils.readYaml(utils.getYamlNameQuarter(q_all, yr, q_yr))
+    if (dic_q is not None) and (p in dic_q['periods']):
+        prd = dic_q['periods'][p]
+        n_days = (prd['end_date'] - prd['start_date']).days + 1
+        for grp in grps:
+            if not grp in prd['groups']:
+                continue
+            su_day = prd['su_alloc'] * prd['groups'][grp]['weight_frac'] / n_days * getUsageRate(grp)
+            usrs = list(grps[grp]['users'].keys())
+            w_tot = 0.0
+            for usr in usrs:
+                w_tot += grps[grp]['users'][usr]['weight']
+            for usr in usrs:
+                if w_tot > 0.0:
+                    frac = grps[grp]['users'][usr]['weight'] / w_tot
+                else:
+                    frac = 1.0 / len(usrs)
+                grps[grp]['users'][usr]['su_usage'] += su_day * frac
+            grps[grp]['su_usage'] += su_day
+
+    utils.writeYaml(cfg['yaml_file_grps_cur'], dic_grps)
+
+    return
+
+###################################################################################################
+
+# Create a report of a simulation: the runs with the number of emails, the allocations, usage, and
+# penalties of all periods, and the emails that would have been sent.
+
+def makeReport(date_start, date_end, days, store, show_emails = False):
+
+    n_emails = 0
+    for day in days:
+        n_emails += len(day['emails'])
+
+    txt = 'Simulation from %s to %s: %d runs, %d emails.\n' \
+        % (date_start.strftime('%Y/%m/%d'), date_end.strftime('%Y/%m/%d'), len(days), n_emails)
+    txt += '\n'
+    txt += '    | Time             | Quarter | Period | Emails |\n'
+    txt += '    ------------------------------------------------\n'
+    for day in days:
+        txt += '    | %s | %7d | %6d | %6d |\n' \
+            % (day['time'].strftime('%Y/%m/%d %H:%M'), day['q_all'], day['p'], len(day['emails']))
+    txt += '    ------------------------------------------------\n'
+
+    # The quarter files written during the simulation
+    for fname in sorted(store.keys()):
+        if not os.path.basename(fname).startswith('quarter_'):
+            continue
+        dic_q = yaml.safe_load(store[fname])
+        for p in sorted(dic_q['periods'].keys()):
+            prd = dic_q['periods'][p]
+            txt += '\n'
+            txt += '%s, period %d (%s to %s), %.1f kSU allocated:\n' \
+                % (fname, p, prd['start_date'].strftime('%Y/%m/%d'), prd['end_date'].strftime('%Y/%m/%d'),
+                   prd['su_alloc'] / 1000.0)
+            txt += '\n'
+            txt += '    | Group           |    Alloc |    Usage | Pen. old | Pen. new | Rebal. |\n'
+            txt += '    ------------------------------------------------------------------------\n'
+            for grp in sorted(prd['groups'].keys()):
+                grp_data = prd['groups'][grp]
+                txt += '    | %-15s | %8.1f | %8.1f | %8.1f | %8.1f | %6.1f |\n' \
+                    % (grp, grp_data['alloc'] / 1000.0, grp_data['su_usage'] / 1000.0,
+                       grp_data['penalty_old'] / 1000.0, grp_data['penalty_new'] / 1000.0,
+                       grp_data.get('alloc_rebalance', 0.0) / 1000.0)
+            txt += '    ------------------------------------------------------------------------\n'
+
+    txt += '\n'
+    txt += 'Emails:\n'
+    txt += '\n'
+    for day in days:
+        for email in day['emails']:
+            txt += '    %s  %-40s  %s\n' % (day['time'].strftime('%Y/%m/%d'), email['to'][:40], email['subject'])
+            if show_emails:
+                txt += '\n'
+                for l in email['content'].splitlines():
+                    txt += '        %s\n' % (l)
+                txt += '\n'
+
+    return txt
+
+###################################################################################################
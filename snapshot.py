@@ -0,0 +1,181 @@
+###################################################################################################
+#
+# This file is part of the HPC allocator code for the UMD astronomy department
+#
+# (c) Benedikt Diemer
+#
+###################################################################################################
+
+import os
+import json
+import shutil
+import datetime
+
+import config
+import utils
+
+###################################################################################################
+
+# Create a compact, JSON-serializable summary of the current period that can be served to users
+# without querying the cluster. The snapshot contains the period dates, the allocation and usage of
+# each group, and the usage of each user in each of their groups.
+
+def makeSnapshot(prd_cur, q_all, p):
+
+    cfg = config.getConfig()
+
+    snap = {}
+    snap['time'] = utils.getNow().isoformat(timespec = 'seconds')
+    snap['quarter'] = q_all
+    snap['period'] = p
+    snap['period_label'] = cfg['periods'][p]['label']
+    snap['start_date'] = prd_cur['start_date'].isoformat()
+    snap['end_date'] = prd_cur['end_date'].isoformat()
+    snap['groups'] = {}
+    snap['users'] = {}
+
+    for grp in prd_cur['groups']:
+        grp_data = prd_cur['groups'][grp]
+        alloc = grp_data['alloc']
+        su_usage = grp_data['su_usage']
+        if alloc > 0.0:
+            usage_prct = 100.0 * su_usage / alloc
+        else:
+            usage_prct = None
+
+        dic_grp = {}
+        dic_grp['alloc'] = alloc
+        dic_grp['su_usage'] = su_usage
+        dic_grp['usage_prct'] = usage_prct
+        dic_grp['scratch_usage'] = grp_data.get('scratch_usage', 0.0)
+        dic_grp['scratch_quota'] = grp_data.get('scratch_quota', 0.0)
+        dic_grp['users'] = sorted(list(grp_data['users'].keys()))
+        snap['groups'][grp] = dic_grp
+
+        for usr in grp_data['users']:
+            if not usr in snap['users']:
+                snap['users'][usr] = {'groups': {}}
+            dic_usr = {}
+            dic_usr['su_usage'] = grp_data['users'][usr].get('su_usage', 0.0)
+            dic_usr['scratch_usage'] = grp_data['users'][usr].get('scratch_usage', 0.0)
+            dic_usr['group_alloc'] = alloc
+            dic_usr['group_su_usage'] = su_usage
+            dic_usr['group_usage_prct'] = usage_prct
+            snap['users'][usr]['groups'][grp] = dic_usr
+
+    return snap
+
+###################################################################################################
+
+def writeSnapshot(snap):
+
+    cfg = config.getConfig()
+
+    utils.writeFileAtomic(cfg['snapshot_file'], json.dumps(snap, sort_keys = True))
+
+    return
+
+###################################################################################################
+
+# Per-user and per-group records are small files that can be read directly by login scripts and
+# shell prompts. Each refresh writes a complete new version directory; the "current" symlink is then
+# replaced atomically so that readers never see a mix of old and new records. Only the previous
+# version is kept, since a reader may still be resolving paths through the old link.
+
+def recordLine(snap, grp):
+
+    dic_grp = snap['groups'][grp]
+    if dic_grp['usage_prct'] is None:
+        s_prct = 'no allocation'
+    else:
+        s_prct = '%.0f%% of %.1f kSU used' % (dic_grp['usage_prct'], dic_grp['alloc'] / 1000.0)
+    s = '%s: %s in the %s period (%s to %s)' % (grp, s_prct, snap['period_label'],
+                                               snap['start_date'], snap['end_date'])
+
+    return s
+
+###################################################################################################
+
+def writeRecords(snap):
+
+    cfg = config.getConfig()
+
+    base_dir = cfg['snapshot_dir']
+    if not os.path.exists(base_dir):
+        os.makedirs(base_dir)
+
+    time_str = datetime.datetime.now().strftime('%Y%m%d_%H%M%S_%f')
+    version = 'v_%s_%d' % (time_str, os.getpid())
+    version_dir = os.path.join(base_dir, version)
+    os.makedirs(os.path.join(version_dir, 'users'))
+    os.makedirs(os.path.join(version_dir, 'groups'))
+
+    prd_info = {}
+    for k in ['time', 'quarter', 'period', 'period_label', 'start_date', 'end_date']:
+        prd_info[k] = snap[k]
+
+    for grp in snap['groups']:
+        dic = dict(prd_info)
+        dic['group'] = grp
+        dic.update(snap['groups'][grp])
+        fname = os.path.join(version_dir, 'groups', grp)
+        f = open(fname + '.json', 'w')
+        json.dump(dic, f, sort_keys = True)
+        f.close()
+        f = open(fname + '.txt', 'w')
+        f.write(recordLine(snap, grp) + '\n')
+        f.close()
+
+    for usr in snap['users']:
+        dic = dict(prd_info)
+        dic['user'] = usr
+        dic.update(snap['users'][usr])
+        fname = os.path.join(version_dir, 'users', usr)
+        f = open(fname + '.json', 'w')
+        json.dump(dic, f, sort_keys = True)
+        f.close()
+        f = open(fname + '.txt', 'w')
+        for grp in sorted(snap['users'][usr]['groups'].keys()):
+            f.write(recordLine(snap, grp) + '\n')
+        f.close()
+
+    # Swap the link, then remove all versions except the new and the previous one
+    link_name = os.path.join(base_dir, 'current')
+    prev_version = None
+    if os.path.islink(link_name):
+        prev_version = os.path.basename(os.readlink(link_name))
+    link_tmp = '%s.tmp.%d' % (link_name, os.getpid())
+    os.symlink(version, link_tmp)
+    os.replace(link_tmp, link_name)
+
+    for d in os.listdir(base_dir):
+        if (not d.startswith('v_')) or (d in [version, prev_version]):
+            continue
+        shutil.rmtree(os.path.join(base_dir, d), ignore_errors = True)
+
+    return
+
+###################################################################################################
+
+# Find the record file of a user. The path depends only on the user name so that it can be 
+# constructed without loading the snapshot.
+
+def getRecordFile(usr, snapshot_dir, ext = 'txt'):
+
+    return os.path.join(snapshot_dir, 'current', 'users', '%s.%s' % (usr, ext))
+
+###################################################################################################
+
+def loadSnapshot():
+
+    cfg = config.getConfig()
+
+    if not os.path.exists(cfg['snapshot_file']):
+        raise Exception('Could not find snapshot file %s.' % (cfg['snapshot_file']))
+    f = open(cfg['snapshot_file'], 'r')
+    snap = json.load(f)
+    f.close()
+
+    return snap
+
+###################################################################################################
@@ -0,0 +1,242 @@
+###################################################################################################
+#
+# This file is part of the HPC allocator code for the UMD astronomy department
+#
+# (c) Benedikt Diemer
+#
+###################################################################################################
+
+import os
+import sys
+import datetime
+import pytest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+import yaml
+
+import config
+import utils
+import cluster
+import allocator
+
+###################################################################################################
+
+# The tests run the allocator in a temporary directory, with the sample config, a clock that the
+# tests advance, an in-memory store, an outbox instead of emails, and a fake cluster instead of the
+# command-line queries (see allocator.py). The default time is in the first period of a quarter.
+
+time_start = datetime.datetime(2026, 10, 19, 12, 0, 0)
+
+###################################################################################################
+
+class Clock():
+
+    def __init__(self, now = time_start):
+
+        self.now = now
+
+        return
+
+    def __call__(self):
+
+        return self.now
+
+    def advance(self, **kwargs):
+
+        self.now += datetime.timedelta(**kwargs)
+
+        return
+
+###################################################################################################
+
+# A stand-in for the cluster with the same output formats as the real commands. Each group has a
+# scratch quota and users with cumulative SU and scratch usage; jobs are returned by sacct if they
+# ended within the queried time range. Groups in scratch_missing are left out of the bulk scratch
+# output. Commands that contain one of the strings in fail raise a
+# CommandError. All commands are recorded in calls.
+
+class FakeCluster():
+
+    def __init__(self):
+
+        self.q_su_quota = 8333200.0
+        self.q_su_avail = 4166600.0
+        self.groups = {}
+        self.jobs = []
+        self.pending = []
+        self.unix_groups = {}
+        self.associations = []
+        self.scratch_missing = []
+        self.fail = []
+        self.calls = []
+        self.inputs = []
+
+        return
+
+    def addGroup(self, grp, users, su_usage = 0.0, scratch_usage = 0.0, scratch_quota = 2000.0):
+
+        self.groups[grp] = {'scratch_quota': scratch_quota, 'users': {}}
+        for usr in users:
+            self.groups[grp]['users'][usr] = {'su': su_usage, 'scratch': scratch_usage}
+
+        return
+
+    def addUsage(self, grp, su_usage, usr = None):
+
+        if usr is None:
+            usr = list(self.groups[grp]['users'].keys())[0]
+        self.groups[grp]['users'][usr]['su'] += su_usage
+
+        return
+
+    def addJob(self, grp, usr, end, hours = 1.0, cpus = 1, partition = 'standard', gpus = 0, acct = 'astr'):
+
+        tres = 'billing=%d,cpu=%d,mem=4G,node=1' % (cpus, cpus)
+        if gpus > 0:
+            tres += ',gres/gpu=%d' % (gpus)
+        self.jobs.append('%d|%s|%s|%d|%s|%s|%s-%s' % (1000 + len(self.jobs), usr, partition, int(hours * 3600),
+                         tres, end.strftime('%Y-%m-%dT%H:%M:%S'), grp, acct))
+
+        return
+
+    def __call__(self, cmd, input_text, timeout):
+
+        key = ' '.join(cmd)
+        self.calls.append(key)
+        self.inputs.append(input_text)
+        for f in self.fail:
+            if f in key:
+                raise cluster.CommandError('Fake failure of "%s".' % (key))
+
+        if cmd[0] == 'sbalance':
+            acct = cmd[cmd.index('-account') + 1]
+            if not '--all' in cmd:
+                return 'Account Value\nLimit %.3f\nAvailable %.3f\n' % (self.q_su_quota / 1000.0, self.q_su_avail / 1000.0)
+            grp = acct.rsplit('-', 1)[0]
+            users = self.groups[grp]['users']
+            txt = 'Account Value\nLimit 1000.0\nUnused 0.0\nUsed %.6f\n' \
+                % (sum([users[usr]['su'] for usr in users]) / 1000.0)
+            for usr in users:
+                txt += 'User %s x %.6f\n' % (usr, users[usr]['su'] / 1000.0)
+            return txt
+
+        elif cmd[0] == 'scratch_quota':
+            grps = [grp for grp in self.groups if not grp in self.scratch_missing]
+            if '--group' in cmd:
+                grps = [cmd[cmd.index('--group') + 1][3:]]
+            txt = ''
+            for grp in grps:
+                users = self.groups[grp]['users']
+                txt += 'Group Used Quota\n-----\n'
+                txt += 'zt-%s %.4f GB %.4f GB\n' % (grp, sum([users[usr]['scratch'] for usr in users]),
+                                                  self.groups[grp]['scratch_quota'])
+                txt += '# User quotas\nUser Used\n'
+                for usr in users:
+                    txt += '%s %.4f GB\n' % (usr, users[usr]['scratch'])
+            return txt
+
+        elif cmd[0] == 'sacct':
+            accts = cmd[cmd.index('-A') + 1].split(',')
+            t_start = cmd[cmd.index('-S') + 1]
+            t_end = cmd[cmd.index('-E') + 1]
+            txt = ''
+            for job in self.jobs:
+                w = job.split('|')
+                if (w[6] in accts) and (w[5] >= t_start) and (w[5] <= t_end):
+                    txt += job + '\n'
+            return txt
+
+        elif cmd[0] == 'getent':
+            txt = ''
+            for grp in self.unix_groups:
+                txt += 'zt-%s:x:5000:%s\n' % (grp, ','.join(self.unix_groups[grp]))
+            return txt
+
+        elif (cmd[0] == 'sacctmgr') and ('associations' in cmd):
+            return ''.join([l + '\n' for l in self.associations])
+
+        elif cmd[0] == 'sacctmgr':
+            return ''
+
+        elif cmd[0] == 'squeue':
+            return ''.join([l + '\n' for l in self.pending])
+
+        raise cluster.CommandError('Unknown command "%s".' % (key))
+
+###################################################################################################
+
+# Read a state file that an allocator wrote to its store
+
+def readState(alloc, key):
+
+    cfg = alloc.run(config.getConfig)
+    fname = cfg.get(key, key)
+
+    return yaml.safe_load(alloc.context.store[fname])
+
+###################################################################################################
+
+# Read the quarter file of the current time of an allocator
+
+def readQuarter(alloc):
+
+    yr, q_yr, q_all, _, _, _, _ = alloc.run(utils.getTimes)
+
+    return readState(alloc, alloc.run(utils.getYamlNameQuarter, q_all, yr, q_yr))
+
+###################################################################################################
+
+# The sample config with three groups and known users, run in a temporary directory
+
+@pytest.fixture
+def cfg(tmp_path, monkeypatch):
+
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('yaml')
+    dic = config.loadYaml(os.path.join(root, 'config', 'config.yaml'))
+    dic.update(config.loadYaml(os.path.join(root, 'config', 'config_email.yaml')))
+    dic['astro_lists'] = {}
+    dic['users_extra'] = {'u00': {'people_type': 'ttk', 'past_user': False},
+                          'u01': {'people_type': 'pd', 'past_user': False},
+                          'u02': {'people_type': 'gs', 'past_user': False},
+                          'u10': {'people_type': 'ttk', 'past_user': False},
+                          'u11': {'people_type': 'gs', 'past_user': False},
+                          'u20': {'people_type': 'ttk', 'past_user': False},
+                          'u21': {'people_type': 'ug', 'past_user': False}}
+    dic['groups'] = {'alpha-prj': {'lead': 'u00'}, 'beta-prj': {'lead': 'u10'}, 'gamma-prj': {'lead': 'u20'}}
+    dic['cluster']['retries'] = 0
+    dic['cluster']['backoff'] = 0.0
+
+    return dic
+
+###################################################################################################
+
+@pytest.fixture
+def fake():
+
+    fc = FakeCluster()
+    fc.addGroup('alpha-prj', ['u00', 'u01', 'u02'], su_usage = 10000.0, scratch_usage = 100.0)
+    fc.addGroup('beta-prj', ['u10', 'u11'], su_usage = 20000.0, scratch_usage = 200.0)
+    fc.addGroup('gamma-prj', ['u20', 'u21'], su_usage = 5000.0, scratch_usage = 50.0)
+
+    return fc
+
+###################################################################################################
+
+@pytest.fixture
+def clock():
+
+    return Clock()
+
+###################################################################################################
+
+# An allocator that runs live (not as a dry run) against the fake cluster
+
+@pytest.fixture
+def alloc(cfg, fake, clock):
+
+    return allocator.Allocator(cfg = cfg, store = {}, outbox = [], runner = fake, clock = clock, dry_run = False)
+
+###################################################################################################
@@ -0,0 +1,174 @@
+###################################################################################################
+#
+# This file is part of the HPC allocator code for the UMD astronomy department
+#
+# (c) Benedikt Diemer
+#
+###################################################################################################
+
+import datetime
+import pytest
+
+import allocator
+import accounting
+import cluster
+from conftest import readState
+
+###################################################################################################
+
+q_start = datetime.date(2026, 10, 1)
+p_start = datetime.date(2026, 10, 1)
+
+###################################################################################################
+
+def collect(alloc, grps = ['alpha-prj', 'beta-prj'], q_all = 4):
+
+    return alloc.run(accounting.collectSU, grps, q_all, q_start, p_start)
+
+###################################################################################################
+
+def test_getJobCost(alloc):
+
+    assert alloc.run(accounting.getJobCost, 'standard', 7200, 'billing=4,cpu=4,mem=16G,node=1') == pytest.approx(8.0)
+    assert alloc.run(accounting.getJobCost, 'gpu', 3600, 'cpu=2,gres/gpu=1') == pytest.approx(50.0)
+    assert alloc.run(accounting.getJobCost, 'bigmem', 3600, 'cpu=2') == pytest.approx(3.0)
+    assert alloc.run(accounting.getTresAmount, 'mem', '2048M') == pytest.approx(2.0)
+
+###################################################################################################
+
+# The usage is aggregated per user, and each job is counted once over several runs
+
+def test_collectSU(fake, clock, alloc):
+
+    fake.addJob('alpha-prj', 'u00', datetime.datetime(2026, 10, 2, 10, 0, 0), hours = 2.0, cpus = 4)
+    fake.addJob('alpha-prj', 'u01', datetime.datetime(2026, 10, 10, 10, 0, 0), hours = 1.0, cpus = 10)
+    fake.addJob('beta-prj', 'u10', datetime.datetime(2026, 10, 18, 10, 0, 0), hours = 1.0, gpus = 1)
+    fake.addJob('gamma-prj', 'u20', datetime.datetime(2026, 10, 18, 10, 0, 0), hours = 100.0)
+    su = collect(alloc)
+
+    assert su['alpha-prj'] == [None, pytest.approx(18.0), pytest.approx({'u00': 8.0, 'u01': 10.0})]
+    assert su['beta-prj'][1] == pytest.approx(49.0)
+    assert not 'gamma-prj' in su
+    assert all(['-A alpha-prj-astr,beta-prj-astr ' in c for c in fake.calls])
+
+    # Jobs that end at the same time as the checkpoint are counted if they are new
+    fake.addJob('alpha-prj', 'u02', datetime.datetime(2026, 10, 10, 10, 0, 0), hours = 1.0)
+    fake.addJob('alpha-prj', 'u02', datetime.datetime(2026, 10, 19, 12, 30, 0), hours = 1.0)
+    su = collect(alloc)
+    assert su['alpha-prj'][2] == pytest.approx({'u00': 8.0, 'u01': 10.0, 'u02': 1.0})
+
+    n_calls = len(fake.calls)
+    clock.advance(hours = 1)
+    su = collect(alloc)
+    assert su['alpha-prj'][2] == pytest.approx({'u00': 8.0, 'u01': 10.0, 'u02': 2.0})
+    assert '-S 2026-10-10T08:00:00 ' in fake.calls[n_calls]
+
+###################################################################################################
+
+# The jobs are read in chunks, starting at the earliest checkpoint. The state is reset in a new 
+# quarter.
+
+def test_chunksAndQuarter(cfg, fake, alloc):
+
+    fake.addJob('alpha-prj', 'u00', datetime.datetime(2026, 10, 2, 10, 0, 0), hours = 1.0)
+    fake.addJob('beta-prj', 'u10', datetime.datetime(2026, 10, 14, 10, 0, 0), hours = 1.0)
+    collect(alloc)
+    assert len(fake.calls) == 10
+    assert '-S 2026-10-01T00:00:00 -E 2026-10-03T00:00:00' in fake.calls[0]
+    assert '-S 2026-10-19T00:00:00 -E 2026-10-19T12:00:00' in fake.calls[9]
+
+    n_calls = len(fake.calls)
+    su = collect(alloc)
+    assert '-S 2026-10-02T08:00:00 ' in fake.calls[n_calls]
+    assert '-A alpha-prj-astr -s' in fake.calls[n_calls]
+    assert su['alpha-prj'][2] == pytest.approx({'u00': 1.0})
+
+    n_calls = len(fake.calls)
+    su = collect(alloc, q_all = 5)
+    assert '-S 2026-10-01T00:00:00 ' in fake.calls[n_calls]
+    assert su['alpha-prj'][2] == pytest.approx({'u00': 1.0})
+    assert alloc.run(accounting.loadState)['alpha-prj-astr']['n_jobs'] == 1
+
+###################################################################################################
+
+# A job whose record appears late, with an end time before the checkpoint, is counted in the next 
+# run if it ended within the lookback window. Jobs in the window are not counted again, and jobs
+# that left the window are forgotten.
+
+def test_lateRecord(cfg, fake, clock, alloc):
+
+    fake.addJob('alpha-prj', 'u00', datetime.datetime(2026, 10, 19, 11, 0, 0), hours = 1.0)
+    su = collect(alloc)
+    assert su['alpha-prj'][2] == pytest.approx({'u00': 1.0})
+
+    fake.addJob('alpha-prj', 'u01', datetime.datetime(2026, 10, 19, 10, 0, 0), hours = 2.0)
+    fake.addJob('alpha-prj', 'u02', datetime.datetime(2026, 10, 19, 8, 0, 0), hours = 4.0)
+    clock.advance(hours = 1)
+    su = collect(alloc)
+    assert su['alpha-prj'][2] == pytest.approx({'u00': 1.0, 'u01': 2.0})
+
+    fake.addJob('alpha-prj', 'u00', datetime.datetime(2026, 10, 19, 12, 30, 0), hours = 1.0)
+    clock.advance(hours = 1)
+    su = collect(alloc)
+    assert su['alpha-prj'][2] == pytest.approx({'u00': 2.0, 'u01': 2.0})
+    acc = alloc.run(accounting.loadState)['alpha-prj-astr']
+    assert acc['n_jobs'] == 3
+    assert sorted(acc['ids_recent'].values()) == ['2026-10-19T11:00:00', '2026-10-19T12:30:00']
+
+###################################################################################################
+
+# A line that cannot be parsed is skipped; the other jobs of its chunk are counted
+
+def test_malformedLine(fake, alloc):
+
+    fake.addJob('alpha-prj', 'u00', datetime.datetime(2026, 10, 2, 10, 0, 0), hours = 1.0)
+    fake.jobs.append('bad|u01|standard|abc|cpu=1|2026-10-02T11:00:00|alpha-prj-astr')
+    fake.addJob('alpha-prj', 'u02', datetime.datetime(2026, 10, 2, 12, 0, 0), hours = 1.0)
+    su = collect(alloc)
+
+    assert su['alpha-prj'][2] == pytest.approx({'u00': 1.0, 'u02': 1.0})
+
+###################################################################################################
+
+# If a query fails, the chunks that were processed before are kept and the rest is read again in 
+# the next run, so that no job is counted twice or lost.
+
+def test_failedChunk(cfg, fake, clock):
+
+    def runner(cmd, input_text, timeout):
+        if fail_at[0] == len(fake.calls):
+            fail_at[0] = None
+            raise cluster.CommandError('sacct failed.')
+        return fake(cmd, input_text, timeout)
+
+    fail_at = [3]
+
+    fake.addJob('alpha-prj', 'u00', datetime.datetime(2026, 10, 2, 10, 0, 0), hours = 1.0)
+    fake.addJob('alpha-prj', 'u00', datetime.datetime(2026, 10, 6, 10, 0, 0), hours = 2.0)
+    fake.addJob('alpha-prj', 'u00', datetime.datetime(2026, 10, 12, 10, 0, 0), hours = 4.0)
+    alloc = allocator.Allocator(cfg = cfg, store = {}, runner = runner, clock = clock)
+    with pytest.raises(cluster.CommandError):
+        collect(alloc)
+    st = alloc.run(accounting.loadState)
+    assert st['alpha-prj-astr']['users'] == pytest.approx({'u00': 3.0})
+
+    su = collect(alloc)
+    assert su['alpha-prj'][2] == pytest.approx({'u00': 7.0})
+
+###################################################################################################
+
+# With job accounting, the SU usage of the groups comes from their jobs
+
+def test_checkWithAccounting(cfg, fake, alloc):
+
+    cfg['accounting']['enabled'] = True
+    fake.addJob('beta-prj', 'u11', datetime.datetime(2026, 10, 12, 10, 0, 0), hours = 3.0, cpus = 2)
+    alloc.check()
+    grps = readState(alloc, 'yaml_file_grps_cur')['grps_cur']
+
+    assert grps['beta-prj']['su_usage'] == pytest.approx(6.0)
+    assert grps['beta-prj']['users']['u11']['su_usage'] == pytest.approx(6.0)
+    assert grps['alpha-prj']['su_usage'] == pytest.approx(0.0)
+    assert not any([c.startswith('sbalance -account beta') for c in fake.calls])
+
+###################################################################################################
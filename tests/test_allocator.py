@@ -0,0 +1,120 @@
+###################################################################################################
+#
+# This file is part of the HPC allocator code for the UMD astronomy department
+#
+# (c) Benedikt Diemer
+#
+###################################################################################################
+
+import copy
+import datetime
+import threading
+import pytest
+
+import config
+import context
+import cluster
+import utils
+import allocator
+from conftest import Clock, FakeCluster, readState
+
+###################################################################################################
+
+def makeAllocator(cfg, clock, su_usage):
+
+    fc = FakeCluster()
+    fc.addGroup('alpha-prj', ['u00', 'u01', 'u02'], su_usage = su_usage)
+    fc.addGroup('beta-prj', ['u10', 'u11'], su_usage = su_usage)
+    fc.addGroup('gamma-prj', ['u20', 'u21'], su_usage = su_usage)
+
+    return allocator.Allocator(cfg = copy.deepcopy(cfg), store = {}, outbox = [], runner = fc,
+                               clock = clock, dry_run = False)
+
+###################################################################################################
+
+# Each allocator has its own config, clock, store, and data source
+
+def test_isolation(cfg):
+
+    alloc1 = makeAllocator(cfg, Clock(), 1000.0)
+    alloc2 = makeAllocator(cfg, Clock(datetime.datetime(2026, 10, 25, 12, 0, 0)), 2000.0)
+    alloc2.run(config.getConfig)['groups']['alpha-prj']['weight'] = 3.0
+    alloc1.check()
+    alloc2.check()
+
+    assert alloc1.run(utils.getNow) == datetime.datetime(2026, 10, 19, 12, 0, 0)
+    assert alloc2.run(utils.getNow) == datetime.datetime(2026, 10, 25, 12, 0, 0)
+    assert not 'weight' in alloc1.run(config.getConfig)['groups']['alpha-prj']
+    grps1 = readState(alloc1, 'yaml_file_grps_cur')['grps_cur']
+    grps2 = readState(alloc2, 'yaml_file_grps_cur')['grps_cur']
+    assert grps1['alpha-prj']['su_usage'] == pytest.approx(3000.0)
+    assert grps2['alpha-prj']['su_usage'] == pytest.approx(6000.0)
+    assert len(alloc1.context.outbox) == 3
+    assert len(alloc2.context.outbox) == 3
+
+###################################################################################################
+
+# Allocators can run concurrently in threads without seeing each other's state or blocking each
+# other, even with the same config
+
+def test_threads(cfg):
+
+    allocs = [makeAllocator(cfg, Clock(), 1000.0 * (i + 1)) for i in range(4)]
+    errors = []
+
+    def checkAlloc(alloc):
+        try:
+            alloc.check()
+        except Exception as e:
+            errors.append(e)
+        return
+
+    threads = [threading.Thread(target = checkAlloc, args = (alloc,)) for alloc in allocs]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert errors == []
+    for i in range(4):
+        grps = readState(allocs[i], 'yaml_file_grps_cur')['grps_cur']
+        assert grps['beta-prj']['su_usage'] == pytest.approx(2000.0 * (i + 1))
+        assert len(allocs[i].context.outbox) == 3
+
+###################################################################################################
+
+# Threads started during a run use the context of the run; outside of a run, the default context
+# is active.
+
+def test_contextThreads(cfg):
+
+    alloc = allocator.Allocator(cfg = cfg, store = {})
+    found = []
+
+    def getContext():
+        found.append(context.get())
+        return
+
+    def startAndJoin():
+        context.startThread(getContext).join()
+        return
+
+    alloc.run(startAndJoin)
+    assert found == [alloc.context]
+    assert context.get() is not alloc.context
+
+###################################################################################################
+
+# The run record of a recording takes its time from the allocator's clock
+
+def test_recordingTime(tmp_path, alloc):
+
+    fname = str(tmp_path / 'rec.json.gz')
+    alloc.check(record_file = fname)
+    runs = cluster.loadRecording(fname)
+
+    assert len(runs) == 1
+    assert runs[0]['time'] == datetime.datetime(2026, 10, 19, 12, 0, 0)
+    assert len(runs[0]['cmds']) > 0
+
+###################################################################################################
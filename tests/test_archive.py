@@ -0,0 +1,97 @@
+###################################################################################################
+#
+# This file is part of the HPC allocator code for the UMD astronomy department
+#
+# (c) Benedikt Diemer
+#
+###################################################################################################
+
+import os
+import datetime
+
+import allocator
+import archive
+from conftest import Clock
+
+###################################################################################################
+
+def storeMessages(alloc, clock):
+
+    alloc.run(archive.storeMessage, 'sent', 'u00@umd.edu, u01@umd.edu', 'Warning', 'Line 1\nFrom here on\n',
+              msg_type = 'warning', groups = ['alpha-prj'])
+    alloc.run(archive.storeMessage, 'draft', 'u10@umd.edu', 'Draft', 'Text', msg_type = 'new_period', 
+              groups = ['beta-prj'])
+    clock.advance(days = 20)
+    alloc.run(archive.storeMessage, 'sent', 'u10@umd.edu', 'Later', 'Text', msg_type = 'warning', 
+              groups = ['beta-prj'])
+
+    return
+
+###################################################################################################
+
+def test_findMessages(cfg, clock, alloc):
+
+    storeMessages(alloc, clock)
+
+    assert [s[0] for s in alloc.run(archive.getSegments)] == ['draft', 'sent', 'sent']
+    assert len(alloc.run(archive.findMessages)) == 3
+    assert [e['subject'] for e in alloc.run(archive.findMessages, usr = 'u10')] == ['Draft', 'Later']
+    assert [e['subject'] for e in alloc.run(archive.findMessages, grp = 'beta-prj', msg_type = 'warning')] == ['Later']
+    assert [e['subject'] for e in alloc.run(archive.findMessages, date_start = datetime.date(2026, 11, 1))] == ['Later']
+    assert sorted([e['subject'] for e in alloc.run(archive.findMessages, date_end = datetime.date(2026, 10, 31))]) \
+        == ['Draft', 'Warning']
+
+    # Each message is read from its own position, and lines starting with "From " survive
+    entry = alloc.run(archive.findMessages, usr = 'u01')[0]
+    txt = alloc.run(archive.readMessage, entry)
+    assert entry['kind'] == 'sent'
+    assert 'Subject: Warning\n' in txt
+    assert txt.endswith('Line 1\nFrom here on\n')
+
+###################################################################################################
+
+# Segments are deleted once they are older than the retention time of their kind
+
+def test_pruneArchive(cfg, clock, alloc):
+
+    storeMessages(alloc, clock)
+    clock_late = Clock(datetime.datetime(2026, 12, 15, 12, 0, 0))
+    alloc_late = allocator.Allocator(cfg = cfg, store = {}, clock = clock_late)
+    alloc_late.run(archive.storeMessage, 'draft', 'u00@umd.edu', 'New', 'Text')
+
+    assert [[s[0], s[1].month] for s in alloc_late.run(archive.getSegments)] \
+        == [['draft', 10], ['draft', 12], ['sent', 10], ['sent', 11]]
+
+    clock_late.advance(days = 20)
+    alloc_late = allocator.Allocator(cfg = cfg, store = {}, clock = clock_late)
+    alloc_late.run(archive.pruneArchive)
+    assert [[s[0], s[1].month] for s in alloc_late.run(archive.getSegments)] \
+        == [['draft', 12], ['sent', 10], ['sent', 11]]
+    assert not os.path.exists(os.path.join(cfg['email_archive']['dir'], 'draft_2026_10.mbox.gz'))
+
+###################################################################################################
+
+# Without an outbox, the emails of a dry run are archived as drafts and sent emails as sent
+
+def test_archiveCheck(cfg, fake, clock, capsys):
+
+    sent = []
+    alloc = allocator.Allocator(cfg = cfg, store = {}, runner = fake, clock = clock, dry_run = True)
+    alloc.check()
+    assert len(alloc.run(archive.findMessages, kinds_use = ['draft'])) == 3
+
+    alloc = allocator.Allocator(cfg = cfg, store = {}, runner = fake, clock = clock, dry_run = False,
+                                mailer = sent.append)
+    alloc.check()
+    found = alloc.run(archive.findMessages, kinds_use = ['sent'])
+    assert len(found) == 3
+    assert len(sent) == 3
+    assert found[0]['type'] == 'new_period'
+
+    capsys.readouterr()
+    alloc.run(archive.printMessages, grp = 'gamma-prj', show_content = True)
+    out = capsys.readouterr().out
+    assert out.startswith('Found 2 messages.')
+    assert 'You are receiving this email because you are a member of the user group gamma-prj' in out
+
+###################################################################################################
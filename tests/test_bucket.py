@@ -0,0 +1,97 @@
+###################################################################################################
+#
+# This file is part of the HPC allocator code for the UMD astronomy department
+#
+# (c) Benedikt Diemer
+#
+###################################################################################################
+
+import datetime
+import pytest
+
+import bucket
+from conftest import readQuarter
+
+###################################################################################################
+
+def test_getQuarterEnd(alloc):
+
+    assert alloc.run(bucket.getQuarterEnd, datetime.date(2026, 10, 31), 1) == datetime.datetime(2027, 1, 1)
+    assert alloc.run(bucket.getQuarterEnd, datetime.date(2026, 7, 1), 0) == datetime.datetime(2026, 10, 1)
+
+###################################################################################################
+
+# Usage is taken out before the bucket is capped, since it happened while the bucket was filling
+
+def test_updateTokens():
+
+    b = {'tokens': 100.0, 'su_usage': 0.0, 'time': 0.0, 'rate': 10.0, 'capacity': 150.0}
+    bucket.updateTokens(b, 20.0, 86400.0)
+    assert b['tokens'] == pytest.approx(90.0)
+
+    bucket.updateTokens(b, 20.0, 86400.0 * 11)
+    assert b['tokens'] == pytest.approx(150.0)
+
+    bucket.updateTokens(b, 70.0, 86400.0 * 16)
+    assert b['tokens'] == pytest.approx(150.0)
+    assert b['su_usage'] == 70.0
+
+###################################################################################################
+
+# The buckets start full, and the allocation of a group is its usage plus its tokens
+
+def test_bucketCheck(cfg, fake, clock, alloc):
+
+    cfg['bucket']['enabled'] = True
+    cfg['refresh']['su_usage'] = 10
+    alloc.check()
+    prd = readQuarter(alloc)['periods'][0]
+    days_left = (datetime.datetime(2027, 1, 1) - clock.now).total_seconds() / 86400.0
+    grp_data = prd['groups']['beta-prj']
+    rate = grp_data['weight_frac'] * prd['su_avail'] / days_left
+
+    assert prd['bucket']['days_left'] == pytest.approx(days_left)
+    assert grp_data['bucket']['rate'] == pytest.approx(rate)
+    assert grp_data['alloc'] == pytest.approx(rate * cfg['bucket']['capacity_days'])
+    capacity = grp_data['bucket']['capacity']
+    n_emails = len(alloc.context.outbox)
+
+    fake.addUsage('beta-prj', grp_data['alloc'] * 0.9)
+    clock.advance(days = 1)
+    alloc.check()
+    prd = readQuarter(alloc)['periods'][0]
+    grp_data = prd['groups']['beta-prj']
+    b = grp_data['bucket']
+
+    assert grp_data['alloc'] == pytest.approx(grp_data['su_usage'] + b['tokens'])
+    assert b['tokens'] == pytest.approx(capacity - grp_data['su_usage'] + rate)
+    assert prd['bucket']['su_remaining'] == pytest.approx(prd['su_avail'] - sum([prd['groups'][g]['su_usage'] for g in prd['groups']]))
+    assert len(alloc.context.outbox) > n_emails
+
+###################################################################################################
+
+# A negative balance at the end of a period becomes a penalty; within a quarter, the remaining
+# tokens are carried into the next period.
+
+def test_startPeriod(cfg, clock, alloc):
+
+    cfg['bucket']['enabled'] = True
+    t_old = (clock.now - datetime.timedelta(days = 1)).timestamp()
+    prd_old = {'groups': {'a-prj': {'su_usage': 500.0, 'bucket': {'tokens': 100.0, 'su_usage': 0.0, 'time': t_old,
+                                                                  'rate': 0.0, 'capacity': 1000.0}},
+                          'b-prj': {'su_usage': 0.0, 'bucket': {'tokens': 300.0, 'su_usage': 0.0, 'time': t_old,
+                                                                'rate': 0.0, 'capacity': 1000.0}}}}
+    prd_new = {'start_date': datetime.date(2026, 10, 19), 'end_date': datetime.date(2026, 11, 29), 'su_avail': 73500.0,
+               'groups': {'a-prj': {'weight_frac': 0.5, 'penalty_old': 0.0}, 'b-prj': {'weight_frac': 0.5, 'penalty_old': 0.0}}}
+    alloc.run(bucket.startPeriod, prd_new, prd_old, 1, False)
+    grps = prd_new['groups']
+
+    assert grps['a-prj']['penalty_old'] == pytest.approx(400.0 * cfg['penalty_factor'])
+    assert grps['a-prj']['bucket']['tokens'] == pytest.approx(-400.0 * cfg['penalty_factor'])
+    assert grps['a-prj']['alloc'] == 0.0
+    assert grps['b-prj']['bucket']['tokens'] == pytest.approx(300.0)
+
+    alloc.run(bucket.startPeriod, prd_new, prd_old, 1, True)
+    assert grps['b-prj']['bucket']['tokens'] == pytest.approx(grps['b-prj']['bucket']['capacity'])
+
+###################################################################################################
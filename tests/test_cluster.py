@@ -0,0 +1,142 @@
+###################################################################################################
+#
+# This file is part of the HPC allocator code for the UMD astronomy department
+#
+# (c) Benedikt Diemer
+#
+###################################################################################################
+
+import pytest
+
+import cluster
+import allocator
+from conftest import readState, readQuarter
+
+###################################################################################################
+
+# A runner that fails a given number of times before it succeeds
+
+class FlakyRunner():
+
+    def __init__(self, n_fail):
+
+        self.n_fail = n_fail
+        self.n_calls = 0
+
+        return
+
+    def __call__(self, cmd, input_text, timeout):
+
+        self.n_calls += 1
+        if self.n_calls <= self.n_fail:
+            raise cluster.CommandError('Failure %d.' % (self.n_calls))
+
+        return 'ok'
+
+###################################################################################################
+
+def test_retries(cfg):
+
+    cfg['cluster']['retries'] = 2
+    runner = FlakyRunner(2)
+    alloc = allocator.Allocator(cfg = cfg, store = {}, runner = runner)
+
+    assert alloc.run(cluster.runCommand, ['sbalance', '-account', 'astr']) == 'ok'
+    assert runner.n_calls == 3
+
+    runner = FlakyRunner(3)
+    alloc = allocator.Allocator(cfg = cfg, store = {}, runner = runner)
+    with pytest.raises(cluster.CommandError):
+        alloc.run(cluster.runCommand, ['sbalance', '-account', 'astr'])
+    assert runner.n_calls == 3
+
+###################################################################################################
+
+def test_timeout(cfg):
+
+    cfg['cluster']['timeout']['default'] = 0.2
+    alloc = allocator.Allocator(cfg = cfg, store = {})
+
+    with pytest.raises(cluster.CommandError, match = 'timed out'):
+        alloc.run(cluster.runCommand, ['sleep', '5'])
+
+###################################################################################################
+
+# After breaker_threshold failed calls, the backend is not called until the cooldown has passed. A
+# successful call closes the breaker.
+
+def test_circuitBreaker(cfg):
+
+    runner = FlakyRunner(3)
+    alloc = allocator.Allocator(cfg = cfg, store = {}, runner = runner)
+    for i in range(cfg['cluster']['breaker_threshold']):
+        with pytest.raises(cluster.CommandError):
+            alloc.run(cluster.runCommand, ['sbalance', '-account', 'astr'])
+    assert alloc.run(cluster.isCircuitOpen, 'sbalance')
+
+    with pytest.raises(cluster.CommandError, match = 'Circuit breaker'):
+        alloc.run(cluster.runCommand, ['sbalance', '-account', 'astr'])
+    assert runner.n_calls == 3
+    assert not alloc.run(cluster.isCircuitOpen, 'scratch_quota')
+
+    state = alloc.run(cluster.loadCircuitState)
+    state['sbalance']['open_until'] = 0.0
+    assert alloc.run(cluster.runCommand, ['sbalance', '-account', 'astr']) == 'ok'
+    assert state['sbalance']['n_fail'] == 0
+
+###################################################################################################
+
+# The breaker state is saved with the other state files and read again by the next run
+
+def test_circuitStatePersists(cfg):
+
+    store = {}
+    alloc = allocator.Allocator(cfg = cfg, store = store, runner = FlakyRunner(10))
+    for i in range(cfg['cluster']['breaker_threshold']):
+        with pytest.raises(cluster.CommandError):
+            alloc.run(cluster.runCommand, ['sbalance', '-account', 'astr'])
+    alloc.run(cluster.saveCircuitState)
+
+    alloc = allocator.Allocator(cfg = cfg, store = store, runner = FlakyRunner(0))
+    assert alloc.run(cluster.isCircuitOpen, 'sbalance')
+
+###################################################################################################
+
+# If the SU query of a group fails, its last known usage is kept and it is marked as stale
+
+def test_staleFallback(fake, clock, alloc):
+
+    alloc.check()
+    fake.addUsage('alpha-prj', 1000.0)
+    fake.addUsage('beta-prj', 1000.0)
+    fake.fail = ['beta-prj-astr']
+    clock.advance(days = 1)
+    alloc.check()
+    grps = readState(alloc, 'yaml_file_grps_cur')['grps_cur']
+
+    assert grps['beta-prj']['stale']
+    assert grps['beta-prj']['su_usage'] == pytest.approx(40000.0)
+    assert not grps['alpha-prj']['stale']
+    assert grps['alpha-prj']['su_usage'] == pytest.approx(31000.0)
+
+###################################################################################################
+
+# A group whose SU query fails without previous data is skipped instead of starting the period
+# with zero usage; its usage is queried again in the next run.
+
+def test_skipGroupWithoutData(cfg, fake, clock, alloc):
+
+    fake.fail = ['beta-prj-astr']
+    alloc.check()
+    dic_q = readQuarter(alloc)
+
+    assert not 'beta-prj' in readState(alloc, 'yaml_file_grps_cur')['grps_cur']
+    assert not 'beta-prj' in dic_q['periods'][0]['groups']
+
+    fake.fail = []
+    clock.advance(minutes = 10)
+    alloc.check()
+    grps = readState(alloc, 'yaml_file_grps_cur')['grps_cur']
+    assert grps['beta-prj']['su_usage'] == pytest.approx(40000.0)
+
+###################################################################################################
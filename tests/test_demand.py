@@ -0,0 +1,100 @@
+###################################################################################################
+#
+# This file is part of the HPC allocator code for the UMD astronomy department
+#
+# (c) Benedikt Diemer
+#
+###################################################################################################
+
+import datetime
+import pytest
+
+import demand
+from conftest import readQuarter
+
+###################################################################################################
+
+pending = ['alpha-prj-astr|PENDING|standard|4|(null)|2:00:00|2:00:00',
+           'beta-prj-astr|RUNNING|gpu|2|gres/gpu:1|1-00:00:00|1:00:00',
+           'gamma-prj-astr|PENDING|standard|1|(null)|UNLIMITED|UNLIMITED',
+           'other-prj-phys|PENDING|standard|1000|(null)|10:00:00|10:00:00']
+
+###################################################################################################
+
+def test_getSeconds():
+
+    assert demand.getSeconds('1-02:03:04') == 93784
+    assert demand.getSeconds('05:30') == 330
+    assert demand.getSeconds('UNLIMITED') is None
+    assert demand.getGresTres('gres/gpu:2') == ['gres/gpu=2']
+    assert demand.getGresTres('gpu:a100:4,shard:1') == ['gres/gpu=4']
+
+###################################################################################################
+
+# Jobs are costed over their remaining time; jobs from other accounts are ignored
+
+def test_pollDemand(fake, alloc):
+
+    fake.pending = pending
+    st = alloc.run(demand.pollDemand, datetime.date(2026, 10, 1))
+
+    assert st['groups']['alpha-prj'] == pytest.approx({'pending': 8.0, 'running': 0.0})
+    assert st['groups']['beta-prj'] == pytest.approx({'pending': 0.0, 'running': 50.0})
+    assert st['groups']['gamma-prj']['pending'] == pytest.approx(24.0)
+
+    alloc.run(demand.saveState, st)
+    fake.pending = []
+    st = alloc.run(demand.pollDemand, datetime.date(2026, 10, 1))
+    assert st['n_samples'] == 2
+    assert st['groups']['alpha-prj']['pending'] == pytest.approx(4.0)
+
+    st = alloc.run(demand.pollDemand, datetime.date(2026, 10, 31))
+    assert st['n_samples'] == 1
+
+###################################################################################################
+
+# The blended fraction of a group is capped at max_factor times its static fraction, and the 
+# excess goes to the other groups.
+
+def test_applyDemand(cfg, alloc):
+
+    cfg['demand']['max_factor'] = 1.5
+    alloc.run(demand.saveState, {'period': '2026-10-01', 'n_samples': 3, 
+                                 'groups': {'a-prj': {'pending': 100.0, 'running': 0.0}}})
+    prd = {'w_tot': 4.0, 'groups': {'a-prj': {'weight': 1.0}, 'b-prj': {'weight': 1.0}, 'c-prj': {'weight': 2.0}}}
+    alloc.run(demand.applyDemand, prd, datetime.date(2026, 10, 31))
+    grps = prd['groups']
+
+    assert grps['a-prj']['weight_alloc'] == pytest.approx(1.5)
+    assert grps['b-prj']['weight_alloc'] == pytest.approx(0.175 * 4.0 / 0.525 * 0.625)
+    assert grps['c-prj']['weight_alloc'] == pytest.approx(0.35 * 4.0 / 0.525 * 0.625)
+    assert grps['c-prj']['weight_frac_static'] == pytest.approx(0.5)
+    assert prd['demand']['n_samples'] == 3
+
+    # The demand of the current period is not used
+    alloc.run(demand.applyDemand, prd, datetime.date(2026, 10, 1))
+    assert grps['a-prj']['weight_alloc'] == pytest.approx(1.0)
+
+###################################################################################################
+
+# The demand recorded in one period changes the weights in the next
+
+def test_demandCheck(cfg, fake, clock, alloc):
+
+    cfg['demand']['enabled'] = True
+    fake.pending = pending
+    alloc.check()
+    clock.advance(days = 1)
+    alloc.check()
+    clock.advance(days = 11)
+    alloc.check()
+    prd = readQuarter(alloc)['periods'][1]
+    grps = prd['groups']
+
+    assert prd['demand']['n_samples'] == 2
+    assert grps['alpha-prj']['demand'] == pytest.approx(8.0)
+    assert grps['gamma-prj']['weight_frac'] > grps['gamma-prj']['weight_frac_static']
+    assert grps['beta-prj']['weight_frac'] < grps['beta-prj']['weight_frac_static']
+    assert sum([grps[grp]['weight_frac'] for grp in grps]) == pytest.approx(1.0)
+
+###################################################################################################
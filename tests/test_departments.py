@@ -0,0 +1,121 @@
+###################################################################################################
+#
+# This file is part of the HPC allocator code for the UMD astronomy department
+#
+# (c) Benedikt Diemer
+#
+###################################################################################################
+
+import yaml
+import pytest
+
+import config
+import allocator
+import run
+
+###################################################################################################
+
+# Split the sample groups into two departments with their own Slurm accounts. The state files are
+# placed in directories named after the departments, unless they are given.
+
+def setDepartments(cfg, extra = {}):
+
+    for dept, grps, acct in [['astro', ['alpha-prj', 'beta-prj'], 'astr'], ['phys', ['gamma-prj'], 'phys']]:
+        dic = {'groups': {grp: cfg['groups'][grp] for grp in grps}, 'slurm_account': acct}
+        dic.update(extra.get(dept, {}))
+        f = open('config_%s.yaml' % (dept), 'w')
+        yaml.dump(dic, f)
+        f.close()
+    cfg['departments'] = {'astro': 'config_astro.yaml', 'phys': 'config_phys.yaml'}
+    cfg['scratch']['bulk_command'] = ['scratch_quota', '--users']
+
+    return
+
+###################################################################################################
+
+def readGroups(alloc, dept):
+
+    return yaml.safe_load(alloc.context.store['yaml/%s/groups_current.yaml' % (dept)])['grps_cur']
+
+###################################################################################################
+
+# Each department is allocated separately, but queries that are the same for all departments are 
+# run only once.
+
+def test_departments(cfg, fake, alloc, capsys):
+
+    setDepartments(cfg)
+    alloc.check()
+    out = capsys.readouterr().out
+
+    assert sorted(readGroups(alloc, 'astro').keys()) == ['alpha-prj', 'beta-prj']
+    assert sorted(readGroups(alloc, 'phys').keys()) == ['gamma-prj']
+    assert not cfg['yaml_file_grps_cur'] in alloc.context.store
+    assert len([c for c in fake.calls if c.startswith('scratch_quota')]) == 1
+    assert len(fake.calls) == len(set(fake.calls))
+    assert 'sbalance -account phys' in fake.calls
+    assert 'Checked 2 departments using %d distinct cluster queries.' % (len(fake.calls)) in out
+    assert sorted([email['to'] for email in alloc.context.outbox]) \
+        == ['u00@umd.edu, u01@umd.edu, u02@umd.edu', 'u10@umd.edu, u11@umd.edu', 'u20@umd.edu, u21@umd.edu']
+
+###################################################################################################
+
+# A failure in one department does not stop the others
+
+def test_departmentFailure(cfg, fake, alloc):
+
+    setDepartments(cfg)
+    fake.fail = ['-account phys']
+    with pytest.raises(Exception, match = r"Check failed for departments \['phys'\]"):
+        alloc.check()
+
+    assert sorted(readGroups(alloc, 'astro').keys()) == ['alpha-prj', 'beta-prj']
+
+###################################################################################################
+
+# Each department has its own state and output paths; paths set by a department are kept
+
+def test_departmentPaths(cfg, alloc):
+
+    setDepartments(cfg, extra = {'phys': {'snapshot_file': 'phys_snapshot.json'}})
+    alloc.run(config.getDepartments)
+    cfg_astro = alloc.run(config.loadDepartment, 'astro')
+    cfg_phys = alloc.run(config.loadDepartment, 'phys')
+
+    assert cfg_astro['yaml_dir'] == 'yaml/astro/'
+    assert cfg_astro['snapshot_file'] == 'yaml/astro/snapshot.json'
+    assert cfg_astro['email_archive']['dir'] == 'emails/astro/'
+    assert cfg_phys['enforce']['yaml_file'] == 'yaml/phys/enforce_state.yaml'
+    assert cfg_phys['snapshot_file'] == 'phys_snapshot.json'
+    for keys in config.department_paths:
+        assert config.getPath(cfg_astro, keys) != config.getPath(cfg_phys, keys)
+
+###################################################################################################
+
+def test_departmentSamePath(cfg, alloc):
+
+    setDepartments(cfg, extra = {'astro': {'snapshot_file': 'snapshot.json'},
+                                 'phys': {'snapshot_file': 'snapshot.json'}})
+    with pytest.raises(Exception, match = 'Departments astro and phys use the same path snapshot.json'):
+        alloc.check()
+
+###################################################################################################
+
+# On disk, the departments write their own records, and -mode myusage finds them all
+
+def test_departmentRecords(cfg, fake, clock, capsys):
+
+    fake.groups['gamma-prj']['users']['u00'] = {'su': 0.0, 'scratch': 0.0}
+    setDepartments(cfg)
+    alloc = allocator.Allocator(cfg = cfg, outbox = [], runner = fake, clock = clock, dry_run = False)
+    alloc.check()
+    capsys.readouterr()
+
+    run.printMyUsage(usr = 'u00', snapshot_dir = cfg['snapshot_dir'])
+    out = capsys.readouterr().out
+    assert out.startswith('alpha-prj: ')
+    assert '\ngamma-prj: ' in out
+    run.printMyUsage(usr = 'u10', snapshot_dir = cfg['snapshot_dir'])
+    assert capsys.readouterr().out.startswith('beta-prj: ')
+
+###################################################################################################
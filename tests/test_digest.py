@@ -0,0 +1,68 @@
+###################################################################################################
+#
+# This file is part of the HPC allocator code for the UMD astronomy department
+#
+# (c) Benedikt Diemer
+#
+###################################################################################################
+
+import messaging
+
+###################################################################################################
+
+# Without digests, each group message goes to all members of the group; with digests, each user
+# receives one email, even if they are in several groups.
+
+def test_digestOnePerRecipient(cfg, fake, alloc):
+
+    fake.groups['beta-prj']['users']['u00'] = {'su': 0.0, 'scratch': 0.0}
+    cfg['email_digest'] = True
+    alloc.check()
+
+    recipients = sorted([email['to'] for email in alloc.context.outbox])
+    assert recipients == ['u00@umd.edu', 'u01@umd.edu', 'u02@umd.edu', 'u10@umd.edu', 'u11@umd.edu',
+                          'u20@umd.edu', 'u21@umd.edu']
+    email = [email for email in alloc.context.outbox if email['to'] == 'u00@umd.edu'][0]
+    assert email['subject'] == '%s Allocation digest (2 notices)' % (messaging.subject_prefix)
+    assert '=== Group alpha-prj:' in email['content']
+    assert '=== Group beta-prj:' in email['content']
+
+###################################################################################################
+
+def test_noDigest(fake, alloc):
+
+    fake.groups['beta-prj']['users']['u00'] = {'su': 0.0, 'scratch': 0.0}
+    alloc.check()
+
+    assert len(alloc.context.outbox) == 3
+    assert 'u00@umd.edu' in alloc.context.outbox[0]['to']
+
+###################################################################################################
+
+# Identical notices are sent once, and the lead-only parts are not sent to the other members
+
+def test_digestDeduplication(alloc):
+
+    prd = {'groups': {'a-prj': {'lead': 'u1', 'users': {'u1': {}, 'u2': {}}},
+                      'b-prj': {'lead': 'u3', 'users': {'u2': {}, 'u3': {}}}}}
+
+    def dispatch():
+        messaging.startDigest()
+        for grp in ['a-prj', 'b-prj']:
+            messaging.dispatchMessage(prd, grp, 'Notice', [['Same text.\n', 'all']], 'other')
+        messaging.dispatchMessage(prd, 'a-prj', 'Details', [['Lead text.\n', 'lead'], ['Member text.\n', 'member']], 'other')
+        messaging.flushDigest(verbose = False)
+        return
+
+    alloc.run(dispatch)
+    emails = {email['to']: email for email in alloc.context.outbox}
+
+    assert sorted(emails.keys()) == ['u1@umd.edu', 'u2@umd.edu', 'u3@umd.edu']
+    assert emails['u2@umd.edu']['content'].count('Same text.') == 1
+    assert 'Member text.' in emails['u2@umd.edu']['content']
+    assert not 'Lead text.' in emails['u2@umd.edu']['content']
+    assert 'Lead text.' in emails['u1@umd.edu']['content']
+    assert not 'Member text.' in emails['u1@umd.edu']['content']
+    assert emails['u3@umd.edu']['subject'] == 'Notice'
+
+###################################################################################################
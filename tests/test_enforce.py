@@ -0,0 +1,169 @@
+###################################################################################################
+#
+# This file is part of the HPC allocator code for the UMD astronomy department
+#
+# (c) Benedikt Diemer
+#
+###################################################################################################
+
+import allocator
+import enforce
+from conftest import readState
+
+###################################################################################################
+
+def enableEnforcement(cfg, dry_run = False):
+
+    cfg['enforce']['enabled'] = True
+    cfg['enforce']['dry_run'] = dry_run
+
+    return
+
+###################################################################################################
+
+def getPushes(fake):
+
+    return [fake.inputs[i] for i in range(len(fake.calls)) if fake.calls[i] == 'sacctmgr -i']
+
+###################################################################################################
+
+def getTransactionFiles(alloc):
+
+    return sorted([k for k in alloc.context.store if k.startswith('enforce/')])
+
+###################################################################################################
+
+# All groups are updated in one sacctmgr call; a second check without changes pushes nothing
+
+def test_pushLimits(cfg, fake, clock, alloc):
+
+    enableEnforcement(cfg)
+    alloc.check()
+    pushes = getPushes(fake)
+    limits = readState(alloc, cfg['enforce']['yaml_file'])['limits']
+
+    assert len(pushes) == 1
+    assert pushes[0].count('modify account where name=') == 3
+    assert sorted(limits.keys()) == ['alpha-prj-astr', 'beta-prj-astr', 'gamma-prj-astr']
+    assert 'set GrpTRESMins=billing=%d' % (limits['beta-prj-astr']) in pushes[0]
+    assert len(getTransactionFiles(alloc)) == 2
+
+    clock.advance(days = 1)
+    alloc.check()
+    assert len(getPushes(fake)) == 1
+    assert len(getTransactionFiles(alloc)) == 2
+
+###################################################################################################
+
+# Only the limits that differ from the last push are sent
+
+def test_pushDiff(cfg, fake, clock, alloc):
+
+    enableEnforcement(cfg)
+    alloc.check()
+    state = readState(alloc, cfg['enforce']['yaml_file'])
+    state['limits']['beta-prj-astr'] += 1000
+    alloc.run(enforce.saveState, state)
+    clock.advance(days = 1)
+    alloc.check()
+    pushes = getPushes(fake)
+
+    assert len(pushes) == 2
+    assert pushes[1].count('modify account') == 1
+    assert 'name=beta-prj-astr' in pushes[1]
+
+###################################################################################################
+
+# A dry run of the allocator neither writes transaction files nor pushes; an enforcement dry run 
+# writes the files but does not apply them.
+
+def test_dryRuns(cfg, fake, clock):
+
+    enableEnforcement(cfg)
+    alloc = allocator.Allocator(cfg = cfg, store = {}, outbox = [], runner = fake, clock = clock, dry_run = True)
+    alloc.check()
+    assert len(getPushes(fake)) == 0
+    assert len(getTransactionFiles(alloc)) == 0
+
+    enableEnforcement(cfg, dry_run = True)
+    alloc = allocator.Allocator(cfg = cfg, store = {}, outbox = [], runner = fake, clock = clock, dry_run = False)
+    alloc.check()
+    assert len(getPushes(fake)) == 0
+    assert len(getTransactionFiles(alloc)) == 2
+    assert not cfg['enforce']['yaml_file'] in alloc.context.store
+
+###################################################################################################
+
+# Transactions written at the same time get different file names
+
+def test_uniqueFileNames(cfg, alloc):
+
+    def writeTwo():
+        fnames = []
+        for i in range(2):
+            fname, fname_rollback = enforce.getTransactionFiles()
+            enforce.writeTransaction(fname, [], 'Test')
+            fnames += [fname, fname_rollback]
+        return fnames
+
+    fnames = alloc.run(writeTwo)
+
+    assert len(set(fnames)) == 4
+
+###################################################################################################
+
+# A rollback applies the previous limits and restores the state before the last push
+
+def test_rollback(cfg, fake, clock, alloc):
+
+    enableEnforcement(cfg)
+    alloc.check()
+    state = readState(alloc, cfg['enforce']['yaml_file'])
+    limits_first = dict(state['limits'])
+    state['limits']['beta-prj-astr'] += 1000
+    alloc.run(enforce.saveState, state)
+    clock.advance(days = 1)
+    alloc.check()
+
+    alloc.run(enforce.rollbackLimits)
+    pushes = getPushes(fake)
+    state = readState(alloc, cfg['enforce']['yaml_file'])
+
+    assert len(pushes) == 3
+    assert 'name=beta-prj-astr set GrpTRESMins=billing=%d' % (limits_first['beta-prj-astr'] + 1000) in pushes[2]
+    assert state['limits']['beta-prj-astr'] == limits_first['beta-prj-astr'] + 1000
+    assert len(state['history']) == 1
+
+    alloc.run(enforce.rollbackLimits)
+    pushes = getPushes(fake)
+    assert 'name=alpha-prj-astr set GrpTRESMins=billing=%d' % (enforce.no_limit) in pushes[3]
+    assert readState(alloc, cfg['enforce']['yaml_file'])['limits'] == {}
+
+###################################################################################################
+
+# If the push fails, the check still saves its state, so that the next check neither sends the
+# same emails again nor skips the push
+
+def test_pushFails(cfg, fake, clock, alloc):
+
+    enableEnforcement(cfg)
+    fake.fail = ['sacctmgr -i']
+    alloc.check()
+    n_emails = len(alloc.context.outbox)
+
+    assert n_emails > 0
+    assert len(getPushes(fake)) == 1
+    assert readState(alloc, 'yaml_file_cfg')['prev_p'] == 0
+    assert not cfg['enforce']['yaml_file'] in alloc.context.store
+
+    fake.fail = []
+    clock.advance(hours = 1)
+    alloc.check()
+    pushes = getPushes(fake)
+
+    assert len(alloc.context.outbox) == n_emails
+    assert len(pushes) == 2
+    assert pushes[1].count('modify account where name=') == 3
+    assert len(readState(alloc, cfg['enforce']['yaml_file'])['limits']) == 3
+
+###################################################################################################
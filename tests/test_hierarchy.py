@@ -0,0 +1,102 @@
+###################################################################################################
+#
+# This file is part of the HPC allocator code for the UMD astronomy department
+#
+# (c) Benedikt Diemer
+#
+###################################################################################################
+
+import pytest
+
+import hierarchy
+from conftest import readQuarter
+
+###################################################################################################
+
+subprojects = {'sims': {'users': ['u01'], 'subprojects': {'gpu': {'users': ['u02'], 'weight': 0.5}}},
+               'obs': {'warning_levels': [90, 100]}}
+
+###################################################################################################
+
+def test_makeSubprojects():
+
+    subs = hierarchy.makeSubprojects({'subprojects': subprojects}, [50, 100])
+
+    assert sorted(subs.keys()) == ['obs', 'sims', 'sims/gpu']
+    assert subs['sims/gpu'] == {'users': ['u02'], 'weight_cfg': 0.5, 'warning_levels': [50, 100]}
+    assert subs['obs']['warning_levels'] == [90, 100]
+    with pytest.raises(Exception, match = 'cannot contain'):
+        hierarchy.makeSubprojects({'subprojects': {'a/b': {}}}, [100])
+
+###################################################################################################
+
+# The allocation of each node is split among its children and its own users by weight. A weight
+# that is not set is the sum of the weights below the node, and penalties are subtracted from the
+# share of the node that incurred them.
+
+def test_allocateTree(cfg, alloc):
+
+    grp_cfg = {'subprojects': subprojects}
+    prd = {'groups': {'a-prj': {'weight': 2.0, 'users': {'u00': {'weight': 1.0}, 'u01': {'weight': 0.6},
+                                                         'u02': {'weight': 0.2}},
+                                'subprojects': hierarchy.makeSubprojects(grp_cfg, [100])},
+                      'b-prj': {'weight': 2.0, 'users': {'u10': {'weight': 1.0}}}}}
+
+    def allocate():
+        tr = hierarchy.buildTree(prd)
+        hierarchy.aggregateTree(tr)
+        for i in range(len(tr['grp'])):
+            tr['penalty_old'][i] = 100.0 if (tr['sub'][i] == 'sims') else 0.0
+        hierarchy.allocateTree(tr, 1000.0)
+        hierarchy.storeTree(tr, prd, ['alloc', 'weight', 'penalty_new'], include_groups = True)
+        return
+
+    alloc.run(allocate)
+    subs = prd['groups']['a-prj']['subprojects']
+
+    assert prd['groups']['a-prj']['alloc'] == pytest.approx(500.0)
+    assert subs['sims']['weight'] == pytest.approx(1.1)
+    assert subs['obs']['weight'] == pytest.approx(0.0)
+    assert subs['sims']['alloc'] == pytest.approx(500.0 * 1.1 / 2.1 - 100.0)
+    assert subs['sims/gpu']['alloc'] == pytest.approx((500.0 * 1.1 / 2.1 - 100.0) * 0.5 / 1.1)
+    assert subs['obs']['alloc'] == 0.0
+
+###################################################################################################
+
+def test_getCrossedLevel():
+
+    assert hierarchy.getCrossedLevel(0.0, 60.0, 100.0, [50, 80, 100]) == 0
+    assert hierarchy.getCrossedLevel(60.0, 110.0, 100.0, [50, 80, 100]) == 2
+    assert hierarchy.getCrossedLevel(60.0, 70.0, 100.0, [50, 80, 100]) == -1
+    assert hierarchy.getCrossedLevel(60.0, 70.0, 80.0, [50, 80, 100], su_alloc_old = 100.0) == 1
+
+###################################################################################################
+
+# The sub-projects in the config are allocated with the group, and are warned separately
+
+def test_subprojectWarning(cfg, fake, clock, alloc):
+
+    cfg['groups']['alpha-prj']['subprojects'] = subprojects
+    cfg['refresh']['su_usage'] = 10
+    alloc.check()
+    grp_data = readQuarter(alloc)['periods'][0]['groups']['alpha-prj']
+    subs = grp_data['subprojects']
+    n_emails = len(alloc.context.outbox)
+
+    assert sorted(subs.keys()) == ['obs', 'sims', 'sims/gpu']
+    assert subs['sims']['alloc'] == pytest.approx(grp_data['alloc'] * 0.8 / 1.8)
+    assert subs['sims/gpu']['alloc'] == pytest.approx(subs['sims']['alloc'] * 0.5 / 0.8)
+
+    fake.addUsage('alpha-prj', subs['sims/gpu']['alloc'] * 0.9, usr = 'u02')
+    clock.advance(hours = 1)
+    alloc.check()
+    emails = alloc.context.outbox[n_emails:]
+
+    # Only gpu crosses a level; the usage in the first period includes the 10 kSU of each user from
+    # the start of the quarter.
+    su_gpu = subs['sims/gpu']['alloc'] * 0.9 + 10000.0
+    assert [email['subject'] for email in emails] \
+        == ['[Astro HPC] Warning: %.0f%% of sub-project allocation used up' % (su_gpu / subs['sims/gpu']['alloc'] * 100.0)]
+    assert 'sub-project sims/gpu' in emails[0]['content']
+
+###################################################################################################
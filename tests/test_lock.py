@@ -0,0 +1,215 @@
+###################################################################################################
+#
+# This file is part of the HPC allocator code for the UMD astronomy department
+#
+# (c) Benedikt Diemer
+#
+###################################################################################################
+
+import os
+import fcntl
+import threading
+import pytest
+
+import config
+import allocator
+import lock
+
+###################################################################################################
+
+# Hold the lock as another instance would, with an open file description of its own
+
+def holdLock(cfg):
+
+    f = open(cfg['lock']['file'], 'a+')
+    assert lock.tryLock(f)
+    f.write('pid: 1\nhost: other\ntime: 0.0\n')
+    f.flush()
+
+    return f
+
+###################################################################################################
+
+def releaseLock(f):
+
+    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    f.close()
+
+    return
+
+###################################################################################################
+
+# An allocator that keeps its state on disk and thus uses the lock file
+
+@pytest.fixture
+def alloc_file(cfg):
+
+    return allocator.Allocator(cfg = cfg)
+
+###################################################################################################
+
+def test_runExclusive(cfg, alloc_file):
+
+    calls = []
+    assert alloc_file.run(lock.runExclusive, lambda: calls.append(1))
+    assert len(calls) == 1
+
+    # The lock is released afterwards, also if the function fails
+    def fail():
+        raise Exception('Failure.')
+    with pytest.raises(Exception, match = 'Failure'):
+        alloc_file.run(lock.runExclusive, fail)
+    f = holdLock(cfg)
+    releaseLock(f)
+
+###################################################################################################
+
+def test_skip(cfg, alloc_file, capsys):
+
+    cfg['lock']['policy'] = 'skip'
+    calls = []
+    f = holdLock(cfg)
+    try:
+        assert not alloc_file.run(lock.runExclusive, lambda: calls.append(1))
+    finally:
+        releaseLock(f)
+
+    assert len(calls) == 0
+    assert 'pid 1 on other' in capsys.readouterr().out
+    assert not os.path.exists(alloc_file.run(lock.getPendingFile))
+
+###################################################################################################
+
+# Runs that overlap with a running check leave a request, and the running check is repeated once,
+# however many requests arrived.
+
+@pytest.mark.parametrize('store', [None, {}])
+def test_coalesce(cfg, store):
+
+    cfg['lock']['policy'] = 'coalesce'
+    alloc = allocator.Allocator(cfg = cfg, store = store)
+    calls = []
+
+    def check():
+        calls.append(1)
+        if len(calls) == 1:
+            for i in range(3):
+                assert not lock.runExclusive(lambda: calls.append(-1))
+        return
+
+    assert alloc.run(lock.runExclusive, check)
+    assert calls == [1, 1]
+    assert not os.path.exists(alloc.run(lock.getPendingFile))
+    assert not alloc.context.check_pending
+
+###################################################################################################
+
+# A request that arrives just before the holder releases the lock still leads to a follow-up run
+
+def test_coalesceLateRequest(cfg, alloc_file, monkeypatch):
+
+    cfg['lock']['policy'] = 'coalesce'
+    calls = []
+    flock = fcntl.flock
+
+    def flockLate(fd, op):
+        if (op == fcntl.LOCK_UN) and (len(calls) == 1):
+            open(alloc_file.run(lock.getPendingFile), 'w').close()
+        flock(fd, op)
+        return
+
+    monkeypatch.setattr(lock.fcntl, 'flock', flockLate)
+    assert alloc_file.run(lock.runExclusive, lambda: calls.append(1))
+    assert calls == [1, 1]
+    assert not os.path.exists(alloc_file.run(lock.getPendingFile))
+
+###################################################################################################
+
+# A holder file that is incomplete or being written does not cause an error
+
+def test_holderString(tmp_path):
+
+    assert lock.holderString({'pid': 1, 'host': 'other', 'time': 0.0}).startswith('pid 1 on other')
+    assert lock.holderString({'pid': 1}) == 'unknown holder'
+    assert lock.holderString(None) == 'unknown holder'
+
+    f = open(str(tmp_path / 'holder'), 'w+')
+    f.write('pid: 1\nhost: [oth')
+    assert lock.readHolder(f) is None
+    f.close()
+
+###################################################################################################
+
+def test_wait(cfg, alloc_file):
+
+    cfg['lock']['policy'] = 'wait'
+    cfg['lock']['wait_timeout'] = 0
+    calls = []
+    f = holdLock(cfg)
+    try:
+        with pytest.raises(Exception, match = 'Could not acquire lock'):
+            alloc_file.run(lock.runExclusive, lambda: calls.append(1))
+    finally:
+        releaseLock(f)
+
+    alloc_file.run(config.getConfig)['lock']['wait_timeout'] = 10
+    f = holdLock(cfg)
+    t = threading.Timer(0.2, releaseLock, args = (f,))
+    t.start()
+    assert alloc_file.run(lock.runExclusive, lambda: calls.append(1))
+    t.join()
+    assert len(calls) == 1
+
+###################################################################################################
+
+def test_unknownPolicy(cfg, alloc):
+
+    cfg['lock']['policy'] = 'queue'
+    with pytest.raises(Exception, match = 'Unknown lock policy'):
+        alloc.run(lock.runExclusive, lambda: None)
+
+###################################################################################################
+
+def test_printLockInfo(cfg, alloc_file, capsys):
+
+    alloc_file.run(lock.printLockInfo)
+    assert capsys.readouterr().out == 'No check is running.\n'
+
+    f = holdLock(cfg)
+    try:
+        alloc_file.run(lock.printLockInfo)
+    finally:
+        releaseLock(f)
+    assert capsys.readouterr().out.startswith('Check is running (pid 1 on other')
+
+###################################################################################################
+
+# Allocators that keep their state in memory have their own locks, even with the same config, and
+# are not blocked by the lock file
+
+def test_memoryLock(cfg, capsys):
+
+    cfg['lock']['policy'] = 'skip'
+    alloc1 = allocator.Allocator(cfg = cfg, store = {})
+    alloc2 = allocator.Allocator(cfg = cfg, store = {})
+    calls = []
+
+    def check():
+        calls.append(1)
+        assert alloc2.run(lock.runExclusive, lambda: calls.append(2))
+        assert not lock.runExclusive(lambda: calls.append(-1))
+        lock.printLockInfo()
+        return
+
+    f = holdLock(cfg)
+    try:
+        assert alloc1.run(lock.runExclusive, check)
+    finally:
+        releaseLock(f)
+
+    assert calls == [1, 2]
+    assert 'Check is running (pid %d' % (os.getpid()) in capsys.readouterr().out
+    alloc1.run(lock.printLockInfo)
+    assert capsys.readouterr().out == 'No check is running.\n'
+
+###################################################################################################
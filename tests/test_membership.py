@@ -0,0 +1,112 @@
+###################################################################################################
+#
+# This file is part of the HPC allocator code for the UMD astronomy department
+#
+# (c) Benedikt Diemer
+#
+###################################################################################################
+
+import config
+import membership
+from conftest import readState
+
+###################################################################################################
+
+def setMembership(cfg, fake):
+
+    cfg['membership']['enabled'] = True
+    fake.unix_groups = {'alpha-prj': ['u00', 'u01', 'u02'], 'beta-prj': ['u10'], 'gamma-prj': ['u20', 'u21'],
+                        'other-prj': ['x1']}
+    fake.associations = ['beta-prj-astr|', 'beta-prj-astr|u11', 'beta-prj-astr|u12', 'other-prj-phys|x2']
+
+    return
+
+###################################################################################################
+
+def test_collectMembership(cfg, fake, alloc):
+
+    setMembership(cfg, fake)
+    members = alloc.run(membership.collectMembership)
+
+    assert members == {'alpha-prj': ['u00', 'u01', 'u02'], 'beta-prj': ['u10', 'u11', 'u12'], 
+                       'gamma-prj': ['u20', 'u21']}
+
+###################################################################################################
+
+def test_diffMembership():
+
+    changes = membership.diffMembership({'a-prj': ['u1', 'u2'], 'b-prj': ['u3']},
+                                        {'a-prj': ['u2', 'u4'], 'b-prj': ['u3'], 'c-prj': ['u5']})
+
+    assert changes == {'a-prj': {'added': ['u4'], 'removed': ['u1']}}
+
+###################################################################################################
+
+# Members without scratch usage are found, and users with usage who are no longer members are kept
+# with zero weight. The membership is cached for the refresh interval.
+
+def test_membershipCheck(cfg, fake, clock, alloc):
+
+    setMembership(cfg, fake)
+    fake.unix_groups['alpha-prj'] = ['u00', 'u01']
+    alloc.check()
+    grps = readState(alloc, 'yaml_file_grps_cur')['grps_cur']
+
+    assert sorted(grps['beta-prj']['users'].keys()) == ['u10', 'u11', 'u12']
+    assert grps['beta-prj']['users']['u12']['scratch_usage'] == 0.0
+    assert grps['alpha-prj']['users']['u02']['weight'] == 0.0
+    assert grps['alpha-prj']['users']['u02']['past_user']
+    assert grps['alpha-prj']['users']['u02']['su_usage'] == 10000.0
+    assert grps['alpha-prj']['su_usage'] == 30000.0
+    n_getent = fake.calls.count('getent group')
+
+    fake.unix_groups['alpha-prj'] = ['u00', 'u01', 'u02']
+    clock.advance(minutes = 30)
+    alloc.run(config.getConfig)['refresh']['su_usage'] = 10
+    alloc.check()
+    assert fake.calls.count('getent group') == n_getent
+
+    clock.advance(minutes = 40)
+    alloc.check()
+    st = readState(alloc, cfg['membership']['yaml_file'])
+    grps = readState(alloc, 'yaml_file_grps_cur')['grps_cur']
+
+    assert fake.calls.count('getent group') == n_getent + 1
+    assert st['changes'] == {'alpha-prj': {'added': ['u02'], 'removed': []}}
+    assert grps['alpha-prj']['users']['u02']['weight'] > 0.0
+
+###################################################################################################
+
+# Without a refresh interval, the membership is only read if there is none yet or if groups were
+# added to the config
+
+def test_refreshNull(cfg, fake, alloc):
+
+    setMembership(cfg, fake)
+    cfg['membership']['refresh'] = None
+    st = {'time': 1000.0, 'groups': {'alpha-prj': [], 'beta-prj': [], 'gamma-prj': []}, 'changes': {}}
+
+    assert alloc.run(membership.isRefreshDue, st = {'time': None, 'groups': {}, 'changes': {}})
+    assert not alloc.run(membership.isRefreshDue, st = st, t_now = 1E9)
+    del st['groups']['gamma-prj']
+    assert alloc.run(membership.isRefreshDue, st = st, t_now = 1E9)
+
+###################################################################################################
+
+# Groups without any members are reported, also when the membership is taken from the cache
+
+def test_emptyGroup(cfg, fake, clock, alloc, capsys):
+
+    setMembership(cfg, fake)
+    del fake.unix_groups['gamma-prj']
+    alloc.run(membership.getMembership)
+    alloc.run(membership.saveState)
+    assert 'WARNING: Found no members of group gamma-prj' in capsys.readouterr().out
+
+    alloc.run(membership.getMembership)
+    out = capsys.readouterr().out
+    assert 'Using cached group membership' in out
+    assert 'WARNING: Found no members of group gamma-prj' in out
+    assert not 'alpha-prj' in out
+
+###################################################################################################
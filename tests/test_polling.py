@@ -0,0 +1,134 @@
+###################################################################################################
+#
+# This file is part of the HPC allocator code for the UMD astronomy department
+#
+# (c) Benedikt Diemer
+#
+###################################################################################################
+
+import datetime
+import pytest
+
+import polling
+
+###################################################################################################
+
+# The accounts whose SU usage was queried from the fake cluster
+
+def getPolledGroups(fake):
+
+    grps = []
+    for c in fake.calls:
+        w = c.split(' ')
+        if (w[0] == 'sbalance') and ('--all' in w):
+            grps.append(w[w.index('-account') + 1].rsplit('-', 1)[0])
+
+    return grps
+
+###################################################################################################
+
+def makePeriod(su_usage):
+
+    prd = {'start_date': datetime.date(2026, 10, 1), 'end_date': datetime.date(2026, 10, 30), 'groups': {}}
+    for grp in su_usage:
+        prd['groups'][grp] = {'alloc': 10000.0, 'su_usage': su_usage[grp]}
+
+    return prd
+
+###################################################################################################
+
+def test_getTimeToLevel(alloc):
+
+    assert alloc.run(polling.getTimeToLevel, {'alloc': 10000.0, 'su_usage': 5000.0}, 1.0) == pytest.approx(3000.0)
+    assert alloc.run(polling.getTimeToLevel, {'alloc': 10000.0, 'su_usage': 9000.0}, 1.0) == pytest.approx(1000.0)
+    assert alloc.run(polling.getTimeToLevel, {'alloc': 10000.0, 'su_usage': 5000.0, 'warning_levels': [50, 100]},
+                     2.0) == pytest.approx(2500.0)
+    assert alloc.run(polling.getTimeToLevel, {'alloc': 10000.0, 'su_usage': 10000.0}, 1.0) is None
+    assert alloc.run(polling.getTimeToLevel, {'alloc': 10000.0, 'su_usage': 5000.0}, 0.0) is None
+
+###################################################################################################
+
+# Groups that have never been polled are due, the others once their next poll time has passed
+
+def test_getDueGroups(alloc):
+
+    st = {'alpha-prj': {'next': 100.0}, 'beta-prj': {'next': 200.0}}
+
+    assert alloc.run(polling.getDueGroups, st, 150.0) == ['alpha-prj', 'gamma-prj']
+    assert alloc.run(polling.getDueGroups, st, 50.0) == ['gamma-prj']
+
+###################################################################################################
+
+# A group close to its next level is polled after min_interval, an idle group after max_interval,
+# and a group in between after a fraction safety of the time until it reaches the level.
+
+def test_updateState(cfg, alloc):
+
+    cfg['polling']['min_interval'] = 10
+    cfg['polling']['max_interval'] = 1440
+    cfg['polling']['safety'] = 0.5
+    t0 = 1000000.0
+    st = {}
+    for grp in ['a-prj', 'b-prj', 'c-prj']:
+        st[grp] = {'time': t0, 'su_usage': 0.0, 'rate': None, 'next': t0}
+    prd = makePeriod({'a-prj': 7900.0, 'b-prj': 0.0, 'c-prj': 4000.0})
+    grps_cur = {'a-prj': {'su_usage': 7900.0}, 'b-prj': {'su_usage': 0.0}, 'c-prj': {'su_usage': 4000.0}}
+    alloc.run(polling.updateState, st, prd, grps_cur, ['a-prj', 'b-prj', 'c-prj'], t0 + 40000.0)
+
+    assert st['a-prj']['rate'] == pytest.approx(7900.0 / 40000.0)
+    assert st['a-prj']['next'] == pytest.approx(t0 + 40000.0 + 600.0)
+    assert st['b-prj']['next'] == pytest.approx(t0 + 40000.0 + 86400.0)
+    assert st['c-prj']['next'] == pytest.approx(t0 + 40000.0 + 0.5 * 4000.0 / 0.1)
+
+###################################################################################################
+
+# The burn rate is smoothed over polls; a group with stale data is retried after min_interval, and
+# a group without a rate is polled again after min_interval.
+
+def test_updateStateRate(cfg, alloc):
+
+    cfg['polling']['smoothing'] = 0.5
+    st = {'a-prj': {'time': 0.0, 'su_usage': 0.0, 'rate': 1.0, 'next': 0.0}}
+    prd = makePeriod({'a-prj': 3000.0, 'b-prj': 0.0})
+    alloc.run(polling.updateState, st, prd, {'a-prj': {'su_usage': 3000.0}}, ['a-prj'], 1000.0)
+    assert st['a-prj']['rate'] == pytest.approx(2.0)
+
+    grps_cur = {'a-prj': {'su_usage': 3000.0, 'stale': True}, 'b-prj': {'su_usage': 0.0}}
+    alloc.run(polling.updateState, st, prd, grps_cur, ['a-prj', 'b-prj'], 2000.0)
+    assert st['a-prj']['rate'] == pytest.approx(2.0)
+    assert st['a-prj']['next'] == pytest.approx(2000.0 + cfg['polling']['min_interval'] * 60.0)
+    assert st['b-prj']['rate'] is None
+    assert st['b-prj']['next'] == pytest.approx(2000.0 + cfg['polling']['min_interval'] * 60.0)
+
+###################################################################################################
+
+# Within a period, only the groups that are due are queried; a new period queries all groups
+
+def test_pollingCheck(cfg, fake, clock, alloc):
+
+    cfg['polling']['enabled'] = True
+    alloc.check()
+    assert sorted(getPolledGroups(fake)) == ['alpha-prj', 'beta-prj', 'gamma-prj']
+    st = alloc.run(polling.loadState)
+    assert sorted(st.keys()) == ['alpha-prj', 'beta-prj', 'gamma-prj']
+    t_next = clock.now.timestamp() + cfg['polling']['max_interval'] * 60.0
+    assert st['alpha-prj']['next'] == pytest.approx(t_next)
+
+    # All groups are far from their first level and are not due for a day
+    fake.calls = []
+    clock.advance(hours = 2)
+    alloc.check()
+    assert getPolledGroups(fake) == []
+
+    st['beta-prj']['next'] = 0.0
+    alloc.run(polling.saveState, st)
+    clock.advance(hours = 2)
+    alloc.check()
+    assert getPolledGroups(fake) == ['beta-prj']
+
+    fake.calls = []
+    clock.now = datetime.datetime(2026, 10, 31, 12, 0, 0)
+    alloc.check()
+    assert sorted(getPolledGroups(fake)) == ['alpha-prj', 'beta-prj', 'gamma-prj']
+
+###################################################################################################
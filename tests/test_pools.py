@@ -0,0 +1,81 @@
+###################################################################################################
+#
+# This file is part of the HPC allocator code for the UMD astronomy department
+#
+# (c) Benedikt Diemer
+#
+###################################################################################################
+
+import pytest
+
+import pools
+from conftest import readQuarter
+
+###################################################################################################
+
+def setPools(cfg):
+
+    cfg['accounting']['enabled'] = True
+    cfg['refresh']['su_usage'] = 10
+    cfg['pools'] = {'gpu': {'label': 'GPU hours', 'unit': 'GPU-h', 'quarter_total': 20000.0, 
+                            'tres_weights': {'gres/gpu': 1.0}, 'alloc_frac': None, 'penalty_factor': 1.0, 
+                            'warning_levels': [80, 100]}}
+
+    return
+
+###################################################################################################
+
+def test_poolsRequireAccounting(cfg, alloc):
+
+    setPools(cfg)
+    cfg['accounting']['enabled'] = False
+    with pytest.raises(Exception, match = 'require job accounting'):
+        alloc.run(pools.getPools)
+
+###################################################################################################
+
+# The pools are split among the groups with the same weights as the SUs, and their usage is 
+# computed from the same job records.
+
+def test_poolAllocation(cfg, fake, clock, alloc):
+
+    setPools(cfg)
+    alloc.check()
+    prd = readQuarter(alloc)['periods'][0]
+    n_emails = len(alloc.context.outbox)
+
+    assert prd['pools']['gpu'] == pytest.approx({'avail': 20000.0, 'alloc': 18000.0})
+    for grp in prd['groups']:
+        assert prd['groups'][grp]['pools']['gpu']['alloc'] == pytest.approx(18000.0 * prd['groups'][grp]['weight_frac'])
+
+    gpu_alloc = prd['groups']['beta-prj']['pools']['gpu']['alloc']
+    fake.addJob('beta-prj', 'u11', clock.now, hours = gpu_alloc * 0.85, gpus = 1, partition = 'gpu')
+    clock.advance(hours = 1)
+    alloc.check()
+    grp_data = readQuarter(alloc)['periods'][0]['groups']['beta-prj']
+    emails = alloc.context.outbox[n_emails:]
+
+    assert grp_data['pools']['gpu']['usage'] == pytest.approx(gpu_alloc * 0.85, rel = 1E-4)
+    assert grp_data['su_usage'] == pytest.approx(gpu_alloc * 0.85 * 49.0, rel = 1E-4)
+    assert [email['subject'] for email in emails if 'GPU' in email['subject']] \
+        == ['[Astro HPC] Warning: 85% of GPU hours allocation used up']
+
+###################################################################################################
+
+# In a new period, usage beyond the allocation becomes a penalty
+
+def test_poolPenalty(cfg, alloc):
+
+    setPools(cfg)
+    prd_old = {'groups': {'a-prj': {'pools': {'gpu': {'alloc': 100.0, 'usage_start': 0.0, 'penalty_new': 0.0}}}}}
+    prd_new = {'groups': {'a-prj': {'weight_frac': 1.0}}}
+    grps_cur = {'a-prj': {'pool_usage': {'gpu': 150.0}}}
+    alloc.run(pools.startPeriod, prd_new, prd_old, grps_cur, grps_cur, 1, False)
+    pool = prd_new['groups']['a-prj']['pools']['gpu']
+
+    assert prd_old['groups']['a-prj']['pools']['gpu']['usage'] == pytest.approx(150.0)
+    assert pool['penalty_old'] == pytest.approx(50.0)
+    assert pool['alloc'] == pytest.approx((20000.0 - 150.0) * 1.5 - 50.0)
+    assert pool['usage_start'] == pytest.approx(150.0)
+
+###################################################################################################
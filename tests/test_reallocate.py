@@ -0,0 +1,165 @@
+###################################################################################################
+#
+# This file is part of the HPC allocator code for the UMD astronomy department
+#
+# (c) Benedikt Diemer
+#
+###################################################################################################
+
+import datetime
+import pytest
+
+import config
+import messaging
+import reallocate
+from conftest import readQuarter
+
+###################################################################################################
+
+# A period of 30 days with 30 kSU split evenly between two groups with one user each
+
+def makePeriod():
+
+    prd = {'start_date': datetime.date(2026, 10, 1), 'end_date': datetime.date(2026, 10, 30),
+           'su_alloc': 30000.0, 'w_tot': 2.0, 'groups': {}}
+    for grp in ['a-prj', 'b-prj']:
+        usr = 'u' + grp[0]
+        prd['groups'][grp] = {'alloc': 15000.0, 'su_usage': 5000.0, 'weight': 1.0, 'weight_frac': 0.5,
+                              'penalty_new': 0.0, 'lead': usr,
+                              'users': {usr: {'weight': 1.0, 'multi_grp': False, 'su_usage': 5000.0}}}
+
+    return prd
+
+###################################################################################################
+
+def makeGroups(weights):
+
+    grps_cur = {}
+    for grp in weights:
+        usr = 'u' + grp[0]
+        grps_cur[grp] = {'weight': weights[grp], 'su_usage': 5000.0, 'lead': usr,
+                         'users': {usr: {'weight': weights[grp], 'multi_grp': False, 'su_usage': 5000.0}}}
+
+    return grps_cur
+
+###################################################################################################
+
+# Halfway through the period, half of the allocation is split again. The added group receives its
+# share of the remaining allocation, the other groups give up the difference, and the total is
+# conserved.
+
+def test_reallocateAdded(cfg, alloc):
+
+    prd = makePeriod()
+    grps_cur = makeGroups({'a-prj': 1.0, 'b-prj': 1.0, 'c-prj': 2.0})
+    alloc.run(reallocate.reallocatePeriod, prd, grps_cur, 0, datetime.date(2026, 10, 16), do_send = True)
+    grps = prd['groups']
+
+    assert grps['c-prj']['weight_frac'] == pytest.approx(0.5)
+    assert grps['c-prj']['alloc'] == pytest.approx(7500.0)
+    assert grps['c-prj']['su_usage'] == 0.0
+    assert grps['c-prj']['su_usage_start'] == pytest.approx(5000.0)
+    assert grps['a-prj']['alloc'] == pytest.approx(11250.0)
+    assert grps['b-prj']['alloc'] == pytest.approx(11250.0)
+    assert sum([grps[grp]['alloc'] for grp in grps]) == pytest.approx(30000.0)
+    assert prd['w_tot'] == pytest.approx(4.0)
+
+    assert len(prd['reallocate']) == 1
+    assert prd['reallocate'][0]['added'] == ['c-prj']
+    assert prd['reallocate'][0]['su_remaining'] == pytest.approx(15000.0)
+    assert sorted([email['to'] for email in alloc.context.outbox]) == ['ua@umd.edu', 'ub@umd.edu', 'uc@umd.edu']
+
+###################################################################################################
+
+# A change in weight shifts the remaining allocation; users who left no longer carry weight
+
+def test_reallocateChanged(cfg, alloc):
+
+    prd = makePeriod()
+    grps_cur = makeGroups({'a-prj': 3.0, 'b-prj': 1.0})
+    grps_cur['a-prj']['users'] = {'ux': {'weight': 3.0, 'multi_grp': False, 'su_usage': 0.0}}
+    alloc.run(reallocate.reallocatePeriod, prd, grps_cur, 0, datetime.date(2026, 10, 16))
+    grps = prd['groups']
+
+    assert prd['reallocate'][0]['changed'] == ['a-prj']
+    assert grps['a-prj']['weight'] == 3.0
+    assert grps['a-prj']['users']['ua']['weight'] == 0.0
+    assert grps['a-prj']['alloc'] == pytest.approx(18750.0)
+    assert grps['b-prj']['alloc'] == pytest.approx(11250.0)
+    assert grps['a-prj']['alloc_reallocate'] == pytest.approx(3750.0)
+
+###################################################################################################
+
+# Nothing happens if no group was added or changed, and small changes are not notified
+
+def test_reallocateNotify(cfg, alloc):
+
+    prd = makePeriod()
+    alloc.run(reallocate.reallocatePeriod, prd, makeGroups({'a-prj': 1.0, 'b-prj': 1.0}), 0,
+              datetime.date(2026, 10, 16))
+    assert not 'reallocate' in prd
+
+    alloc.run(reallocate.reallocatePeriod, prd, makeGroups({'a-prj': 1.01, 'b-prj': 1.0}), 0,
+              datetime.date(2026, 10, 29), do_send = True)
+    assert len(prd['reallocate']) == 1
+    assert prd['reallocate'][0]['allocs'] == {}
+    assert alloc.context.outbox == []
+
+###################################################################################################
+
+# In the final period, an added group has access to the full remaining allocation
+
+def test_reallocateFinalPeriod(cfg, alloc):
+
+    prd = makePeriod()
+    n_periods = alloc.run(config.getConfig)['n_periods']
+    alloc.run(reallocate.reallocatePeriod, prd, makeGroups({'a-prj': 1.0, 'b-prj': 1.0, 'c-prj': 1.0}),
+              n_periods - 1, datetime.date(2026, 10, 16))
+
+    assert prd['groups']['c-prj']['alloc'] == pytest.approx(30000.0)
+    assert prd['groups']['a-prj']['alloc'] == pytest.approx(15000.0)
+
+###################################################################################################
+
+# A group that is added to the config during a period joins it on the next check if reallocation
+# is enabled, and is skipped until the next period otherwise (the default).
+
+def addGroup(alloc, fake, clock):
+
+    alloc.check()
+    alloc.context.outbox.clear()
+    cfg = alloc.run(config.getConfig)
+    cfg['groups']['delta-prj'] = {'lead': 'u30'}
+    cfg['users_extra']['u30'] = {'people_type': 'ttk', 'past_user': False}
+    fake.addGroup('delta-prj', ['u30'], su_usage = 7000.0)
+    clock.advance(days = 1)
+    alloc.check()
+
+    return readQuarter(alloc)['periods'][0]
+
+###################################################################################################
+
+def test_addedGroupJoins(cfg, fake, clock, alloc):
+
+    cfg['reallocate']['enabled'] = True
+    prd = addGroup(alloc, fake, clock)
+
+    assert prd['groups']['delta-prj']['su_usage_start'] == pytest.approx(7000.0)
+    assert prd['groups']['delta-prj']['alloc'] > 0.0
+    assert prd['reallocate'][0]['added'] == ['delta-prj']
+    assert sum([prd['groups'][grp]['alloc'] for grp in prd['groups']]) == pytest.approx(prd['su_alloc'])
+    emails = {email['to']: email['subject'] for email in alloc.context.outbox}
+    assert emails['u30@umd.edu'] == '%s Allocation for your group' % (messaging.subject_prefix)
+
+###################################################################################################
+
+def test_reallocateDisabled(cfg, fake, clock, alloc):
+
+    assert not cfg['reallocate']['enabled']
+    prd = addGroup(alloc, fake, clock)
+
+    assert not 'delta-prj' in prd['groups']
+    assert not 'reallocate' in prd
+    assert not 'u30@umd.edu' in [email['to'] for email in alloc.context.outbox]
+
+###################################################################################################
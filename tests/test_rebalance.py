@@ -0,0 +1,77 @@
+###################################################################################################
+#
+# This file is part of the HPC allocator code for the UMD astronomy department
+#
+# (c) Benedikt Diemer
+#
+###################################################################################################
+
+import datetime
+import pytest
+
+import hierarchy
+import rebalance
+
+###################################################################################################
+
+# A period of 30 days with an idle group a, a group c on track, and groups b and d that are 
+# projected to exceed their allocations.
+
+def makePeriod():
+
+    prd = {'start_date': datetime.date(2026, 10, 1), 'end_date': datetime.date(2026, 10, 30), 'groups': {}}
+    for grp, alloc, su_usage, weight in [['a-prj', 30000.0, 2000.0, 1.0], ['b-prj', 10000.0, 9000.0, 1.0], 
+                                          ['c-prj', 10000.0, 5000.0, 1.0], ['d-prj', 10000.0, 8500.0, 3.0]]:
+        usr = 'u' + grp[0]
+        prd['groups'][grp] = {'alloc': alloc, 'su_usage': su_usage, 'weight': weight, 'lead': usr, 
+                              'users': {usr: {}}}
+
+    return prd
+
+###################################################################################################
+
+def test_rebalancePeriod(cfg, alloc):
+
+    prd = makePeriod()
+    prd['groups']['b-prj']['users'] = {'ub': {'weight': 1.0}, 'ub2': {'weight': 1.0}}
+    subs = hierarchy.makeSubprojects({'subprojects': {'sims': {'users': ['ub2']}}}, [80, 100])
+    subs['sims'].update({'alloc': 5000.0, 'penalty_old': 0.0, 'penalty_new': 0.0})
+    prd['groups']['b-prj']['subprojects'] = subs
+    alloc.run(rebalance.rebalancePeriod, prd, datetime.date(2026, 10, 16), do_send = True)
+    grps = prd['groups']
+
+    # The idle group donates half of its projected unused allocation. Group d would get 3/4 of the
+    # pool by weight but is capped at its projected need; the rest goes to b.
+    assert grps['a-prj']['alloc'] == pytest.approx(30000.0 - 12750.0)
+    assert grps['d-prj']['alloc'] == pytest.approx(10000.0 + 9125.0)
+    assert grps['b-prj']['alloc'] == pytest.approx(10000.0 + 3625.0)
+    assert grps['c-prj']['alloc'] == pytest.approx(10000.0)
+    assert sum([grps[grp]['alloc'] for grp in grps]) == pytest.approx(60000.0)
+    assert grps['b-prj']['alloc_rebalance'] == pytest.approx(3625.0)
+
+    # The sub-project of b receives its share of the new allocation
+    assert grps['b-prj']['subprojects']['sims']['alloc'] == pytest.approx(0.5 * (10000.0 + 3625.0))
+
+    assert len(prd['rebalance']) == 1
+    assert prd['rebalance'][0]['donors'] == pytest.approx({'a-prj': 12750.0})
+    assert sorted(prd['rebalance'][0]['recipients'].keys()) == ['b-prj', 'd-prj']
+    assert sorted([email['to'] for email in alloc.context.outbox]) == ['ua@umd.edu', 'ub@umd.edu, ub2@umd.edu', 'ud@umd.edu']
+
+###################################################################################################
+
+# A group donates at most once per period, and nothing happens early in the period
+
+def test_rebalanceLimits(cfg, alloc):
+
+    prd = makePeriod()
+    alloc.run(rebalance.rebalancePeriod, prd, datetime.date(2026, 10, 5))
+    assert not 'rebalance' in prd
+
+    alloc.run(rebalance.rebalancePeriod, prd, datetime.date(2026, 10, 16))
+    allocs = {grp: prd['groups'][grp]['alloc'] for grp in prd['groups']}
+    alloc.run(rebalance.rebalancePeriod, prd, datetime.date(2026, 10, 20))
+
+    assert len(prd['rebalance']) == 1
+    assert {grp: prd['groups'][grp]['alloc'] for grp in prd['groups']} == allocs
+
+###################################################################################################
@@ -0,0 +1,83 @@
+###################################################################################################
+#
+# This file is part of the HPC allocator code for the UMD astronomy department
+#
+# (c) Benedikt Diemer
+#
+###################################################################################################
+
+import os
+import json
+import pytest
+
+import config
+import snapshot
+import run
+
+###################################################################################################
+
+def makeSnapshot(alloc):
+
+    alloc.check()
+    cfg = alloc.run(config.getConfig)
+
+    return cfg, json.loads(alloc.context.store[cfg['snapshot_file']])
+
+###################################################################################################
+
+def test_writeRecords(alloc):
+
+    cfg, snap = makeSnapshot(alloc)
+    alloc.run(snapshot.writeRecords, snap)
+
+    fname = snapshot.getRecordFile('u10', cfg['snapshot_dir'])
+    txt = open(fname).read()
+    assert txt.startswith('beta-prj: ')
+    assert 'kSU used in the 1st period (2026-10-01 to 2026-10-30)' in txt
+    dic = json.load(open(snapshot.getRecordFile('u10', cfg['snapshot_dir'], ext = 'json')))
+    assert dic['user'] == 'u10'
+    assert list(dic['groups'].keys()) == ['beta-prj']
+    assert os.path.exists(os.path.join(cfg['snapshot_dir'], 'current', 'groups', 'alpha-prj.txt'))
+
+###################################################################################################
+
+# Only the current and the previous version are kept
+
+def test_writeRecordsVersions(alloc):
+
+    cfg, snap = makeSnapshot(alloc)
+    for i in range(3):
+        alloc.run(snapshot.writeRecords, snap)
+    versions = [d for d in os.listdir(cfg['snapshot_dir']) if d.startswith('v_')]
+    current = os.path.basename(os.readlink(os.path.join(cfg['snapshot_dir'], 'current')))
+
+    assert len(versions) == 2
+    assert current in versions
+
+###################################################################################################
+
+def test_printMyUsage(alloc, capsys):
+
+    cfg, snap = makeSnapshot(alloc)
+    alloc.run(snapshot.writeRecords, snap)
+    capsys.readouterr()
+
+    run.printMyUsage(usr = 'u00', snapshot_dir = cfg['snapshot_dir'])
+    assert capsys.readouterr().out.startswith('alpha-prj: ')
+    run.printMyUsage(usr = 'nobody', snapshot_dir = cfg['snapshot_dir'])
+    assert capsys.readouterr().out == 'No usage information found for user nobody.\n'
+
+###################################################################################################
+
+def test_readSetting(tmp_path):
+
+    fname = str(tmp_path / 'config.yaml')
+    f = open(fname, 'w')
+    f.write('# snapshot_dir: commented/\nsnapshot_file: a.json\nsnapshot_dir: records/ # comment\nlock:\n  file: x\n')
+    f.close()
+
+    assert config.readSetting(fname, 'snapshot_dir') == 'records/'
+    with pytest.raises(Exception):
+        config.readSetting(fname, 'file')
+
+###################################################################################################
@@ -0,0 +1,109 @@
+###################################################################################################
+#
+# This file is part of the HPC allocator code for the UMD astronomy department
+#
+# (c) Benedikt Diemer
+#
+###################################################################################################
+
+import pytest
+
+import utils
+import run
+from conftest import readState
+
+###################################################################################################
+
+def countCalls(fake, cmd):
+
+    return len([c for c in fake.calls if c.startswith(cmd)])
+
+###################################################################################################
+
+def test_isRefreshDue():
+
+    assert not utils.isRefreshDue(None, None)
+    assert utils.isRefreshDue(None, 10)
+    assert not utils.isRefreshDue(1000.0, 10, t_now = 1000.0 + 599.0)
+    assert utils.isRefreshDue(1000.0, 10, t_now = 1000.0 + 600.0)
+
+###################################################################################################
+
+def test_collectScratchBulk(cfg, alloc):
+
+    cfg['scratch']['bulk_command'] = ['scratch_quota', '--users']
+    scratch_bulk = alloc.run(run.collectScratchBulk)
+
+    assert sorted(scratch_bulk.keys()) == ['alpha-prj', 'beta-prj', 'gamma-prj']
+    scratch_quota, scratch_usage, usr_scratch = scratch_bulk['beta-prj']
+    assert scratch_quota == pytest.approx(2000.0)
+    assert scratch_usage == pytest.approx(400.0)
+    assert usr_scratch == pytest.approx({'u10': 200.0, 'u11': 200.0})
+
+###################################################################################################
+
+# With a bulk command, scratch_quota is called once instead of once per group
+
+def test_bulkScratchOneCall(cfg, fake, alloc):
+
+    cfg['scratch']['bulk_command'] = ['scratch_quota', '--users']
+    alloc.check()
+    grps = readState(alloc, 'yaml_file_grps_cur')['grps_cur']
+
+    assert countCalls(fake, 'scratch_quota') == 1
+    assert grps['gamma-prj']['scratch_usage'] == pytest.approx(100.0)
+    assert sorted(grps['gamma-prj']['users'].keys()) == ['u20', 'u21']
+
+###################################################################################################
+
+# If one group is missing from the bulk output, only that group falls back to its last data
+
+def test_bulkScratchMissingGroup(cfg, fake, clock, alloc):
+
+    cfg['scratch']['bulk_command'] = ['scratch_quota', '--users']
+    alloc.check()
+    fake.groups['beta-prj']['users']['u10']['scratch'] = 500.0
+    fake.groups['gamma-prj']['users']['u20']['scratch'] = 500.0
+    fake.scratch_missing = ['beta-prj']
+    clock.advance(days = 1)
+    alloc.check()
+    grps = readState(alloc, 'yaml_file_grps_cur')['grps_cur']
+
+    assert grps['beta-prj']['stale']
+    assert grps['beta-prj']['scratch_usage'] == pytest.approx(400.0)
+    assert not grps['gamma-prj']['stale']
+    assert grps['gamma-prj']['scratch_usage'] == pytest.approx(550.0)
+
+###################################################################################################
+
+# SU usage and scratch data are refreshed at their own intervals within a day; without intervals,
+# nothing is queried again until the next day.
+
+def test_refreshIntervals(cfg, fake, clock, alloc):
+
+    cfg['refresh']['su_usage'] = 10
+    cfg['refresh']['scratch'] = None
+    alloc.check()
+    n_su = countCalls(fake, 'sbalance')
+    n_scratch = countCalls(fake, 'scratch_quota')
+
+    fake.addUsage('alpha-prj', 1000.0)
+    clock.advance(minutes = 5)
+    alloc.check()
+    assert countCalls(fake, 'sbalance') == n_su
+    assert countCalls(fake, 'scratch_quota') == n_scratch
+
+    clock.advance(minutes = 10)
+    alloc.check()
+    grps = readState(alloc, 'yaml_file_grps_cur')['grps_cur']
+    assert countCalls(fake, 'sbalance') > n_su
+    assert countCalls(fake, 'scratch_quota') == n_scratch
+    assert grps['alpha-prj']['su_usage'] == pytest.approx(31000.0)
+
+    n_su = countCalls(fake, 'sbalance')
+    clock.advance(days = 1)
+    alloc.check()
+    assert countCalls(fake, 'sbalance') > n_su
+    assert countCalls(fake, 'scratch_quota') > n_scratch
+
+###################################################################################################
@@ -0,0 +1,101 @@
+###################################################################################################
+#
+# This file is part of the HPC allocator code for the UMD astronomy department
+#
+# (c) Benedikt Diemer
+#
+###################################################################################################
+
+import re
+import datetime
+
+import allocator
+import cluster
+from conftest import time_start
+
+###################################################################################################
+
+def noCluster(cmd, input_text, timeout):
+
+    raise AssertionError('Cluster queried during replay: %s' % (' '.join(cmd)))
+
+###################################################################################################
+
+# Record a check on two days, with usage in between, and return the file and the live outbox
+
+def makeRecording(fake, clock, alloc, tmp_path):
+
+    fname = str(tmp_path / 'recording.gz')
+    alloc.check(record_file = fname)
+    fake.addUsage('alpha-prj', 5000.0)
+    fake.addUsage('gamma-prj', 8000.0)
+    clock.advance(days = 1)
+    alloc.check(record_file = fname)
+
+    return fname
+
+###################################################################################################
+
+# Replay output without timings
+
+def getReplayOutput(capsys):
+
+    out = capsys.readouterr().out
+    out = re.sub(r'took [0-9.]+ seconds', 'took x seconds', out)
+    out = re.sub(r'in [0-9.]+ seconds', 'in x seconds', out)
+
+    return out
+
+###################################################################################################
+
+def test_loadRecording(fake, clock, alloc, tmp_path):
+
+    fname = makeRecording(fake, clock, alloc, tmp_path)
+    runs = cluster.loadRecording(fname)
+
+    assert len(runs) == 2
+    assert runs[0]['time'] == time_start
+    assert runs[1]['time'] == time_start + datetime.timedelta(days = 1)
+    assert sum([len(r['cmds']) for r in runs]) == len(fake.calls)
+    assert runs[0]['cmds'][0]['ok']
+
+###################################################################################################
+
+# The run record is shifted by days_future, but keeps the time of day of the clock
+
+def test_recordDaysFuture(fake, clock, alloc, tmp_path):
+
+    fname = str(tmp_path / 'recording.gz')
+    alloc.check(record_file = fname, days_future = 3)
+    runs = cluster.loadRecording(fname)
+
+    assert runs[0]['time'] == time_start + datetime.timedelta(days = 3)
+
+###################################################################################################
+
+# A replay reproduces the recorded runs without querying the cluster, sends the same emails as the
+# live runs, leaves the state of the allocator untouched, and gives the same result every time.
+
+def test_replay(cfg, fake, clock, alloc, tmp_path, capsys):
+
+    fname = makeRecording(fake, clock, alloc, tmp_path)
+    n_emails = len(alloc.context.outbox)
+    store = {'marker': 'x'}
+    outbox = []
+    alloc_replay = allocator.Allocator(cfg = cfg, store = store, outbox = outbox, runner = noCluster)
+    capsys.readouterr()
+
+    alloc_replay.check(replay_file = fname)
+    out_1 = getReplayOutput(capsys)
+    alloc_replay.check(replay_file = fname)
+    out_2 = getReplayOutput(capsys)
+
+    assert 'Replayed 2 runs in x seconds, %d emails collected.' % (n_emails) in out_1
+    assert 'Replay run 2 of 2, time %s' % ((time_start + datetime.timedelta(days = 1)).strftime('%Y/%m/%d %H:%M:%S')) in out_1
+    assert '0 of %d recorded commands unused' % (len(cluster.loadRecording(fname)[0]['cmds'])) in out_1
+    assert out_1 == out_2
+    assert store == {'marker': 'x'}
+    assert outbox == []
+    assert alloc_replay.context.clock is None
+
+###################################################################################################
@@ -0,0 +1,129 @@
+###################################################################################################
+#
+# This file is part of the HPC allocator code for the UMD astronomy department
+#
+# (c) Benedikt Diemer
+#
+###################################################################################################
+
+import os
+import pwd
+
+import config
+import context
+import scratch
+
+###################################################################################################
+
+# Create a scratch tree with files of known sizes and modification times. The files are listed as
+# [path, size in bytes, modification time].
+
+files_tree = [['a.dat', 5000, 1000000], ['run1/big.dat', 9000, 2000000], ['run1/old.dat', 10, 500000],
+              ['run1/sub/x.dat', 100, 3000000], ['run2/y.dat', 7000, 4000000], ['run2/deep/er/z.dat', 1, 600000]]
+
+def makeTree(root):
+
+    for path, size, mtime in files_tree:
+        fn = os.path.join(root, path)
+        if not os.path.exists(os.path.dirname(fn)):
+            os.makedirs(os.path.dirname(fn))
+        f = open(fn, 'wb')
+        f.write(b'x' * size)
+        f.close()
+        os.utime(fn, (mtime, mtime))
+
+    return
+
+###################################################################################################
+
+def setScratchPath(cfg, tmp_path):
+
+    cfg['scratch']['path'] = str(tmp_path / 'scratch' / '{grp}')
+    cfg['scratch']['scan_processes'] = 2
+    cfg['scratch']['scan_top'] = 3
+    makeTree(str(tmp_path / 'scratch' / 'gamma-prj'))
+
+    return
+
+###################################################################################################
+
+def test_addFile():
+
+    summary = {}
+    for i in range(10):
+        scratch.addFile(summary, 'u1', i, 100 - i, 'f%d' % (i), 3)
+    other = {}
+    scratch.addFile(other, 'u1', 20, 200, 'g', 3)
+    scratch.addFile(other, 'u2', 1, 1, 'h', 3)
+    scratch.mergeSummary(summary, other, 3)
+
+    assert summary['u1'][0] == 11
+    assert summary['u1'][1] == 65
+    assert sorted(summary['u1'][2], reverse = True) == [[20, 200, 'g'], [9, 91, 'f9'], [8, 92, 'f8']]
+    assert sorted(summary['u1'][3], reverse = True) == [[-91, 9, 'f9'], [-92, 8, 'f8'], [-93, 7, 'f7']]
+    assert summary['u2'][0] == 1
+
+###################################################################################################
+
+# A scan finds the largest and oldest files; unchanged directories are taken from the cache
+
+def test_scanGroup(cfg, tmp_path, alloc, capsys):
+
+    setScratchPath(cfg, tmp_path)
+    scan = alloc.run(scratch.scanGroup, 'gamma-prj')
+    usr = pwd.getpwuid(os.getuid()).pw_name
+    s = scan['users'][usr]
+
+    assert s['n_files'] == 6
+    assert s['size'] * 1024.0**3 == sum([f[1] for f in files_tree])
+    assert [f[0] for f in s['largest']] == ['run1/big.dat', 'run2/y.dat', 'a.dat']
+    assert [f[0] for f in s['oldest']] == ['run1/old.dat', 'run2/deep/er/z.dat', 'a.dat']
+    capsys.readouterr()
+
+    alloc.run(scratch.scanGroup, 'gamma-prj')
+    assert '0 directories listed' in capsys.readouterr().out
+
+    f = open(str(tmp_path / 'scratch' / 'gamma-prj' / 'run2' / 'deep' / 'er' / 'new.dat'), 'wb')
+    f.write(b'x' * 20000)
+    f.close()
+    scan = alloc.run(scratch.scanGroup, 'gamma-prj')
+    assert '1 directories listed' in capsys.readouterr().out
+    assert scan['users'][usr]['n_files'] == 7
+    assert scan['users'][usr]['largest'][0][0] == 'run2/deep/er/new.dat'
+
+###################################################################################################
+
+# The scan processes are not forked from the allocator, which runs other threads at the same time
+
+def test_scanProcesses(cfg, tmp_path, alloc):
+
+    setScratchPath(cfg, tmp_path)
+    assert scratch.getPoolContext().get_start_method() != 'fork'
+
+    scans = []
+    t = alloc.run(context.startThread, lambda: scans.append(scratch.scanGroup('gamma-prj', verbose = False)))
+    t.join()
+    assert scans[0]['users'][pwd.getpwuid(os.getuid()).pw_name]['n_files'] == 6
+
+###################################################################################################
+
+# A scratch warning lists the files found by the scan
+
+def test_scratchWarning(cfg, fake, clock, alloc, tmp_path):
+
+    setScratchPath(cfg, tmp_path)
+    alloc.check()
+    n_emails = len(alloc.context.outbox)
+    fake.groups['gamma-prj']['users']['u20']['scratch'] = 1850.0
+    fake.groups['beta-prj']['users']['u10']['scratch'] = 1500.0
+    clock.advance(days = 1)
+    alloc.check()
+    emails = alloc.context.outbox[n_emails:]
+
+    assert len(emails) == 1
+    assert emails[0]['subject'] == '[Astro HPC] Warning: 95% of scratch quota used'
+    assert 'gamma-prj' in emails[0]['content']
+    assert 'big.dat' in emails[0]['content']
+    assert os.path.exists(os.path.join(alloc.run(config.getConfig)['scratch']['scan_dir'], 'gamma-prj'))
+
+###################################################################################################
@@ -0,0 +1,98 @@
+###################################################################################################
+#
+# This file is part of the HPC allocator code for the UMD astronomy department
+#
+# (c) Benedikt Diemer
+#
+###################################################################################################
+
+import json
+import threading
+import urllib.error
+import urllib.request
+import pytest
+from http.server import ThreadingHTTPServer
+
+import config
+import allocator
+import server
+
+###################################################################################################
+
+def getSnapshot(alloc):
+
+    cfg = alloc.run(config.getConfig)
+
+    return json.loads(alloc.context.store[cfg['snapshot_file']])
+
+###################################################################################################
+
+def test_renderResponses(alloc):
+
+    alloc.check()
+    resp = server.renderResponses(getSnapshot(alloc))
+
+    assert set(resp.keys()) == {'/', '/groups', '/metrics', '/groups/alpha-prj', '/groups/beta-prj',
+                                '/groups/gamma-prj', '/users/u00', '/users/u01', '/users/u02',
+                                '/users/u10', '/users/u11', '/users/u20', '/users/u21'}
+    content_type, body = resp['/groups/beta-prj']
+    dic = json.loads(body)
+    assert content_type == server.content_type_json
+    assert dic['group'] == 'beta-prj'
+    assert dic['users'] == ['u10', 'u11']
+    assert dic['alloc'] > 0.0
+    assert json.loads(resp['/users/u00'][1])['groups']['alpha-prj']['group_alloc'] \
+        == json.loads(resp['/groups/alpha-prj'][1])['alloc']
+
+###################################################################################################
+
+def test_metricsBody(alloc):
+
+    alloc.check()
+    snap = getSnapshot(alloc)
+    body = server.metricsBody(snap).decode('utf-8')
+    ll = body.splitlines()
+
+    assert ll[-1] == '# EOF'
+    assert 'hpc_group_alloc_su{group="alpha-prj"} %.1f' % (snap['groups']['alpha-prj']['alloc']) in ll
+    assert 'hpc_user_usage_su{group="gamma-prj",user="u21"} 0.0' in ll
+
+###################################################################################################
+
+# Serve a snapshot file over HTTP on a free port
+
+def test_serveSnapshot(cfg, alloc):
+
+    alloc.check()
+    snap = getSnapshot(alloc)
+    alloc_srv = allocator.Allocator(cfg = cfg)
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), server.StatusHandler)
+    httpd.context = alloc_srv.context
+    t = threading.Thread(target = httpd.serve_forever, daemon = True)
+    t.start()
+    url = 'http://127.0.0.1:%d' % (httpd.server_address[1])
+
+    try:
+        # Without a snapshot file, there is nothing to serve yet
+        with pytest.raises(urllib.error.HTTPError) as e:
+            urllib.request.urlopen(url + '/groups/alpha-prj')
+        assert e.value.code == 503
+
+        f = open(cfg['snapshot_file'], 'w')
+        json.dump(snap, f)
+        f.close()
+        alloc_srv.run(server.refreshResponses, force = True)
+
+        r = urllib.request.urlopen(url + '/groups/alpha-prj/')
+        assert r.status == 200
+        assert json.loads(r.read())['alloc'] == snap['groups']['alpha-prj']['alloc']
+        with pytest.raises(urllib.error.HTTPError) as e:
+            urllib.request.urlopen(url + '/groups/unknown-prj')
+        assert e.value.code == 404
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+    return
+
+###################################################################################################
@@ -0,0 +1,65 @@
+###################################################################################################
+#
+# This file is part of the HPC allocator code for the UMD astronomy department
+#
+# (c) Benedikt Diemer
+#
+###################################################################################################
+
+import pytest
+
+import allocator
+import simulate
+
+###################################################################################################
+
+def noCluster(cmd, input_text, timeout):
+
+    raise AssertionError('Cluster queried during simulation: %s' % (' '.join(cmd)))
+
+###################################################################################################
+
+# A simulation starts from the current state, runs once per day, and leaves the state and outbox
+# of the allocator unchanged.
+
+def test_simulateSynthetic(cfg, alloc, tmp_path, capsys):
+
+    alloc.check()
+    store = dict(alloc.context.store)
+    outbox = list(alloc.context.outbox)
+    alloc_sim = allocator.Allocator(cfg = cfg, store = store, outbox = outbox, runner = noCluster)
+    fname = str(tmp_path / 'report.txt')
+    capsys.readouterr()
+    alloc_sim.simulate('2026-10-20', '2026-11-03', report_file = fname)
+    out = capsys.readouterr().out
+    report = open(fname).read()
+
+    assert store == alloc.context.store
+    assert outbox == alloc.context.outbox
+    assert 'Simulation from 2026/10/20 to 2026/11/03: 15 runs' in out
+    assert '    | 2026/10/31 12:00 |       4 |      1 |' in out
+    assert 'period 1 (2026/10/31 to 2026/11/29)' in out
+    assert report.startswith('Simulation from 2026/10/20 to 2026/11/03: 15 runs')
+    assert "2nd allocation period, which runs from 2026/10/31 to 2026/11/29" in report
+
+###################################################################################################
+
+# The synthetic usage rate differs between groups but is the same in every simulation
+
+def test_usageRate(alloc):
+
+    rates = [alloc.run(simulate.getUsageRate, grp) for grp in ['alpha-prj', 'beta-prj', 'gamma-prj']]
+
+    assert len(set(rates)) == 3
+    assert rates[0] == alloc.run(simulate.getUsageRate, 'alpha-prj')
+
+###################################################################################################
+
+def test_simulateErrors(cfg, alloc):
+
+    with pytest.raises(Exception, match = 'before start date'):
+        alloc.simulate('2026-11-03', '2026-10-20')
+    with pytest.raises(Exception, match = 'require current group data'):
+        alloc.simulate('2026-10-20', '2026-10-21')
+
+###################################################################################################
@@ -0,0 +1,83 @@
+###################################################################################################
+#
+# This file is part of the HPC allocator code for the UMD astronomy department
+#
+# (c) Benedikt Diemer
+#
+###################################################################################################
+
+import pytest
+
+import allocator
+import rebalance
+import run
+from conftest import readQuarter
+
+###################################################################################################
+
+def collectGroups(cfg, fake, workers, queue_size):
+
+    cfg['cluster']['workers'] = workers
+    cfg['cluster']['queue_size'] = queue_size
+    alloc = allocator.Allocator(cfg = cfg, store = {}, runner = fake)
+
+    return alloc.run(lambda: dict(run.streamGroupData()))
+
+###################################################################################################
+
+# The groups are the same for any number of workers and any queue size
+
+def test_streamGroupData(cfg, fake):
+
+    grps_1 = collectGroups(cfg, fake, 1, 1)
+    grps_4 = collectGroups(cfg, fake, 4, 2)
+
+    assert sorted(grps_1.keys()) == ['alpha-prj', 'beta-prj', 'gamma-prj']
+    assert grps_1 == grps_4
+    assert grps_1['beta-prj']['su_usage'] == pytest.approx(40000.0)
+
+###################################################################################################
+
+# Make the check send a usage warning to gamma-prj in its second run
+
+def runWarning(cfg, fake, clock, mailer):
+
+    cfg['refresh']['su_usage'] = 10
+    alloc = allocator.Allocator(cfg = cfg, store = {}, runner = fake, clock = clock, dry_run = False, 
+                                mailer = mailer)
+    alloc.check()
+    su_alloc = readQuarter(alloc)['periods'][0]['groups']['gamma-prj']['alloc']
+    fake.addUsage('gamma-prj', su_alloc * 1.5)
+    clock.advance(hours = 1)
+
+    return alloc
+
+###################################################################################################
+
+# Messages are sent by a separate thread. Errors while sending are raised after the check, but do 
+# not replace an exception raised by the check itself.
+
+def test_sendErrors(cfg, fake, clock, monkeypatch):
+
+    sent = []
+    def mailer(msg):
+        if msg['Subject'].startswith('[Astro HPC] Warning'):
+            raise Exception('SMTP failure')
+        sent.append(msg)
+
+    alloc = runWarning(cfg, fake, clock, mailer)
+    n_sent = len(sent)
+    with pytest.raises(Exception, match = 'Could not send message .* to u20@umd.edu, u21@umd.edu \\(SMTP failure\\)'):
+        alloc.check()
+    assert len(sent) == n_sent
+
+    def fail(*args, **kwargs):
+        raise RuntimeError('Rebalancing failed.')
+
+    monkeypatch.setattr(rebalance, 'rebalancePeriod', fail)
+    cfg['rebalance']['enabled'] = True
+    alloc = runWarning(cfg, fake, clock, mailer)
+    with pytest.raises(RuntimeError, match = 'Rebalancing failed'):
+        alloc.check()
+
+###################################################################################################
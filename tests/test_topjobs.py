@@ -0,0 +1,63 @@
+###################################################################################################
+#
+# This file is part of the HPC allocator code for the UMD astronomy department
+#
+# (c) Benedikt Diemer
+#
+###################################################################################################
+
+import datetime
+
+import config
+import accounting
+from conftest import readQuarter
+
+###################################################################################################
+
+q_start = datetime.date(2026, 10, 1)
+
+###################################################################################################
+
+# Only the most expensive jobs since the start of the period are kept, and the list starts over in
+# a new period.
+
+def test_topJobs(cfg, fake, alloc):
+
+    cfg['accounting']['top_jobs'] = 3
+    for i in range(10):
+        fake.addJob('alpha-prj', 'u0%d' % (i % 3), datetime.datetime(2026, 10, 11, 10, i, 0), hours = 1.0, cpus = i + 1)
+    fake.addJob('alpha-prj', 'u00', datetime.datetime(2026, 10, 5, 10, 0, 0), hours = 1.0, cpus = 100)
+    alloc.run(accounting.collectSU, ['alpha-prj'], 4, q_start, datetime.date(2026, 10, 10))
+    jobs = alloc.run(accounting.getTopJobs, 'alpha-prj')
+
+    assert [job['su'] for job in jobs] == [10.0, 9.0, 8.0]
+    assert jobs[0] == {'su': 10.0, 'id': '1009', 'user': 'u00', 'partition': 'standard', 'end': '2026-10-11T10:09:00'}
+    assert alloc.run(accounting.getTopJobs, 'beta-prj') == []
+
+    alloc.run(accounting.collectSU, ['alpha-prj'], 4, q_start, datetime.date(2026, 10, 15))
+    assert alloc.run(accounting.getTopJobs, 'alpha-prj') == []
+
+###################################################################################################
+
+# A usage warning lists the most expensive jobs of the group
+
+def test_warningWithTopJobs(cfg, fake, clock, alloc):
+
+    cfg['accounting']['enabled'] = True
+    alloc.check()
+    su_alloc = readQuarter(alloc)['periods'][0]['groups']['gamma-prj']['alloc']
+    n_emails = len(alloc.context.outbox)
+
+    fake.addJob('gamma-prj', 'u21', clock.now, hours = 1.0, cpus = int(su_alloc * 1.1))
+    fake.addJob('gamma-prj', 'u20', clock.now, hours = 1.0, cpus = 1)
+    clock.advance(hours = 1)
+    alloc.run(config.getConfig)['refresh']['su_usage'] = 10
+    alloc.check()
+    emails = alloc.context.outbox[n_emails:]
+
+    assert len(emails) == 1
+    assert 'u20@umd.edu' in emails[0]['to']
+    assert 'the 2 most expensive jobs that finished in this period' in emails[0]['content']
+    assert '| 1000         | u21         | standard     |' in emails[0]['content']
+
+###################################################################################################
@@ -6,15 +6,38 @@
 #
 ###################################################################################################
 
+import os
 import datetime
+import threading
+import yaml
 
 import config
+import context
 
 ###################################################################################################
 
-# Quarter counter starts in 2025/4; this is hard-coded and cannot be changed later
-first_quarter_year = 2025
-first_quarter_idx = 4
+# The clock and state store of the active context (see context.py and simulate.py). If the clock is
+# set, it replaces the current date and time. If the store is set, all files written with 
+# writeFileAtomic() go to the store instead of the disk, and readYaml() looks in the store before 
+# looking on disk. The quarter counter starts at the first quarter of the context.
+
+###################################################################################################
+
+def getNow():
+
+    clock = context.get().clock
+    if clock is None:
+        return datetime.datetime.now()
+    if callable(clock):
+        return clock()
+    
+    return clock
+
+###################################################################################################
+
+def getToday():
+
+    return getNow().date()
 
 ###################################################################################################
 
@@ -26,6 +49,23 @@ def printLine():
 
 ###################################################################################################
 
+# Check whether data that were last refreshed at time t_last (in seconds since the epoch) need to
+# be refreshed again, given an interval in minutes. If the interval is None, the data are never due
+# for an extra refresh.
+
+def isRefreshDue(t_last, interval, t_now = None):
+
+    if interval is None:
+        return False
+    if t_last is None:
+        return True
+    if t_now is None:
+        t_now = getNow().timestamp()
+    
+    return (t_now - t_last >= interval * 60.0)
+
+###################################################################################################
+
 def getTotalWeight(groups):
 
     w_tot = 0.0
@@ -134,7 +174,7 @@ def getTimes(days_future = 0):
     cfg = config.getConfig()
 
     # Get current year and month
-    date_today = datetime.date.today()
+    date_today = getToday()
     if days_future != 0:
         time_delta = datetime.timedelta(days = days_future)
         date_today += time_delta
@@ -151,7 +191,8 @@ def getTimes(days_future = 0):
     else:
         q_yr = 1
     q_start = quarterStartDate(yr, q_yr)
-    q_all = (yr - first_quarter_year) * 4 + (q_yr - first_quarter_idx)
+    ctx = context.get()
+    q_all = (yr - ctx.first_quarter_year) * 4 + (q_yr - ctx.first_quarter_idx)
 
     # Determine days since beginning of quarter
     delta = date_today - q_start
@@ -221,3 +262,61 @@ def getYamlNameQuarter(q_all, yr, q_yr, previous = False):
     return yaml_file_quarter
 
 ###################################################################################################
+
+# Write a file atomically: the content goes to a temporary file in the same directory, which then
+# replaces the target. Readers thus always see either the old or the new version, never a partial
+# file.
+
+def writeFileAtomic(fname, content):
+
+    store = context.get().store
+    if store is not None:
+        store[fname] = content
+        return
+
+    fname_tmp = '%s.tmp.%d.%d' % (fname, os.getpid(), threading.get_ident())
+    f = open(fname_tmp, 'w')
+    f.write(content)
+    f.flush()
+    os.fsync(f.fileno())
+    f.close()
+    os.replace(fname_tmp, fname)
+
+    return
+
+###################################################################################################
+
+def writeYaml(fname, dic):
+
+    writeFileAtomic(fname, yaml.dump(dic))
+
+    return
+
+###################################################################################################
+
+def fileExists(fname):
+
+    store = context.get().store
+    if (store is not None) and (fname in store):
+        return True
+
+    return os.path.exists(fname)
+
+###################################################################################################
+
+# Load a yaml file; returns None if the file does not exist.
+
+def readYaml(fname):
+
+    store = context.get().store
+    if (store is not None) and (fname in store):
+        return yaml.safe_load(store[fname])
+    if not os.path.exists(fname):
+        return None
+    pFile = open(fname, 'r')
+    dic = yaml.safe_load(pFile)
+    pFile.close()
+
+    return dic
+
+###################################################################################################